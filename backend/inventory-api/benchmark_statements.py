@@ -0,0 +1,58 @@
+"""
+Benchmark: CPU per stock lookup and reduction, statements rebuilt on every call (as the
+hot paths did) vs the statements built once in stock_levels.py (see query_cache.py).
+
+Runs on an in-memory SQLite database so the time is the Python side: statement build,
+cache key, compile or cache lookup, and the execution itself.
+
+    python benchmark_statements.py --items 1 10 50
+"""
+import argparse
+import time
+
+from sqlalchemy import create_engine, select, update
+from sqlalchemy.pool import StaticPool
+
+import stock_levels
+from database import inventory_table, metadata
+
+
+def rebuilt(conn, skus):
+    # What reduce_stock_in_place did per item before
+    for sku in skus:
+        level = conn.execute(select(inventory_table.c.stock_level).where(inventory_table.c.product_id == sku)).scalar()
+        conn.execute(update(inventory_table).where(inventory_table.c.product_id == sku).values(stock_level=level - 1))
+
+
+def prebuilt(conn, skus):
+    for sku in skus:
+        level = conn.execute(stock_levels.select_stock_level, {"sku": sku}).scalar()
+        conn.execute(stock_levels.set_stock_level, {"sku": sku, "new_level": level - 1})
+
+
+def per_call_us(path, engine, skus, repeat: int) -> float:
+    with engine.begin() as conn:
+        path(conn, skus)  # warm the compiled cache
+        start = time.process_time()
+        for _ in range(repeat):
+            path(conn, skus)
+        return (time.process_time() - start) / repeat * 1e6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, nargs="+", default=[1, 10, 50], help="cart lines per reduction")
+    parser.add_argument("--repeat", type=int, default=500)
+    args = parser.parse_args()
+
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(inventory_table.insert(), [{"product_id": f"SKU-{i}", "stock_level": 10**9} for i in range(max(args.items))])
+
+    print(f"{'items':>6} {'rebuilt us':>11} {'prebuilt us':>12} {'speedup':>8}")
+    for items in args.items:
+        skus = [f"SKU-{i}" for i in range(items)]
+        rebuilt_us = per_call_us(rebuilt, engine, skus, args.repeat)
+        prebuilt_us = per_call_us(prebuilt, engine, skus, args.repeat)
+        print(f"{items:>6} {rebuilt_us:>11.1f} {prebuilt_us:>12.1f} {rebuilt_us / prebuilt_us:>7.2f}x")
@@ -0,0 +1,55 @@
+"""
+Benchmark: the orders -> inventory stock reduction payload, JSON vs the binary encoding
+(item_codec.py), without the database: what each side spends per call on the wire format.
+
+- encode: orders-api building the body from its cart (dicts + json.dumps, as httpx does,
+  vs item_codec.encode)
+- decode: inventory-api parsing and validating it (List[ItemPurchased] vs item_codec.decode)
+
+    python benchmark_transport.py --items 3 50 1000 10000
+"""
+import argparse
+import json
+import time
+
+import item_codec
+from main import purchased_items
+
+
+def per_call_us(function, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def run(items: int, repeat: int):
+    cart = [(f"SKU-{1000 + i}", 1 + i % 5) for i in range(items)]
+
+    def encode_json():
+        return json.dumps([{"id": product_id, "quantity": quantity} for product_id, quantity in cart]).encode("utf-8")
+
+    def encode_binary():
+        return item_codec.encode(cart)
+
+    json_body, binary_body = encode_json(), encode_binary()
+    assert [(item.id, item.quantity) for item in purchased_items.validate_json(json_body)] == item_codec.decode(binary_body)
+    return {
+        "json": (len(json_body), per_call_us(encode_json, repeat), per_call_us(lambda: purchased_items.validate_json(json_body), repeat)),
+        "binary": (len(binary_body), per_call_us(encode_binary, repeat), per_call_us(lambda: item_codec.decode(binary_body), repeat)),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, nargs="+", default=[3, 50, 1000, 10000], help="items per call")
+    parser.add_argument("--calls", type=int, default=20000, help="items x calls per measurement")
+    args = parser.parse_args()
+
+    print(f"{'items':>7} {'format':>7} {'bytes':>9} {'encode us':>10} {'decode us':>10} {'total':>8}")
+    for items in args.items:
+        results = run(items, max(10, args.calls * 10 // items))
+        json_total = sum(results["json"][1:])
+        for name, (size, encode_us, decode_us) in results.items():
+            speedup = "" if name == "json" else f"{json_total / (encode_us + decode_us):.1f}x"
+            print(f"{items:>7} {name:>7} {size:>9} {encode_us:>10.1f} {decode_us:>10.1f} {speedup:>8}")
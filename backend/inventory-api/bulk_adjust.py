@@ -0,0 +1,243 @@
+"""
+Bulk stock adjustments for nightly warehouse syncs.
+
+Input is a stream of lines, one adjustment per line, either CSV:
+
+    product_id,mode,value
+    1001,set,250
+    1002,delta,-3
+
+or JSON lines: {"product_id": "1001", "mode": "set", "value": 250}
+
+"set" replaces the stock level, "delta" adds to it (never below 0).
+Lines are applied in chunks: each chunk is loaded into the staging table and
+applied with ONE set-based UPDATE ... FROM, in its own short transaction.
+A bad line or an unknown SKU only counts as failed, it never aborts the sync.
+
+Usage:
+    python bulk_adjust.py warehouse-sync.csv [--chunk-size 5000]
+    cat warehouse-sync.csv | python bulk_adjust.py -
+"""
+import argparse
+import json
+import os
+import sys
+import uuid
+from typing import Iterable, List
+
+from sqlalchemy import bindparam, case, delete, select, update
+
+import reconcile
+import stock_ledger
+import stock_levels
+from database import engine, inventory_table, adjustments_staging_table
+
+DEFAULT_CHUNK_SIZE = int(os.getenv("BULK_ADJUST_CHUNK_SIZE", "5000"))
+VALID_MODES = ("set", "delta")
+
+# Locks the chunk's rows (in key order, like every other writer) and reads their levels, so
+# no sale can commit between this read and the UPDATE (see query_cache.py)
+lock_stock_levels = (
+    select(inventory_table.c.product_id, inventory_table.c.stock_level)
+    .where(inventory_table.c.product_id.in_(bindparam("skus", expanding=True)))
+    .order_by(inventory_table.c.product_id)
+    .with_for_update()
+)
+# Only keep the first few error messages, the counts are what matters for 100k+ lines
+MAX_REPORTED_ERRORS = 50
+
+
+def parse_adjustment(line: str):
+    """
+    Parses one input line into {"product_id", "mode", "value"}.
+    Returns None for blank lines and the CSV header, raises ValueError for bad lines.
+    """
+    line = line.strip()
+    if not line:
+        return None
+
+    if line.startswith("{"):
+        try:
+            data = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"invalid JSON: {e}")
+        product_id, mode, value = data.get("product_id"), data.get("mode"), data.get("value")
+    else:
+        parts = [part.strip() for part in line.split(",")]
+        if len(parts) != 3:
+            raise ValueError("expected 3 columns: product_id,mode,value")
+        product_id, mode, value = parts
+        if product_id == "product_id":
+            return None  # CSV header
+
+    if not product_id:
+        raise ValueError("missing product_id")
+    if mode not in VALID_MODES:
+        raise ValueError(f"mode must be one of {VALID_MODES}, got {mode!r}")
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"value must be an integer, got {value!r}")
+    if mode == "set" and value < 0:
+        raise ValueError("absolute stock level cannot be negative")
+
+    return {"product_id": str(product_id), "mode": mode, "value": value}
+
+
+def _collapse(rows: List[dict]) -> List[dict]:
+    # UPDATE ... FROM needs at most one staging row per product,
+    # so fold repeated SKUs inside a chunk in file order.
+    merged = {}
+    for row in rows:
+        previous = merged.get(row["product_id"])
+        if previous is None or row["mode"] == "set":
+            merged[row["product_id"]] = dict(row)
+        else:
+            previous["value"] += row["value"]
+    return list(merged.values())
+
+
+def apply_chunk(rows: List[dict]) -> dict:
+    """
+    Applies one chunk of parsed adjustments in a single transaction.
+    Returns {"updated_items": [...], "missing": [...]} where missing are unknown SKUs.
+    """
+    rows = _collapse(rows)
+    if stock_ledger.LEDGER_MODE:
+        result = _apply_chunk_to_ledger(rows)
+    else:
+        result = _apply_chunk_in_place(rows)
+    stock_levels.after_commit(result["updated_items"])
+    return result
+
+
+def _apply_chunk_in_place(rows: List[dict]) -> dict:
+    batch_id = uuid.uuid4().hex
+    staged = adjustments_staging_table.c
+
+    new_level = case(
+        (staged.mode == "set", staged.value),
+        else_=inventory_table.c.stock_level + staged.value,
+    )
+    update_query = (
+        update(inventory_table)
+        .values(stock_level=case((new_level < 0, 0), else_=new_level))
+        .where(inventory_table.c.product_id == staged.product_id)
+        .where(staged.batch_id == batch_id)
+        .returning(inventory_table.c.product_id, inventory_table.c.stock_level)
+    )
+
+    with engine.begin() as conn:
+        conn.execute(
+            adjustments_staging_table.insert(),
+            [{"batch_id": batch_id, **row} for row in rows],
+        )
+        # Levels before the UPDATE, with the rows locked: the baseline shift below must be
+        # exactly this adjustment, never a sale that committed in between
+        previous = dict(conn.execute(lock_stock_levels, {"skus": sorted(row["product_id"] for row in rows)}).fetchall())
+        updated = conn.execute(update_query).fetchall()
+        conn.execute(delete(adjustments_staging_table).where(staged.batch_id == batch_id))
+        # Warehouse changes aren't sales: keep them out of the reconciliation drift
+        reconcile.shift_baselines(conn, {row[0]: row[1] - previous[row[0]] for row in updated})
+        stock_levels.publish_changes(conn, [row[0] for row in updated])
+
+    updated_items = [{"product_id": row[0], "new_stock_level": row[1]} for row in updated]
+    found = {item["product_id"] for item in updated_items}
+    missing = [row["product_id"] for row in rows if row["product_id"] not in found]
+    return {"updated_items": updated_items, "missing": missing}
+
+
+def _apply_chunk_to_ledger(rows: List[dict]) -> dict:
+    # In ledger mode the snapshot row is never updated directly: each adjustment
+    # becomes a ledger movement computed against the available stock.
+    updated_items, missing, movements = [], [], []
+    with engine.begin() as conn:
+        available = stock_ledger.available_stock(conn, [row["product_id"] for row in rows])
+        for row in rows:
+            current_stock = available.get(row["product_id"])
+            if current_stock is None:
+                missing.append(row["product_id"])
+                continue
+            new_stock = row["value"] if row["mode"] == "set" else max(0, current_stock + row["value"])
+            movements.append((row["product_id"], new_stock - current_stock, "adjustment"))
+            updated_items.append({"product_id": row["product_id"], "new_stock_level": new_stock})
+        stock_ledger.record_movements(conn, movements)
+        reconcile.shift_baselines(conn, {product_id: delta for product_id, delta, _ in movements})
+        stock_levels.publish_changes(conn, [item["product_id"] for item in updated_items])
+    return {"updated_items": updated_items, "missing": missing}
+
+
+class BulkAdjustment:
+    """
+    Accumulates parsed lines into chunks and keeps the running report.
+    Shared by the CLI (sync file iteration) and the API (async request stream).
+    """
+
+    def __init__(self, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.chunk_size = max(1, chunk_size)
+        self.pending: List[dict] = []
+        self.line_no = 0
+        self.report = {"applied": 0, "failed": 0, "chunks": 0, "errors": []}
+
+    def _error(self, message: str):
+        self.report["failed"] += 1
+        if len(self.report["errors"]) < MAX_REPORTED_ERRORS:
+            self.report["errors"].append(message)
+
+    def add_line(self, line: str) -> bool:
+        """Parses a line. Returns True when a full chunk is ready to flush."""
+        self.line_no += 1
+        try:
+            row = parse_adjustment(line)
+        except ValueError as e:
+            self._error(f"line {self.line_no}: {e}")
+            return False
+        if row is not None:
+            self.pending.append(row)
+        return len(self.pending) >= self.chunk_size
+
+    def flush(self) -> List[dict]:
+        """Applies the pending chunk. Returns the updated items of that chunk."""
+        if not self.pending:
+            return []
+        rows, self.pending = self.pending, []
+        try:
+            result = apply_chunk(rows)
+        except Exception as e:
+            # The chunk's transaction was rolled back; earlier chunks stay committed
+            for _ in rows:
+                self._error(f"chunk {self.report['chunks'] + 1} failed: {e}")
+            self.report["chunks"] += 1
+            return []
+
+        self.report["chunks"] += 1
+        self.report["applied"] += len(result["updated_items"])
+        for product_id in result["missing"]:
+            self._error(f"product {product_id} not found in inventory")
+        return result["updated_items"]
+
+
+def apply_adjustments(lines: Iterable[str], chunk_size: int = DEFAULT_CHUNK_SIZE) -> dict:
+    """Streams lines through chunked set-based updates and returns the report."""
+    bulk = BulkAdjustment(chunk_size)
+    for line in lines:
+        if bulk.add_line(line):
+            bulk.flush()
+    bulk.flush()
+    return bulk.report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply bulk stock adjustments from a CSV/JSON-lines file.")
+    parser.add_argument("path", help="Input file, or - for stdin")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    if args.path == "-":
+        report = apply_adjustments(sys.stdin, args.chunk_size)
+    else:
+        with open(args.path, encoding="utf-8") as f:
+            report = apply_adjustments(f, args.chunk_size)
+
+    print(json.dumps(report, indent=2))
+    sys.exit(1 if report["failed"] else 0)
@@ -0,0 +1,203 @@
+"""
+Cross-replica cache invalidation.
+
+Writers call publish(conn, channel, keys) inside their transaction; every replica runs
+an InvalidationListener that evicts those keys from its in-process cache tier once the
+transaction commits (the writer itself already dropped them from the shared tier).
+
+- PostgreSQL: publish() is a pg_notify(), the listener holds a LISTEN connection.
+  Notifications are transactional, so a rolled-back write never evicts anything.
+- Other databases (SQLite in tests and local runs): publish() appends a row to
+  'cache_invalidations' and the listener polls for rows newer than the last one it saw.
+
+Whenever the listener (re)connects it may have missed changes, so it runs a full resync
+(on_resync, which drops the whole in-process tier) before trusting the feed again.
+
+CACHE_INVALIDATION_MODE: "auto" (default: notify on PostgreSQL, poll otherwise),
+"poll" (always use the table) or "off".
+
+This file is identical in products-api and inventory-api (each service is its own image).
+"""
+import asyncio
+import json
+import os
+import select as select_module
+import time
+from typing import Callable, Iterable, List
+
+from sqlalchemy import bindparam, delete, func, select
+from starlette.concurrency import run_in_threadpool
+
+from database import engine, cache_invalidations_table
+
+CACHE_INVALIDATION_MODE = os.getenv("CACHE_INVALIDATION_MODE", "auto")
+# Polling interval (poll mode) and longest single wait for a notification (notify mode)
+CACHE_INVALIDATION_POLL_SECONDS = float(os.getenv("CACHE_INVALIDATION_POLL_SECONDS", "1"))
+# How long to wait before reconnecting after the listener lost its connection
+CACHE_INVALIDATION_RETRY_SECONDS = float(os.getenv("CACHE_INVALIDATION_RETRY_SECONDS", "5"))
+# Poll mode keeps feed rows this long
+CACHE_INVALIDATION_RETENTION_SECONDS = float(os.getenv("CACHE_INVALIDATION_RETENTION_SECONDS", "3600"))
+# pg_notify payloads are limited to 8000 bytes
+MAX_NOTIFY_PAYLOAD_BYTES = 7000
+KEEPALIVE_SECONDS = 30.0
+PRUNE_INTERVAL_SECONDS = 60.0
+
+
+def uses_notify(dialect_name: str) -> bool:
+    return CACHE_INVALIDATION_MODE == "auto" and dialect_name == "postgresql"
+
+
+def _notify_payloads(keys: List[str]) -> List[str]:
+    payloads, batch = [], []
+    for key in keys:
+        if batch and len(json.dumps(batch + [key])) > MAX_NOTIFY_PAYLOAD_BYTES:
+            payloads.append(json.dumps(batch))
+            batch = []
+        batch.append(key)
+    if batch:
+        payloads.append(json.dumps(batch))
+    return payloads
+
+
+# Hot-path statements, built once (see query_cache.py)
+_notify = select(func.pg_notify(bindparam("channel"), bindparam("payload")))
+_record_change = cache_invalidations_table.insert()
+
+
+def publish(conn, channel: str, keys: Iterable[str]):
+    """Announces changed keys to every replica, as part of the caller's transaction."""
+    keys = sorted(set(keys))
+    if not keys or CACHE_INVALIDATION_MODE == "off":
+        return
+    if uses_notify(conn.dialect.name):
+        for payload in _notify_payloads(keys):
+            conn.execute(_notify, {"channel": channel, "payload": payload})
+    else:
+        conn.execute(_record_change, {"channel": channel, "changed_keys": json.dumps(keys), "created_at": time.time()})
+
+
+class InvalidationListener:
+    """
+    Applies one channel's change notifications to this replica.
+    on_keys(keys) evicts the given keys, on_resync() drops everything.
+    """
+
+    def __init__(self, channel: str, on_keys: Callable[[List[str]], None], on_resync: Callable[[], None]):
+        self.channel = channel
+        self.on_keys = on_keys
+        self.on_resync = on_resync
+        self.connected = False
+        self.connection = None  # DBAPI connection holding the LISTEN (notify mode)
+        self.last_id = 0  # Last feed row applied (poll mode)
+        self.last_activity = 0.0
+        self.last_prune = 0.0
+        self.stats = {"notifications": 0, "keys_evicted": 0, "resyncs": 0, "errors": 0}
+
+    @property
+    def uses_notify(self) -> bool:
+        return uses_notify(engine.dialect.name)
+
+    def poll(self, timeout: float = 0.0) -> int:
+        """
+        Applies pending changes, waiting up to timeout for a notification in notify mode.
+        Returns the number of evicted keys. Connection errors are logged, not raised:
+        the next call reconnects and resyncs.
+        """
+        try:
+            if not self.connected:
+                self._connect()
+                self.connected = True
+                self._resync()
+            batches = self._wait_for_notifications(timeout) if self.uses_notify else self._read_feed()
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"  WARNING: Cache invalidation listener on '{self.channel}' lost its connection. {e}")
+            self._disconnect()
+            return 0
+
+        evicted = 0
+        for keys in batches:
+            self.stats["notifications"] += 1
+            self.on_keys(keys)
+            evicted += len(keys)
+        self.stats["keys_evicted"] += evicted
+        return evicted
+
+    async def run(self):
+        """Background task: listens until cancelled."""
+        if CACHE_INVALIDATION_MODE == "off":
+            return
+        try:
+            while True:
+                await run_in_threadpool(self.poll, CACHE_INVALIDATION_POLL_SECONDS)
+                if not self.connected:
+                    await asyncio.sleep(CACHE_INVALIDATION_RETRY_SECONDS)
+                elif not self.uses_notify:
+                    await asyncio.sleep(CACHE_INVALIDATION_POLL_SECONDS)
+        finally:
+            self._disconnect()
+
+    def _resync(self):
+        # Anything may have changed while we weren't listening
+        self.stats["resyncs"] += 1
+        self.on_resync()
+
+    def _connect(self):
+        self.last_activity = time.monotonic()
+        if not self.uses_notify:
+            # Start after the newest row: older changes are covered by the resync
+            with engine.connect() as conn:
+                self.last_id = conn.execute(select(func.max(cache_invalidations_table.c.id))).scalar() or 0
+            return
+        # A dedicated connection, detached from the pool: it stays in LISTEN for its whole life
+        raw = engine.raw_connection()
+        raw.detach()
+        self.connection = raw.driver_connection
+        self.connection.autocommit = True
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'LISTEN "{self.channel}"')
+
+    def _disconnect(self):
+        self.connected = False
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            self.connection = None
+
+    def _wait_for_notifications(self, timeout: float) -> List[List[str]]:
+        readable, _, _ = select_module.select([self.connection], [], [], timeout)
+        now = time.monotonic()
+        if readable:
+            self.last_activity = now
+        elif now - self.last_activity > KEEPALIVE_SECONDS:
+            # Nothing heard for a while: make sure the connection is still alive
+            with self.connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            self.last_activity = now
+        self.connection.poll()
+        batches = []
+        while self.connection.notifies:
+            notification = self.connection.notifies.pop(0)
+            if notification.channel == self.channel:
+                batches.append(json.loads(notification.payload))
+        return batches
+
+    def _read_feed(self) -> List[List[str]]:
+        feed = cache_invalidations_table.c
+        with engine.begin() as conn:
+            rows = conn.execute(
+                select(feed.id, feed.changed_keys)
+                .where(feed.channel == self.channel, feed.id > self.last_id)
+                .order_by(feed.id)
+            ).fetchall()
+            now = time.time()
+            if now - self.last_prune > PRUNE_INTERVAL_SECONDS:
+                self.last_prune = now
+                conn.execute(delete(cache_invalidations_table).where(
+                    feed.created_at < now - CACHE_INVALIDATION_RETENTION_SECONDS
+                ))
+        if rows:
+            self.last_id = rows[-1].id
+        return [json.loads(row.changed_keys) for row in rows]
@@ -0,0 +1,84 @@
+"""
+Compact binary encoding of (product ID, quantity) lists for orders-api -> inventory-api.
+
+A JSON list of {"id", "quantity"} objects costs a dict per item to build on one side and
+a validated model per item on the other, which dominates the call for big or batched
+carts. This format is columnar, so each side does a handful of struct calls per list:
+
+    b"SKU1" | count: uint32 | count x quantity: int32 | count x len(id): uint16 | ids (UTF-8)
+
+(all little-endian). Decoding checks the magic and that the lengths add up to the body
+exactly; anything else raises ValueError. Items come back as (id, quantity) tuples, with
+the same .id / .quantity attributes as the JSON model.
+
+It is used when both sides opt in: requests with Content-Type CONTENT_TYPE, responses
+when the caller sends Accept: CONTENT_TYPE. JSON stays the default.
+
+This file is identical in orders-api and inventory-api (each service is its own image).
+"""
+import struct
+from itertools import accumulate, repeat
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+CONTENT_TYPE = "application/x-stock-items"
+MAGIC = b"SKU1"
+_HEADER = struct.Struct("<4sI")
+
+
+class Item(NamedTuple):
+    id: str
+    quantity: int
+
+
+def is_binary(content_type: Optional[str]) -> bool:
+    return (content_type or "").split(";")[0].strip().lower() == CONTENT_TYPE
+
+
+def accepts_binary(accept: Optional[str]) -> bool:
+    return any(is_binary(media_type) for media_type in (accept or "").split(","))
+
+
+def encode(items: Iterable[Tuple[str, int]]) -> bytes:
+    """Encodes (id, quantity) pairs. Raises ValueError for IDs over 65535 bytes or non-int32 quantities."""
+    pairs = list(items)
+    ids = [str(product_id).encode("utf-8") for product_id, _ in pairs]
+    count = len(pairs)
+    try:
+        return b"".join([
+            _HEADER.pack(MAGIC, count),
+            struct.pack(f"<{count}i", *(quantity for _, quantity in pairs)),
+            struct.pack(f"<{count}H", *map(len, ids)),
+            *ids,
+        ])
+    except struct.error as e:
+        raise ValueError(f"cannot encode items: {e}")
+
+
+def decode(body: bytes) -> List[Item]:
+    """Decodes and validates a body from encode(). Raises ValueError if it is malformed."""
+    if len(body) < _HEADER.size:
+        raise ValueError("body too short")
+    magic, count = _HEADER.unpack_from(body)
+    if magic != MAGIC:
+        raise ValueError("not a stock items body")
+    ids_at = _HEADER.size + 6 * count
+    if len(body) < ids_at:
+        raise ValueError(f"body too short for {count} items")
+
+    quantities = struct.unpack_from(f"<{count}i", body, _HEADER.size)
+    lengths = struct.unpack_from(f"<{count}H", body, _HEADER.size + 4 * count)
+    ends = list(accumulate(lengths, initial=ids_at))
+    if ends[-1] != len(body):
+        raise ValueError("ID lengths don't match the body size")
+
+    try:
+        text = body[ids_at:].decode("utf-8")
+        if len(text) == len(body) - ids_at:
+            # ASCII (the usual case): byte offsets are character offsets, slice the str
+            ids = [text[start - ids_at:end - ids_at] for start, end in zip(ends, ends[1:])]
+        else:
+            ids = [body[start:end].decode("utf-8") for start, end in zip(ends, ends[1:])]
+    except UnicodeDecodeError as e:
+        raise ValueError(f"invalid UTF-8 in IDs: {e}")
+    # tuple.__new__ skips the Python-level NamedTuple constructor (2x faster on big lists)
+    return list(map(tuple.__new__, repeat(Item), zip(ids, quantities)))
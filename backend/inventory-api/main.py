@@ -1,10 +1,23 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Request, Response
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import PlainTextResponse
+from starlette.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List
-from database import engine, inventory_table, create_db_and_tables
-from sqlalchemy import select, update
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from typing import List, Optional
+import asyncio
+from database import engine, create_db_and_tables
 from seed_db import seed_database
+import stock_ledger
+import stock_levels
+import reservations
+import stock_stream
+import item_codec
+import metrics
+import profiling
+from single_flight import SingleFlight
+from admission import AdmissionController, AdmissionMiddleware, CHECKOUT, READ
+from bulk_adjust import BulkAdjustment, DEFAULT_CHUNK_SIZE
 # --- Pydantic Models (Data Contracts) ---
 # This is what the Orders Service will send us
 # We only need the product ID and the quantity purchased
@@ -12,9 +25,34 @@ class ItemPurchased(BaseModel):
     id: str
     quantity: int
 
+purchased_items = TypeAdapter(List[ItemPurchased])
+
+# A held quantity must be positive: zero or less would lower the held sum and oversell
+class ReservedItem(ItemPurchased):
+    quantity: int = Field(gt=0)
+
+# What checkout sends to hold stock while the customer pays
+class ReservationRequest(BaseModel):
+    items: List[ReservedItem]
+    ttl_seconds: Optional[int] = None
+
 # --- FastAPI App ---
 app = FastAPI()
 
+# --- Admission Control ---
+# Bounded concurrency and wait queue per route class, 503 + Retry-After when full
+# (see admission.py). Added before CORS so shed responses still carry CORS headers.
+def classify_route(method: str, path: str):
+    if not path.startswith("/api/inventory") or path == "/api/inventory/stream":
+        return None  # Health checks, /metrics and long-lived streams
+    if path == "/api/inventory/reduce" or path.startswith("/api/inventory/reservations"):
+        return CHECKOUT
+    # Lookups, and warehouse syncs (bulk-adjust) which can wait behind checkout
+    return READ
+
+admission_controller = AdmissionController("inventory-api")
+app.add_middleware(AdmissionMiddleware, controller=admission_controller, classify=classify_route)
+
 # --- CORS Configuration ---
 # Allow requests from the Orders Service (port 8001)
 # and the Frontend (port 3000)
@@ -31,6 +69,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# --- Profiling ---
+# Guarded /debug/profile endpoints and per-request profiling (see profiling.py)
+profiling.install(app)
+
 # --- Database Connection ---
 @app.on_event("startup")
 def on_startup():
@@ -41,69 +83,185 @@ def on_startup():
     # This will uses the SAME engine, so it connects to RDS
     seed_database()
 
+    # 3. Load the known SKUs into the negative-lookup filter
+    stock_levels.known_products.build()
+
+    # 4. Background jobs: expired reservation sweeper, stock cache invalidation
+    # listener and, in ledger mode, folding the ledger into the stock snapshot
+    app.state.background_tasks = [
+        asyncio.create_task(run_reservation_sweeper()),
+        asyncio.create_task(stock_levels.stock_listener.run()),
+    ]
+    if stock_ledger.LEDGER_MODE:
+        app.state.background_tasks.append(asyncio.create_task(run_ledger_compaction()))
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    for task in getattr(app.state, "background_tasks", []):
+        task.cancel()
+
+async def run_ledger_compaction():
+    while True:
+        await asyncio.sleep(stock_ledger.COMPACT_INTERVAL_SECONDS)
+        try:
+            compacted = await run_in_threadpool(stock_ledger.compact)
+            if compacted:
+                print(f"[Inventory Service] Compacted {compacted} ledger rows.")
+        except Exception as e:
+            # Pending rows stay pending, so the next run simply picks them up
+            print(f"  ERROR: Ledger compaction failed. {e}")
+
+async def run_reservation_sweeper():
+    while True:
+        await asyncio.sleep(reservations.SWEEP_INTERVAL_SECONDS)
+        try:
+            swept = await run_in_threadpool(reservations.sweep_expired)
+            if swept:
+                print(f"[Inventory Service] Released {swept} expired reservation rows.")
+        except Exception as e:
+            print(f"  ERROR: Reservation sweep failed. {e}")
+
+# Concurrent cache misses for one SKU share a single query (see single_flight.py)
+stock_lookups = SingleFlight("inventory")
+
 # --- API Endpoints ---
 
 @app.get("/")
 def read_root():
     return {"status": "Inventory API is running"}
 
+# Prometheus scrape endpoint (see metrics.py)
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return metrics.render()
+
+# Fast availability check for checkout: stock minus unexpired holds
+# e.g. GET /api/inventory/available?ids=1001,1002
+# (declared before /api/inventory/{product_id} so "available" isn't taken as an ID)
+@app.get("/api/inventory/available")
+async def get_available_stock(ids: str):
+    product_ids = [product_id for product_id in ids.split(",") if product_id]
+    with engine.connect() as conn:
+        return reservations.availability(conn, product_ids)
+
+# Live stock levels for product pages, instead of polling /api/inventory/{product_id}
+# e.g. GET /api/inventory/stream?ids=1001,1002 (Server-Sent Events, see stock_stream.py)
+@app.get("/api/inventory/stream")
+async def stream_inventory(ids: str):
+    product_ids = list(dict.fromkeys(product_id for product_id in ids.split(",") if product_id))
+    if not product_ids or len(product_ids) > stock_stream.STREAM_MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"Pass between 1 and {stock_stream.STREAM_MAX_IDS} product IDs")
+    broadcaster = stock_stream.broadcaster
+    if broadcaster.client_count >= stock_stream.STREAM_MAX_CLIENTS:
+        raise HTTPException(status_code=503, detail="Too many open stock streams", headers={"Retry-After": "5"})
+
+    with engine.connect() as conn:
+        snapshot = stock_levels.current_stock(conn, product_ids)
+    subscriber = broadcaster.subscribe(product_ids, snapshot)
+    return stock_stream.StockStreamResponse(
+        subscriber, broadcaster, headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # Endpoint for the frontend to check stock
 @app.get("/api/inventory/{product_id}")
 async def get_inventory_level(product_id: str):
-    with engine.connect() as conn:
-        query = select(inventory_table.c.stock_level).where(inventory_table.c.product_id == product_id)
-        result = conn.execute(query).first()
-        
-        if result:
-            return {"product_id": product_id, "stock_level": result[0]}
-        else:
-            raise HTTPException(status_code=404, detail=f"Inventory for product {product_id} not found")
+    if stock_levels.known_products.definitely_missing(product_id):
+        raise HTTPException(status_code=404, detail=f"Inventory for product {product_id} not found")
+
+    # Served from the stock cache for a few seconds (see stock_levels.py)
+    stock_level = await stock_levels.stock_cache.aget(product_id)
+    if stock_level is None:
+        stock_level = await stock_lookups.run(product_id, stock_levels.load_level, product_id)
+        if stock_level is None:
+            stock_levels.known_products.record_false_positive()
+
+    if stock_level is not None:
+        return {"product_id": product_id, "stock_level": stock_level}
+    else:
+        raise HTTPException(status_code=404, detail=f"Inventory for product {product_id} not found")
 
 # Endpoint for the Orders Service to reduce stock
-@app.post("/api/inventory/reduce")
-async def reduce_inventory(items: List[ItemPurchased]):
+# JSON (List[ItemPurchased]) by default; orders-api can send and accept the compact
+# binary encoding instead (see item_codec.py), decoded without a model per item.
+@app.post("/api/inventory/reduce", openapi_extra={"requestBody": {"required": True, "content": {
+    "application/json": {"schema": {"type": "array", "items": {"$ref": "#/components/schemas/ItemPurchased"}}},
+    item_codec.CONTENT_TYPE: {"schema": {"type": "string", "format": "binary"}},
+}}})
+async def reduce_inventory(request: Request):
+    body = await request.body()
+    if item_codec.is_binary(request.headers.get("content-type")):
+        try:
+            items = item_codec.decode(body)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid {item_codec.CONTENT_TYPE} body: {e}")
+    else:
+        try:
+            items = purchased_items.validate_json(body)
+        except ValidationError as e:
+            raise RequestValidationError([{**error, "loc": ("body", *error["loc"])} for error in e.errors()], body=body)
+
     print("\n--- [Inventory Service] ---")
     print(f"Received request to reduce stock for {len(items)} item types.")
     
-    updated_items = []
-    
-    with engine.connect() as conn:
-        trans = conn.begin() # Start a database transaction
-        try:
-            for item in items:
-                # Get current stock
-                stock_query = select(inventory_table.c.stock_level).where(inventory_table.c.product_id == item.id)
-                current_stock = conn.execute(stock_query).scalar()
-
-                if current_stock is None:
-                    print(f"  ERROR: Product {item.id} not found in inventory.")
-                    continue # Skip this item
-                
-                if current_stock < item.quantity:
-                    # This is a problem! We sold something we don't have.
-                    # In a real system, this would trigger a compensation (e.g., refund)
-                    print(f"  ERROR: Stock for {item.id} is {current_stock}, but {item.quantity} were sold! Setting stock to 0.")
-                    new_stock = 0
-                else:
-                    new_stock = current_stock - item.quantity
-                
-                # Update the database
-                update_query = (
-                    update(inventory_table)
-                    .where(inventory_table.c.product_id == item.id)
-                    .values(stock_level=new_stock)
-                )
-                conn.execute(update_query)
-                
-                print(f"  - Product {item.id}: Stock reduced from {current_stock} to {new_stock}")
-                updated_items.append({"product_id": item.id, "new_stock_level": new_stock})
-            
-            trans.commit() # Commit all changes at once
-            print("--- [End Inventory Update] ---")
-            
-        except Exception as e:
-            trans.rollback() # Undo changes if anything failed
-            print(f"  ERROR: Transaction failed, rolling back. {e}")
-            raise HTTPException(status_code=500, detail="Inventory update failed")
-            
-    return {"status": "Inventory updated", "updated_items": updated_items}
\ No newline at end of file
+    try:
+        with engine.begin() as conn: # Commit all changes at once
+            updated_items = stock_levels.reduce_stock(conn, items)
+        stock_levels.after_commit(updated_items)
+        print("--- [End Inventory Update] ---")
+    except Exception as e:
+        print(f"  ERROR: Transaction failed, rolling back. {e}")
+        raise HTTPException(status_code=500, detail="Inventory update failed")
+
+    if item_codec.accepts_binary(request.headers.get("accept")):
+        # (product_id, new_stock_level) pairs
+        levels = ((item["product_id"], item["new_stock_level"]) for item in updated_items)
+        return Response(item_codec.encode(levels), media_type=item_codec.CONTENT_TYPE)
+    return {"status": "Inventory updated", "updated_items": updated_items}
+
+# Endpoint for warehouse syncs to adjust many SKUs at once
+# The body is streamed as CSV or JSON lines (see bulk_adjust.py for the format)
+# and applied chunk by chunk, so a 100k+ line sync never holds one giant transaction.
+@app.post("/api/inventory/bulk-adjust")
+async def bulk_adjust_inventory(request: Request, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    bulk = BulkAdjustment(chunk_size)
+    buffer = b""
+
+    async for data in request.stream():
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if bulk.add_line(line.decode("utf-8", errors="replace")):
+                await run_in_threadpool(bulk.flush)
+
+    if buffer:
+        bulk.add_line(buffer.decode("utf-8", errors="replace"))
+    await run_in_threadpool(bulk.flush)
+
+    print(f"[Inventory Service] Bulk adjustment: {bulk.report['applied']} applied, {bulk.report['failed']} failed.")
+    return bulk.report
+
+
+# --- Reservations (hold stock at checkout start, confirm or release later) ---
+
+# Safe to retry with the same Idempotency-Key (see reservations.py)
+@app.post("/api/inventory/reservations")
+async def create_reservation(payload: ReservationRequest, idempotency_key: Optional[str] = Header(None)):
+    ttl_seconds = payload.ttl_seconds or reservations.DEFAULT_TTL_SECONDS
+    try:
+        return await run_in_threadpool(reservations.reserve, payload.items, ttl_seconds, idempotency_key)
+    except reservations.InsufficientStock as e:
+        raise HTTPException(status_code=409, detail={"message": str(e), "shortages": e.shortages})
+
+@app.post("/api/inventory/reservations/{reservation_id}/confirm")
+async def confirm_reservation(reservation_id: str):
+    updated_items = await run_in_threadpool(reservations.confirm, reservation_id)
+    if updated_items is None:
+        raise HTTPException(status_code=404, detail=f"Reservation {reservation_id} not found or expired")
+    return {"status": "confirmed", "reservation_id": reservation_id, "updated_items": updated_items}
+
+@app.delete("/api/inventory/reservations/{reservation_id}")
+async def release_reservation(reservation_id: str):
+    released = await run_in_threadpool(reservations.release, reservation_id)
+    if not released:
+        raise HTTPException(status_code=404, detail=f"Reservation {reservation_id} not found")
+    return {"status": "released", "reservation_id": reservation_id}
@@ -0,0 +1,282 @@
+"""
+Order/inventory reconciliation.
+
+When create_order's call to /api/inventory/reduce fails, the order is kept but the sale
+never reaches the inventory table, and stock drifts from what order_items says was sold.
+This job finds (and optionally corrects) that drift without loading either table into
+memory:
+
+1. Units sold per SKU since the last run are aggregated from order_items, a range of
+   RECONCILE_ITEM_CHUNK item IDs per GROUP BY query, into reconciliation_sales.
+   The checkpoint is the last order_items.id reconciled.
+2. SKUs are compared RECONCILE_SKU_CHUNK at a time, with one query joining inventory
+   (plus pending ledger deltas), the per-SKU baselines and the sales:
+
+       expected = max(0, baseline - sold since the last run),  drift = actual - expected
+
+3. Every SKU's baseline becomes its expected level, so the next run only checks the
+   sales made after this one. Warehouse syncs (bulk_adjust) shift the baselines by the
+   change they make, so restocks are not drift.
+
+A drift seen by one run only may be an order whose inventory call was still in flight
+when the stock was read; it goes away by the next run. With --correct, a drift that two
+consecutive runs found unchanged is corrected (relative to the current level, so sales
+made meanwhile are kept). Without it, the job only reports.
+
+Runs are checkpointed: a run that stops halfway is resumed by the next invocation,
+skipping the SKUs it already checked. The first run only records the baselines.
+
+order_items is read from the inventory database (all services share it), or from each
+of ORDER_DATABASE_URLS when orders are sharded. Items of failed orders are not sales, and
+a run stops before the first order still in the status pipeline (it may still fail).
+
+Usage:
+    python reconcile.py            # report
+    python reconcile.py --correct  # report and correct persistent drift
+"""
+import argparse
+import json
+import os
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import and_, bindparam, column, create_engine, delete, func, select, table, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+import stock_ledger
+import stock_levels
+from database import (
+    engine, inventory_table, stock_ledger_table, stock_baselines_table, reconciliation_runs_table,
+    reconciliation_sales_table, reconciliation_checkpoints_table,
+)
+
+RECONCILE_ITEM_CHUNK = int(os.getenv("RECONCILE_ITEM_CHUNK", "100000"))
+RECONCILE_SKU_CHUNK = int(os.getenv("RECONCILE_SKU_CHUNK", "5000"))
+ORDER_DATABASE_URLS = [url.strip() for url in os.getenv("ORDER_DATABASE_URLS", "").split(",") if url.strip()]
+# Only the first few drifted SKUs are listed, the counts are what matters at scale
+MAX_REPORTED_DRIFTS = 50
+
+# Read-only views of the orders-api tables (never created here)
+orders = table("orders", column("id"), column("status"))
+order_items = table("order_items", column("id"), column("order_id"), column("product_id"), column("quantity"))
+order_pipeline = table("order_pipeline", column("order_id"))
+
+_dialect_inserts = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+def order_sources() -> List[Tuple[str, Any]]:
+    """(checkpoint name, engine) of every database holding order_items."""
+    if not ORDER_DATABASE_URLS:
+        return [("orders", engine)]
+    return [(f"orders{i}", create_engine(url)) for i, url in enumerate(ORDER_DATABASE_URLS)]
+
+
+def _upsert(conn, target, key_columns: List[str], rows: List[Dict[str, Any]], set_: Dict[str, Any]):
+    """INSERT ... ON CONFLICT DO UPDATE; set_ maps a column to f(excluded) -> value."""
+    dialect_insert = _dialect_inserts.get(conn.dialect.name)
+    if dialect_insert is None:
+        for row in rows:
+            key = [target.c[name] == row[name] for name in key_columns]
+            values = {name: value(row) for name, value in set_.items()}
+            if not conn.execute(update(target).where(*key).values(**values)).rowcount:
+                conn.execute(target.insert().values(**row))
+        return
+    statement = dialect_insert(target).values(rows)
+    conn.execute(statement.on_conflict_do_update(
+        index_elements=key_columns,
+        set_={name: value(statement.excluded) for name, value in set_.items()},
+    ))
+
+
+# --- Phase 1: sales since the checkpoint ---
+
+def _start_run(sources, checkpoints: Dict[str, int]) -> Dict[str, Any]:
+    """Resumes the unfinished run, or starts one up to the current last order item."""
+    runs = reconciliation_runs_table.c
+    with engine.begin() as conn:
+        unfinished = conn.execute(
+            select(reconciliation_runs_table).where(runs.status != "done").order_by(runs.started_at)
+        ).first()
+        if unfinished is not None:
+            return dict(unfinished._mapping)
+
+    high_water = {}
+    for name, source in sources:
+        with source.connect() as conn:
+            last_item = conn.execute(select(func.max(order_items.c.id))).scalar() or 0
+            # Stop before the first order still in the status pipeline: it may fail yet
+            first_in_flight = conn.execute(
+                select(func.min(order_items.c.id)).where(order_items.c.order_id.in_(select(order_pipeline.c.order_id)))
+            ).scalar()
+        if first_in_flight is not None:
+            last_item = min(last_item, first_in_flight - 1)
+        high_water[name] = max(last_item, checkpoints.get(name, 0))
+    run = {"id": uuid.uuid4().hex, "status": "loading", "high_water": json.dumps(high_water), "started_at": time.time()}
+    with engine.begin() as conn:
+        conn.execute(reconciliation_runs_table.insert().values(**run))
+    return run
+
+
+def _load_sales(run: Dict[str, Any], sources, checkpoints: Dict[str, int]):
+    sales = reconciliation_sales_table.c
+    high_water = json.loads(run["high_water"])
+    with engine.begin() as conn:
+        # A resumed load starts over, the sums aren't idempotent
+        conn.execute(delete(reconciliation_sales_table).where(sales.run_id == run["id"]))
+
+    for name, source in sources:
+        start, end = checkpoints.get(name, 0), high_water[name]
+        # Failed orders (the pipeline released their stock) aren't sales
+        while start < end:
+            stop = min(start + RECONCILE_ITEM_CHUNK, end)
+            with source.connect() as conn:
+                sold = conn.execute(
+                    select(order_items.c.product_id, func.sum(order_items.c.quantity))
+                    .select_from(order_items.join(orders, orders.c.id == order_items.c.order_id))
+                    .where(order_items.c.id > start, order_items.c.id <= stop, orders.c.status != "failed")
+                    .group_by(order_items.c.product_id)
+                ).all()
+            if sold:
+                with engine.begin() as conn:
+                    _upsert(conn, reconciliation_sales_table, ["run_id", "product_id"],
+                            [{"run_id": run["id"], "product_id": product_id, "sold": units} for product_id, units in sold],
+                            {"sold": lambda new: reconciliation_sales_table.c.sold + new.sold})
+            start = stop
+
+    with engine.begin() as conn:
+        conn.execute(update(reconciliation_runs_table).where(reconciliation_runs_table.c.id == run["id"]).values(status="comparing"))
+
+
+# --- Phase 2: compare, chunk by chunk ---
+
+def _compare_query(run_id: str, after: str, chunk_size: int):
+    inventory, baselines, sales = inventory_table.c, stock_baselines_table.c, reconciliation_sales_table.c
+    actual = inventory.stock_level
+    if stock_ledger.LEDGER_MODE:
+        pending = (
+            select(func.coalesce(func.sum(stock_ledger_table.c.delta), 0))
+            .where(stock_ledger_table.c.product_id == inventory.product_id, stock_ledger_table.c.compacted == False)  # noqa: E712
+            .scalar_subquery()
+        )
+        actual = actual + pending
+    return (
+        select(
+            inventory.product_id, actual.label("actual"), baselines.baseline, baselines.last_drift,
+            baselines.run_id, func.coalesce(sales.sold, 0).label("sold"),
+        )
+        .select_from(
+            inventory_table
+            .outerjoin(stock_baselines_table, baselines.product_id == inventory.product_id)
+            .outerjoin(reconciliation_sales_table, and_(sales.product_id == inventory.product_id, sales.run_id == run_id))
+        )
+        .where(inventory.product_id > after)
+        .order_by(inventory.product_id)
+        .limit(chunk_size)
+    )
+
+
+def _apply_corrections(conn, corrections: Dict[str, int]):
+    """Takes each drift off the current level (sales made since the read are kept)."""
+    if stock_ledger.LEDGER_MODE:
+        stock_ledger.record_movements(conn, [(product_id, -drift, "reconciliation") for product_id, drift in corrections.items()])
+        return
+    for product_id, drift in corrections.items():
+        new_level = inventory_table.c.stock_level - drift
+        conn.execute(
+            update(inventory_table)
+            .where(inventory_table.c.product_id == product_id)
+            .values(stock_level=func.max(new_level, 0) if conn.dialect.name == "sqlite" else func.greatest(new_level, 0))
+        )
+
+
+def _compare_chunk(run: Dict[str, Any], after: str, correct: bool, first_run: bool, report: Dict[str, Any]) -> Optional[str]:
+    """Checks one chunk of SKUs in one transaction. Returns the last SKU, or None at the end."""
+    with engine.begin() as conn:
+        rows = conn.execute(_compare_query(run["id"], after, RECONCILE_SKU_CHUNK)).all()
+        if not rows:
+            return None
+
+        baselines, corrections = [], {}
+        for row in rows:
+            if row.run_id == run["id"]:
+                continue  # Already checked before this run was interrupted
+            report["skus_checked"] += 1
+            if row.baseline is None or first_run:
+                baselines.append({"product_id": row.product_id, "baseline": row.actual, "last_drift": 0, "run_id": run["id"]})
+                continue
+
+            expected = max(0, row.baseline - row.sold)
+            drift = row.actual - expected
+            last_drift = drift
+            if drift:
+                report["drifted"] += 1
+                report["total_abs_drift"] += abs(drift)
+                if len(report["drift"]) < MAX_REPORTED_DRIFTS:
+                    report["drift"].append({"product_id": row.product_id, "expected": expected, "actual": row.actual, "drift": drift})
+                if correct and drift == row.last_drift:
+                    corrections[row.product_id] = drift
+                    last_drift = 0
+            baselines.append({"product_id": row.product_id, "baseline": expected, "last_drift": last_drift, "run_id": run["id"]})
+
+        if baselines:
+            _upsert(conn, stock_baselines_table, ["product_id"], baselines, {
+                "baseline": lambda new: new.baseline, "last_drift": lambda new: new.last_drift, "run_id": lambda new: new.run_id,
+            })
+        if corrections:
+            _apply_corrections(conn, corrections)
+            stock_levels.publish_changes(conn, list(corrections))
+            levels = stock_levels.current_stock(conn, list(corrections))
+            report["corrected"] += len(corrections)
+
+    if corrections:
+        stock_levels.after_commit([{"product_id": product_id, "new_stock_level": level} for product_id, level in levels.items()])
+    return rows[-1].product_id
+
+
+def run(correct: bool = False) -> Dict[str, Any]:
+    """Runs (or resumes) one reconciliation. Returns the report."""
+    sources = order_sources()
+    with engine.connect() as conn:
+        checkpoints = {row.source: row.last_item_id for row in conn.execute(select(reconciliation_checkpoints_table))}
+    first_run = not checkpoints
+
+    current = _start_run(sources, checkpoints)
+    if current["status"] == "loading":
+        _load_sales(current, sources, checkpoints)
+
+    report = {"run_id": current["id"], "first_run": first_run, "skus_checked": 0, "drifted": 0,
+              "corrected": 0, "total_abs_drift": 0, "drift": []}
+    after = ""
+    while after is not None:
+        after = _compare_chunk(current, after, correct, first_run, report)
+
+    with engine.begin() as conn:
+        _upsert(conn, reconciliation_checkpoints_table, ["source"],
+                [{"source": name, "last_item_id": item_id} for name, item_id in json.loads(current["high_water"]).items()],
+                {"last_item_id": lambda new: new.last_item_id})
+        conn.execute(delete(reconciliation_sales_table).where(reconciliation_sales_table.c.run_id == current["id"]))
+        conn.execute(
+            update(reconciliation_runs_table).where(reconciliation_runs_table.c.id == current["id"])
+            .values(status="done", finished_at=time.time())
+        )
+    return report
+
+
+def shift_baselines(conn, deltas: Dict[str, int]):
+    """Moves baselines by stock changes that aren't sales (warehouse syncs), in one executemany."""
+    baselines = stock_baselines_table.c
+    changes = [{"sku": product_id, "delta": delta} for product_id, delta in deltas.items() if delta]
+    if changes:
+        conn.execute(
+            update(stock_baselines_table).where(baselines.product_id == bindparam("sku"))
+            .values(baseline=baselines.baseline + bindparam("delta")),
+            changes,
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--correct", action="store_true", help="correct drift seen unchanged by two consecutive runs")
+    args = parser.parse_args()
+    print(json.dumps(run(correct=args.correct), indent=2))
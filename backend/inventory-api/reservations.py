@@ -0,0 +1,210 @@
+"""
+Stock reservations with a TTL.
+
+Checkout reserves its cart up front, then either confirms (the held quantities become
+a sale) or releases the hold. Holds that are neither confirmed nor released expire:
+
+    available = stock level - SUM(quantity of holds with expires_at > now)
+
+Expired holds stop counting immediately; sweep_expired() only deletes the rows.
+Reserving locks the cart's 'inventory' rows for the length of one short transaction,
+never for the whole checkout.
+
+Both calls are safe to retry. A reserve with an idempotency key (the Idempotency-Key
+header, orders-api sends the order ID) gets the reservation ID RSV-<key>, and a retry
+returns the hold already made instead of holding the stock twice. A confirmed
+reservation is recorded in confirmed_reservations, so a retried confirm succeeds
+without selling twice.
+"""
+import os
+import time
+import uuid
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import bindparam, delete, func, select
+
+import stock_levels
+from database import engine, confirmed_reservations_table, inventory_table, stock_reservations_table
+
+DEFAULT_TTL_SECONDS = int(os.getenv("RESERVATION_TTL_SECONDS", "900"))
+MAX_TTL_SECONDS = 24 * 3600
+SWEEP_INTERVAL_SECONDS = float(os.getenv("RESERVATION_SWEEP_INTERVAL_SECONDS", "30"))
+SWEEP_BATCH_SIZE = int(os.getenv("RESERVATION_SWEEP_BATCH_SIZE", "1000"))
+
+
+class InsufficientStock(Exception):
+    """Raised when a reservation can't be covered. shortages lists the failing items."""
+
+    def __init__(self, shortages: List[dict]):
+        super().__init__(f"Insufficient stock for {len(shortages)} item(s)")
+        self.shortages = shortages
+
+
+# Hot-path statements, built once (see query_cache.py)
+_held = stock_reservations_table.c
+select_reserved = (
+    select(_held.product_id, func.sum(_held.quantity))
+    .where(_held.product_id.in_(bindparam("skus", expanding=True)), _held.expires_at > bindparam("now"))
+    .group_by(_held.product_id)
+)
+# Locks the cart's rows in a fixed order, so two checkouts can't deadlock
+lock_stock_rows = (
+    select(inventory_table.c.product_id)
+    .where(inventory_table.c.product_id.in_(bindparam("skus", expanding=True)))
+    .order_by(inventory_table.c.product_id)
+    .with_for_update()
+)
+insert_holds = stock_reservations_table.insert()
+# DELETE ... RETURNING makes confirm exactly-once under concurrent retries
+take_unexpired_holds = (
+    delete(stock_reservations_table)
+    .where(_held.reservation_id == bindparam("hold_id"), _held.expires_at > bindparam("now"))
+    .returning(_held.product_id, _held.quantity)
+)
+delete_holds = delete(stock_reservations_table).where(_held.reservation_id == bindparam("hold_id"))
+select_unexpired_holds = (
+    select(_held.product_id, _held.quantity, _held.expires_at)
+    .where(_held.reservation_id == bindparam("hold_id"), _held.expires_at > bindparam("now"))
+)
+_confirmed = confirmed_reservations_table.c
+select_confirmed = select(_confirmed.reservation_id).where(_confirmed.reservation_id == bindparam("hold_id"))
+insert_confirmed = confirmed_reservations_table.insert()
+
+
+def reserved_quantities(conn, product_ids: Iterable[str], now: Optional[float] = None) -> Dict[str, int]:
+    """Returns {product_id: quantity held by unexpired reservations}."""
+    now = time.time() if now is None else now
+    return {row[0]: row[1] for row in conn.execute(select_reserved, {"skus": list(product_ids), "now": now})}
+
+
+def availability(conn, product_ids: Iterable[str]) -> List[dict]:
+    """Stock, reserved and available (stock minus reserved) for each known product."""
+    product_ids = list(dict.fromkeys(product_ids))
+    stock = stock_levels.current_stock(conn, product_ids)
+    reserved = reserved_quantities(conn, stock.keys())
+    return [
+        {
+            "product_id": product_id,
+            "stock_level": stock[product_id],
+            "reserved": reserved.get(product_id, 0),
+            "available": max(0, stock[product_id] - reserved.get(product_id, 0)),
+        }
+        for product_id in product_ids
+        if product_id in stock
+    ]
+
+
+def reserve(items, ttl_seconds: int = DEFAULT_TTL_SECONDS, idempotency_key: Optional[str] = None) -> dict:
+    """
+    Holds the given items (anything with .id and .quantity) if ALL of them are available.
+    Raises InsufficientStock otherwise, without holding anything, and ValueError for a
+    quantity below 1. With an idempotency_key, an unexpired or confirmed reservation
+    made with the same key is returned as it is.
+    """
+    quantities: Dict[str, int] = {}
+    for item in items:
+        if item.quantity <= 0:
+            raise ValueError(f"Quantity for {item.id} must be positive, got {item.quantity}")
+        quantities[item.id] = quantities.get(item.id, 0) + item.quantity
+
+    ttl_seconds = max(1, min(ttl_seconds, MAX_TTL_SECONDS))
+    now = time.time()
+    reservation_id = f"RSV-{idempotency_key}" if idempotency_key else f"RSV-{uuid.uuid4().hex}"
+    expires_at = now + ttl_seconds
+
+    with engine.begin() as conn:
+        # Lock the cart's rows so concurrent reservations of the same SKU see each other's holds
+        # (and a concurrent retry with the same key sees the hold of the first call)
+        conn.execute(lock_stock_rows, {"skus": list(quantities)}).fetchall()
+
+        if idempotency_key:
+            held = conn.execute(select_unexpired_holds, {"hold_id": reservation_id, "now": now}).fetchall()
+            if held:
+                return {
+                    "reservation_id": reservation_id,
+                    "expires_at": held[0].expires_at,
+                    "items": [{"product_id": row.product_id, "quantity": row.quantity} for row in held],
+                }
+            if conn.execute(select_confirmed, {"hold_id": reservation_id}).first() is not None:
+                # Already sold: nothing is held any more
+                return {"reservation_id": reservation_id, "expires_at": None, "items": []}
+
+        stock = stock_levels.current_stock(conn, quantities)
+        reserved = reserved_quantities(conn, quantities, now)
+        shortages = []
+        for product_id, quantity in quantities.items():
+            if product_id not in stock:
+                shortages.append({"product_id": product_id, "requested": quantity, "available": 0, "error": "not found"})
+                continue
+            available = stock[product_id] - reserved.get(product_id, 0)
+            if available < quantity:
+                shortages.append({"product_id": product_id, "requested": quantity, "available": max(0, available)})
+        if shortages:
+            raise InsufficientStock(shortages)
+
+        conn.execute(
+            insert_holds,
+            [
+                {"reservation_id": reservation_id, "product_id": product_id, "quantity": quantity, "expires_at": expires_at}
+                for product_id, quantity in quantities.items()
+            ],
+        )
+
+    return {
+        "reservation_id": reservation_id,
+        "expires_at": expires_at,
+        "items": [{"product_id": product_id, "quantity": quantity} for product_id, quantity in quantities.items()],
+    }
+
+
+class _HeldItem:
+    # Same shape as ItemPurchased, so confirm() can reuse the sale write path
+    __slots__ = ("id", "quantity")
+
+    def __init__(self, product_id: str, quantity: int):
+        self.id = product_id
+        self.quantity = quantity
+
+
+def confirm(reservation_id: str) -> Optional[List[dict]]:
+    """
+    Turns an unexpired hold into a sale, in one transaction.
+    Returns the updated items ([] if it was already confirmed), or None if the reservation
+    doesn't exist (or expired).
+    """
+    now = time.time()
+    with engine.begin() as conn:
+        rows = conn.execute(take_unexpired_holds, {"hold_id": reservation_id, "now": now}).fetchall()
+        if not rows:
+            # A concurrent confirm of the same holds has committed by the time the DELETE returns
+            confirmed = conn.execute(select_confirmed, {"hold_id": reservation_id}).first() is not None
+            return [] if confirmed else None
+        updated_items = stock_levels.reduce_stock(conn, [_HeldItem(row[0], row[1]) for row in rows])
+        conn.execute(insert_confirmed, {"reservation_id": reservation_id, "confirmed_at": now})
+    stock_levels.after_commit(updated_items)
+    return updated_items
+
+
+def release(reservation_id: str) -> int:
+    """Drops a hold. Returns the number of released item rows (0 if unknown)."""
+    with engine.begin() as conn:
+        return conn.execute(delete_holds, {"hold_id": reservation_id}).rowcount
+
+
+def sweep_expired(now: Optional[float] = None, batch_size: int = SWEEP_BATCH_SIZE) -> int:
+    """
+    Deletes expired holds in batches of batch_size, one short transaction each (and the
+    confirmations older than the longest hold). Returns the number of holds deleted.
+    """
+    now = time.time() if now is None else now
+    held = stock_reservations_table.c
+    with engine.begin() as conn:
+        conn.execute(delete(confirmed_reservations_table).where(_confirmed.confirmed_at <= now - MAX_TTL_SECONDS))
+    swept = 0
+    while True:
+        with engine.begin() as conn:
+            batch = select(held.id).where(held.expires_at <= now).limit(batch_size)
+            count = conn.execute(delete(stock_reservations_table).where(held.id.in_(batch))).rowcount
+        swept += count
+        if count < batch_size:
+            return swept
@@ -0,0 +1,154 @@
+"""
+Append-only stock ledger.
+
+In ledger mode (INVENTORY_WRITE_MODE=ledger) sales and adjustments never UPDATE the
+'inventory' row. They INSERT a movement into 'stock_ledger', so concurrent sales of
+one hot SKU don't queue on the same row lock, and every movement is kept as an audit trail.
+
+    available stock = inventory.stock_level (snapshot) + SUM(pending ledger deltas)
+
+compact() periodically folds the pending deltas into the snapshot and flags them as
+compacted (the rows themselves are kept, see LEDGER_RETENTION_DAYS).
+"""
+import os
+import time
+from typing import Dict, Iterable, List, Tuple
+
+from sqlalchemy import and_, bindparam, case, delete, func, select, update
+
+from database import engine, inventory_table, stock_ledger_table
+
+LEDGER_MODE = os.getenv("INVENTORY_WRITE_MODE", "update").lower() == "ledger"
+COMPACT_INTERVAL_SECONDS = float(os.getenv("LEDGER_COMPACT_INTERVAL_SECONDS", "30"))
+# 0 keeps compacted ledger rows forever
+LEDGER_RETENTION_DAYS = float(os.getenv("LEDGER_RETENTION_DAYS", "0"))
+RETENTION_DELETE_BATCH = 10000
+
+
+# Hot-path statements, built once (see query_cache.py)
+_ledger = stock_ledger_table.c
+select_available_stock = (
+    select(
+        inventory_table.c.product_id,
+        inventory_table.c.stock_level + func.coalesce(func.sum(_ledger.delta), 0),
+    )
+    .select_from(
+        inventory_table.outerjoin(
+            stock_ledger_table,
+            and_(_ledger.product_id == inventory_table.c.product_id, _ledger.compacted == False),  # noqa: E712
+        )
+    )
+    .where(inventory_table.c.product_id.in_(bindparam("skus", expanding=True)))
+    .group_by(inventory_table.c.product_id, inventory_table.c.stock_level)
+)
+insert_movements = stock_ledger_table.insert()
+
+
+def available_stock(conn, product_ids: Iterable[str]) -> Dict[str, int]:
+    """
+    Returns {product_id: available stock} for the given products in one query.
+    Products missing from 'inventory' are missing from the result.
+    """
+    product_ids = list(set(product_ids))
+    if not product_ids:
+        return {}
+
+    return {row[0]: max(0, row[1]) for row in conn.execute(select_available_stock, {"skus": product_ids})}
+
+
+def record_movements(conn, movements: List[Tuple[str, int, str]]):
+    """Appends (product_id, delta, reason) movements to the ledger. Zero deltas are skipped."""
+    now = time.time()
+    rows = [
+        {"product_id": product_id, "delta": delta, "reason": reason, "created_at": now, "compacted": False}
+        for product_id, delta, reason in movements
+        if delta != 0
+    ]
+    if rows:
+        conn.execute(insert_movements, rows)
+
+
+def reduce_stock(conn, items) -> List[dict]:
+    """
+    Ledger version of reduce_inventory: one read of the available stock for the whole
+    cart, then one multi-row INSERT. Stock never goes below 0 (same as the in-place path).
+    Without the row lock, concurrent sales can read the same available stock, so the
+    last units of a hot SKU may be oversold; the view and compaction clamp at 0.
+    """
+    # Fold repeated lines first so the "never below 0" clamp sees the whole cart
+    quantities: Dict[str, int] = {}
+    for item in items:
+        quantities[item.id] = quantities.get(item.id, 0) + item.quantity
+
+    available = available_stock(conn, quantities.keys())
+    updated_items, movements = [], []
+    for product_id, quantity in quantities.items():
+        current_stock = available.get(product_id)
+        if current_stock is None:
+            print(f"  ERROR: Product {product_id} not found in inventory.")
+            continue
+        if current_stock < quantity:
+            print(f"  ERROR: Stock for {product_id} is {current_stock}, but {quantity} were sold! Setting stock to 0.")
+        new_stock = max(0, current_stock - quantity)
+        movements.append((product_id, new_stock - current_stock, "sale"))
+        updated_items.append({"product_id": product_id, "new_stock_level": new_stock})
+
+    record_movements(conn, movements)
+    return updated_items
+
+
+def compact() -> int:
+    """
+    Folds all pending ledger deltas into the inventory snapshot.
+    Returns the number of ledger rows compacted.
+    """
+    ledger = stock_ledger_table.c
+    conn = engine.connect()
+    if engine.dialect.name == "postgresql":
+        # Both statements must see the same set of pending rows, otherwise a sale
+        # committed in between would be flagged as compacted without being folded.
+        conn = conn.execution_options(isolation_level="REPEATABLE READ")
+
+    with conn:
+        with conn.begin():
+            max_id = conn.execute(select(func.max(ledger.id)).where(ledger.compacted == False)).scalar()  # noqa: E712
+            if max_id is None:
+                return 0
+
+            pending_filter = and_(ledger.compacted == False, ledger.id <= max_id)  # noqa: E712
+            pending = (
+                select(ledger.product_id, func.sum(ledger.delta).label("delta"))
+                .where(pending_filter)
+                .group_by(ledger.product_id)
+                .subquery()
+            )
+            new_level = inventory_table.c.stock_level + pending.c.delta
+            conn.execute(
+                update(inventory_table)
+                .values(stock_level=case((new_level < 0, 0), else_=new_level))
+                .where(inventory_table.c.product_id == pending.c.product_id)
+            )
+            compacted = conn.execute(
+                update(stock_ledger_table).where(pending_filter).values(compacted=True)
+            ).rowcount
+
+    if LEDGER_RETENTION_DAYS > 0:
+        prune(time.time() - LEDGER_RETENTION_DAYS * 86400)
+    return compacted
+
+
+def prune(older_than: float) -> int:
+    """Deletes compacted ledger rows older than the given timestamp, in batches."""
+    ledger = stock_ledger_table.c
+    deleted = 0
+    while True:
+        with engine.begin() as conn:
+            batch = (
+                select(ledger.id)
+                .where(ledger.compacted == True, ledger.created_at < older_than)  # noqa: E712
+                .limit(RETENTION_DELETE_BATCH)
+            )
+            count = conn.execute(delete(stock_ledger_table).where(ledger.id.in_(batch))).rowcount
+        deleted += count
+        if count < RETENTION_DELETE_BATCH:
+            return deleted
@@ -0,0 +1,164 @@
+"""
+Stock reads and sales for both write modes.
+
+The default mode updates the 'inventory' row in place. With INVENTORY_WRITE_MODE=ledger
+the same calls go through the append-only ledger (see stock_ledger.py).
+Both functions take an open connection, so callers control the transaction.
+
+Stock lookups for GET /api/inventory/{product_id} are cached (in-process and in the
+shared cache tier). Every write path calls publish_changes() inside its transaction,
+so the other replicas evict their copies (see cache_invalidation.py), and after_commit()
+once committed, which drops the shared copies and pushes the new levels to live streams
+(see stock_stream.py).
+
+A cache miss that read the database before a write's invalidation ran must not store the
+old level after it. Every invalidation this replica sees bumps the SKU's generation, and
+load_level() only keeps what it cached if the generation didn't move during its read. An
+invalidation from another replica is only seen once its notification arrives, so the
+shared tier keeps a short TTL (STOCK_CACHE_TTL_SECONDS) to bound that window.
+"""
+import itertools
+import os
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import bindparam, select, update
+
+import cache_invalidation
+import stock_ledger
+import stock_stream
+from database import engine, inventory_table
+from id_filter import KnownIdFilter
+from shared_cache import SharedCache
+
+STOCK_CACHE_TTL_SECONDS = float(os.getenv("STOCK_CACHE_TTL_SECONDS", "2"))
+STOCK_CHANNEL = "inventory_changed"
+stock_cache = SharedCache("inventory")
+
+# Generation of each SKU's cached level, moved by every invalidation (next() is atomic)
+_generation_counter = itertools.count(1)
+_generations: Dict[str, int] = {}
+
+
+def _bump(product_ids: Iterable[str]):
+    for product_id in product_ids:
+        _generations[product_id] = next(_generation_counter)
+
+
+def invalidate(product_ids: Iterable[str]):
+    """Drops cached stock levels after a committed write."""
+    product_ids = set(product_ids)
+    _bump(product_ids)
+    stock_cache.delete_many(product_ids)
+
+
+def after_commit(updated_items: List[dict]):
+    """Runs once a write committed: invalidates the caches and notifies live streams."""
+    invalidate(item["product_id"] for item in updated_items)
+    stock_stream.broadcaster.publish({item["product_id"]: item["new_stock_level"] for item in updated_items})
+
+
+def _changed_elsewhere(product_ids: List[str]):
+    # Called by the listener for writes on any replica (this one included)
+    _bump(product_ids)
+    stock_cache.evict_local(product_ids)
+    stock_stream.broadcaster.refresh(product_ids, _load_levels)
+
+
+def _load_levels(product_ids: List[str]) -> Dict[str, int]:
+    with engine.connect() as conn:
+        return current_stock(conn, product_ids)
+
+
+def load_level(product_id: str) -> Optional[int]:
+    """Cache miss path of GET /api/inventory/{product_id}: reads and caches one level."""
+    generation = _generations.get(product_id)
+    stock_level = _load_levels([product_id]).get(product_id)
+    if stock_level is not None and _generations.get(product_id) == generation:
+        stock_cache.set(product_id, stock_level, STOCK_CACHE_TTL_SECONDS)
+        # An invalidation that ran between the check and the set: take the fill back
+        if _generations.get(product_id) != generation:
+            stock_cache.delete_many([product_id])
+    return stock_level
+
+
+def publish_changes(conn, product_ids: Iterable[str]):
+    """Tells every replica (on commit) that these stock levels changed."""
+    cache_invalidation.publish(conn, STOCK_CHANNEL, product_ids)
+
+
+def _load_product_ids() -> List[str]:
+    with engine.connect() as conn:
+        return [row[0] for row in conn.execute(select(inventory_table.c.product_id))]
+
+
+# Unknown SKUs are answered with a 404 without touching the database (see id_filter.py)
+known_products = KnownIdFilter("inventory", _load_product_ids)
+
+
+def _resync():
+    stock_cache.clear_local()
+    if known_products.ready:
+        known_products.build()
+
+
+# Each replica evicts its in-process copies when another replica writes
+stock_listener = cache_invalidation.InvalidationListener(STOCK_CHANNEL, on_keys=_changed_elsewhere, on_resync=_resync)
+
+
+# Hot-path statements, built once (see query_cache.py)
+select_stock_level = select(inventory_table.c.stock_level).where(inventory_table.c.product_id == bindparam("sku"))
+set_stock_level = (
+    update(inventory_table).where(inventory_table.c.product_id == bindparam("sku")).values(stock_level=bindparam("new_level"))
+)
+select_stock_levels = select(inventory_table.c.product_id, inventory_table.c.stock_level).where(
+    inventory_table.c.product_id.in_(bindparam("skus", expanding=True))
+)
+
+
+def current_stock(conn, product_ids: Iterable[str]) -> Dict[str, int]:
+    """Returns {product_id: stock level}; unknown products are left out."""
+    if stock_ledger.LEDGER_MODE:
+        # Snapshot plus the deltas that haven't been compacted yet
+        return stock_ledger.available_stock(conn, product_ids)
+
+    return {row[0]: row[1] for row in conn.execute(select_stock_levels, {"skus": list(product_ids)})}
+
+
+def reduce_stock(conn, items) -> List[dict]:
+    """Applies a sale of the given items (anything with .id and .quantity)."""
+    if stock_ledger.LEDGER_MODE:
+        # Append-only: one INSERT per movement, no UPDATE of the hot 'inventory' row
+        updated_items = stock_ledger.reduce_stock(conn, items)
+    else:
+        updated_items = reduce_stock_in_place(conn, items)
+    publish_changes(conn, [item["product_id"] for item in updated_items])
+    return updated_items
+
+
+def reduce_stock_in_place(conn, items) -> List[dict]:
+    """Default write path: read and UPDATE each 'inventory' row."""
+    updated_items = []
+
+    for item in items:
+        # Get current stock
+        current_stock = conn.execute(select_stock_level, {"sku": item.id}).scalar()
+
+        if current_stock is None:
+            print(f"  ERROR: Product {item.id} not found in inventory.")
+            continue # Skip this item
+
+        if current_stock < item.quantity:
+            # This is a problem! We sold something we don't have.
+            # In a real system, this would trigger a compensation (e.g., refund)
+            print(f"  ERROR: Stock for {item.id} is {current_stock}, but {item.quantity} were sold! Setting stock to 0.")
+            new_stock = 0
+        else:
+            new_stock = current_stock - item.quantity
+
+        # Update the database
+        conn.execute(set_stock_level, {"sku": item.id, "new_level": new_stock})
+
+        print(f"  - Product {item.id}: Stock reduced from {current_stock} to {new_stock}")
+        updated_items.append({"product_id": item.id, "new_stock_level": new_stock})
+
+    return updated_items
@@ -0,0 +1,166 @@
+"""
+Live stock updates for GET /api/inventory/stream (Server-Sent Events).
+
+Every committed stock change is published to the StockBroadcaster, which fans it out to
+the subscribers watching that SKU. Changes made on other replicas arrive through the
+cache invalidation listener (see stock_levels.py), which reloads the watched SKUs.
+
+A subscriber never has a queue, only a {product_id: latest level} dict:
+
+- rapid updates to the same SKU coalesce into one event (the latest level wins), and a
+  stream waits STREAM_COALESCE_SECONDS after waking before it sends, to collect them;
+- a slow client can't hold memory or slow anyone else down: at most one pending level
+  per watched SKU, and publishing never waits on a client;
+- a level equal to the last one queued for that subscriber is dropped, so a change heard
+  twice (local write, then the invalidation listener) is sent once. This is per
+  subscriber: a newer snapshot read by one stream never hides a change from the others.
+
+Idle streams cost one asyncio.Event each and send a comment line every
+STREAM_HEARTBEAT_SECONDS so proxies keep the connection open.
+"""
+import asyncio
+import json
+import os
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+from fastapi.responses import StreamingResponse
+
+STREAM_MAX_IDS = int(os.getenv("STREAM_MAX_IDS", "100"))
+STREAM_MAX_CLIENTS = int(os.getenv("STREAM_MAX_CLIENTS", "10000"))
+STREAM_COALESCE_SECONDS = float(os.getenv("STREAM_COALESCE_SECONDS", "0.25"))
+STREAM_HEARTBEAT_SECONDS = float(os.getenv("STREAM_HEARTBEAT_SECONDS", "15"))
+
+
+class Subscriber:
+    __slots__ = ("product_ids", "pending", "sent", "event", "closed")
+
+    def __init__(self, product_ids: List[str]):
+        self.product_ids = product_ids
+        self.pending: Dict[str, int] = {}
+        # Last level queued per SKU (pending or already sent)
+        self.sent: Dict[str, int] = {}
+        self.event = asyncio.Event()
+        self.closed = False
+
+    def push(self, levels: Dict[str, int]) -> int:
+        """Queues the levels that differ from the last ones queued; returns how many."""
+        changed = {product_id: level for product_id, level in levels.items() if self.sent.get(product_id) != level}
+        if changed:
+            self.sent.update(changed)
+            self.pending.update(changed)
+            self.event.set()
+        return len(changed)
+
+    def drain(self) -> Dict[str, int]:
+        pending, self.pending = self.pending, {}
+        self.event.clear()
+        return pending
+
+
+class StockBroadcaster:
+    """Fans stock levels out to subscribers. Subscriptions live on one event loop."""
+
+    def __init__(self):
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.subscribers: Dict[str, Set[Subscriber]] = {}
+        self.client_count = 0
+        self.stats = {"published": 0, "delivered": 0}
+
+    def subscribe(self, product_ids: Iterable[str], snapshot: Dict[str, int]) -> Subscriber:
+        """Registers a stream (must run on the event loop) and queues the current levels."""
+        self.loop = asyncio.get_running_loop()
+        subscriber = Subscriber(list(product_ids))
+        for product_id in subscriber.product_ids:
+            self.subscribers.setdefault(product_id, set()).add(subscriber)
+        self.client_count += 1
+        subscriber.push(snapshot)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        """Releases a stream; safe to call more than once."""
+        if subscriber.closed:
+            return
+        subscriber.closed = True
+        for product_id in subscriber.product_ids:
+            watchers = self.subscribers.get(product_id)
+            if watchers is None:
+                continue
+            watchers.discard(subscriber)
+            if not watchers:
+                del self.subscribers[product_id]
+        self.client_count -= 1
+
+    def watched(self, product_ids: Iterable[str]) -> List[str]:
+        return [product_id for product_id in product_ids if product_id in self.subscribers]
+
+    def publish(self, levels: Dict[str, int]):
+        """Publishes committed stock levels. Safe to call from any thread."""
+        if not self.subscribers or self.loop is None:
+            return
+        try:
+            on_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            self._dispatch(levels)
+        elif not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._dispatch, dict(levels))
+
+    def refresh(self, product_ids: Iterable[str], load: Callable[[List[str]], Dict[str, int]]):
+        """Reloads and publishes watched SKUs (changed on another replica)."""
+        watched = self.watched(product_ids)
+        if watched:
+            self.publish(load(watched))
+
+    def _dispatch(self, levels: Dict[str, int]):
+        for product_id, level in levels.items():
+            delivered = sum(subscriber.push({product_id: level}) for subscriber in self.subscribers.get(product_id, ()))
+            if delivered:
+                self.stats["published"] += 1
+                self.stats["delivered"] += delivered
+
+
+broadcaster = StockBroadcaster()
+
+
+def format_event(product_id: str, stock_level: int) -> str:
+    data = json.dumps({"product_id": product_id, "stock_level": stock_level})
+    return f"event: stock\ndata: {data}\n\n"
+
+
+async def events(subscriber: Subscriber, stream_broadcaster: StockBroadcaster,
+                 coalesce_seconds: float = STREAM_COALESCE_SECONDS,
+                 heartbeat_seconds: float = STREAM_HEARTBEAT_SECONDS):
+    """SSE body for one subscriber; unsubscribes when the client goes away."""
+    try:
+        yield f"retry: {int(heartbeat_seconds * 1000)}\n\n"
+        while True:
+            try:
+                await asyncio.wait_for(subscriber.event.wait(), heartbeat_seconds)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            if coalesce_seconds:
+                await asyncio.sleep(coalesce_seconds)
+            # One chunk per wake-up, however many SKUs changed
+            yield "".join(format_event(product_id, level) for product_id, level in subscriber.drain().items())
+    finally:
+        stream_broadcaster.unsubscribe(subscriber)
+
+
+class StockStreamResponse(StreamingResponse):
+    """
+    SSE response for one subscriber. The subscription is released when the response ends,
+    also when the body never started (the generator's own cleanup only runs once it has).
+    """
+
+    def __init__(self, subscriber: Subscriber, stream_broadcaster: StockBroadcaster, **kwargs):
+        super().__init__(events(subscriber, stream_broadcaster), media_type="text/event-stream", **kwargs)
+        self.subscriber = subscriber
+        self.stream_broadcaster = stream_broadcaster
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.stream_broadcaster.unsubscribe(self.subscriber)
@@ -1,10 +1,27 @@
+import asyncio
+import json
 import pytest
+import time
 from fastapi.testclient import TestClient
 from unittest.mock import Mock, patch, MagicMock
-from sqlalchemy import create_engine, MetaData
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String
 from sqlalchemy.pool import StaticPool
+from starlette.concurrency import run_in_threadpool
+import main
 from main import app, ItemPurchased
-from database import inventory_table, metadata
+from database import inventory_table, adjustments_staging_table, stock_ledger_table, stock_reservations_table, metadata
+from bulk_adjust import apply_adjustments, parse_adjustment
+import cache_invalidation
+from single_flight import SingleFlight
+from id_filter import KnownIdFilter
+import stock_ledger
+import stock_levels
+import stock_stream
+import reservations
+import reconcile
+import item_codec
+import query_cache
+from shared_cache import SharedCache, connect
 
 # Create an in-memory SQLite database for testing
 TEST_DATABASE_URL = "sqlite:///:memory:"
@@ -23,7 +40,10 @@ def test_engine():
 @pytest.fixture
 def client(test_engine):
     """Create a test client with mocked database"""
-    with patch('main.engine', test_engine):
+    with patch('main.engine', test_engine), patch('bulk_adjust.engine', test_engine), \
+            patch('stock_ledger.engine', test_engine), patch('reservations.engine', test_engine), \
+            patch('cache_invalidation.engine', test_engine), patch('stock_levels.engine', test_engine), \
+            patch('reconcile.engine', test_engine):
         with patch('database.engine', test_engine):
             # Seed some test data
             with test_engine.connect() as conn:
@@ -35,8 +55,12 @@ def client(test_engine):
                 ])
                 trans.commit()
             
-            # Mock the seed_database function to prevent it from running
-            with patch('main.seed_database'):
+            # Fresh stock cache on the in-process fakeredis server, so tests don't see each other's entries
+            connect("fake://").flushall()
+            with patch('main.seed_database'), \
+                    patch('stock_levels.stock_cache', SharedCache("inventory", url="fake://")), \
+                    patch('stock_stream.broadcaster', stock_stream.StockBroadcaster()), \
+                    patch('stock_levels.known_products', KnownIdFilter("inventory", stock_levels._load_product_ids)):
                 yield TestClient(app)
 
 class TestInventoryAPI:
@@ -153,6 +177,700 @@ class TestInventoryAPI:
         assert response.status_code == 422  # Validation error
 
 
+def get_stock(engine, product_id):
+    with engine.connect() as conn:
+        query = inventory_table.select().where(inventory_table.c.product_id == product_id)
+        return conn.execute(query).first().stock_level
+
+
+class TestBulkAdjust:
+    """Test suite for bulk stock adjustments"""
+
+    def test_bulk_adjust_csv(self, client, test_engine):
+        """Test absolute and delta adjustments from a CSV body"""
+        body = "product_id,mode,value\ntest-product-1,set,250\ntest-product-2,delta,-5\n"
+        response = client.post("/api/inventory/bulk-adjust", content=body)
+        assert response.status_code == 200
+        data = response.json()
+        assert data["applied"] == 2
+        assert data["failed"] == 0
+        assert get_stock(test_engine, "test-product-1") == 250
+        assert get_stock(test_engine, "test-product-2") == 45
+
+    def test_previous_levels_read_under_lock(self):
+        """Test that the levels the baseline shift is computed from are read FOR UPDATE, in key order"""
+        from sqlalchemy.dialects import postgresql
+        import bulk_adjust
+        sql = str(bulk_adjust.lock_stock_levels.compile(dialect=postgresql.dialect()))
+        assert sql.endswith("ORDER BY inventory.product_id FOR UPDATE")
+
+    def test_bulk_adjust_json_lines(self, client, test_engine):
+        """Test adjustments sent as JSON lines"""
+        body = '{"product_id": "test-product-3", "mode": "delta", "value": 7}\n'
+        response = client.post("/api/inventory/bulk-adjust", content=body)
+        assert response.json()["applied"] == 1
+        assert get_stock(test_engine, "test-product-3") == 7
+
+    def test_bulk_adjust_reports_failures(self, client, test_engine):
+        """Test that bad lines and unknown SKUs are counted, not fatal"""
+        body = "test-product-1,delta,-10\nunknown-sku,set,5\ntest-product-2,oops,1\nnot-a-line\n"
+        response = client.post("/api/inventory/bulk-adjust", content=body)
+        data = response.json()
+        assert data["applied"] == 1
+        assert data["failed"] == 3
+        assert any("unknown-sku" in error for error in data["errors"])
+        assert get_stock(test_engine, "test-product-1") == 90
+
+    def test_bulk_adjust_delta_never_negative(self, client, test_engine):
+        """Test that a delta larger than the stock clamps to 0"""
+        client.post("/api/inventory/bulk-adjust", content="test-product-2,delta,-500")
+        assert get_stock(test_engine, "test-product-2") == 0
+
+    def test_bulk_adjust_chunks_and_duplicates(self, client, test_engine):
+        """Test chunked application and repeated SKUs within the stream"""
+        body = "\n".join([
+            "test-product-1,set,10",
+            "test-product-1,delta,5",
+            "test-product-2,delta,1",
+            "test-product-2,delta,1",
+            "test-product-3,set,3",
+        ])
+        response = client.post("/api/inventory/bulk-adjust?chunk_size=2", content=body)
+        data = response.json()
+        assert data["chunks"] == 3
+        assert data["failed"] == 0
+        assert get_stock(test_engine, "test-product-1") == 15
+        assert get_stock(test_engine, "test-product-2") == 52
+        assert get_stock(test_engine, "test-product-3") == 3
+
+        # The staging table is cleaned up after every chunk
+        with test_engine.connect() as conn:
+            assert conn.execute(adjustments_staging_table.select()).first() is None
+
+    def test_apply_adjustments_from_lines(self, client, test_engine):
+        """Test the CLI entry point with a plain iterable of lines"""
+        report = apply_adjustments(iter(["test-product-1,delta,1\n", "\n"]), chunk_size=100)
+        assert report["applied"] == 1
+        assert get_stock(test_engine, "test-product-1") == 101
+
+    def test_parse_adjustment_validation(self):
+        """Test line parsing rules"""
+        assert parse_adjustment("product_id,mode,value") is None
+        assert parse_adjustment("a,set,5") == {"product_id": "a", "mode": "set", "value": 5}
+        with pytest.raises(ValueError):
+            parse_adjustment("a,set,-5")
+        with pytest.raises(ValueError):
+            parse_adjustment("a,delta,many")
+
+
+@pytest.fixture
+def ledger_mode():
+    with patch('stock_ledger.LEDGER_MODE', True):
+        yield
+
+
+class TestStockLedger:
+    """Test suite for the append-only stock ledger (INVENTORY_WRITE_MODE=ledger)"""
+
+    def test_reduce_appends_to_ledger(self, client, test_engine, ledger_mode):
+        """Test that a sale inserts ledger rows and leaves the snapshot untouched"""
+        items = [{"id": "test-product-1", "quantity": 10}, {"id": "test-product-1", "quantity": 5}]
+        response = client.post("/api/inventory/reduce", json=items)
+        assert response.status_code == 200
+        assert response.json()["updated_items"] == [{"product_id": "test-product-1", "new_stock_level": 85}]
+
+        assert get_stock(test_engine, "test-product-1") == 100
+        with test_engine.connect() as conn:
+            rows = conn.execute(stock_ledger_table.select()).fetchall()
+        assert [(row.product_id, row.delta, row.reason) for row in rows] == [("test-product-1", -15, "sale")]
+
+    def test_get_inventory_reads_snapshot_plus_deltas(self, client, ledger_mode):
+        """Test that the available stock includes pending ledger deltas"""
+        client.post("/api/inventory/reduce", json=[{"id": "test-product-2", "quantity": 20}])
+        client.post("/api/inventory/reduce", json=[{"id": "test-product-2", "quantity": 5}])
+        response = client.get("/api/inventory/test-product-2")
+        assert response.json()["stock_level"] == 25
+
+    def test_reduce_never_below_zero(self, client, ledger_mode):
+        """Test that overselling records a movement down to 0 only"""
+        response = client.post("/api/inventory/reduce", json=[{"id": "test-product-2", "quantity": 80}])
+        assert response.json()["updated_items"][0]["new_stock_level"] == 0
+        assert client.get("/api/inventory/test-product-2").json()["stock_level"] == 0
+
+    def test_reduce_unknown_product(self, client, ledger_mode):
+        """Test that unknown products are skipped like in the in-place path"""
+        response = client.post("/api/inventory/reduce", json=[{"id": "nope", "quantity": 1}])
+        assert response.status_code == 200
+        assert response.json()["updated_items"] == []
+
+    def test_compaction_folds_pending_deltas(self, client, test_engine, ledger_mode):
+        """Test that compaction moves pending deltas into the snapshot and keeps the audit trail"""
+        client.post("/api/inventory/reduce", json=[{"id": "test-product-1", "quantity": 30}])
+        client.post("/api/inventory/reduce", json=[{"id": "test-product-2", "quantity": 10}])
+
+        assert stock_ledger.compact() == 2
+        assert stock_ledger.compact() == 0
+        assert get_stock(test_engine, "test-product-1") == 70
+        assert get_stock(test_engine, "test-product-2") == 40
+        assert client.get("/api/inventory/test-product-1").json()["stock_level"] == 70
+
+        with test_engine.connect() as conn:
+            rows = conn.execute(stock_ledger_table.select()).fetchall()
+        assert len(rows) == 2
+        assert all(row.compacted for row in rows)
+
+    def test_bulk_adjust_in_ledger_mode(self, client, test_engine, ledger_mode):
+        """Test that bulk adjustments become ledger movements against the available stock"""
+        client.post("/api/inventory/reduce", json=[{"id": "test-product-1", "quantity": 40}])
+        body = "test-product-1,set,10\ntest-product-2,delta,5\n"
+        data = client.post("/api/inventory/bulk-adjust", content=body).json()
+        assert data["applied"] == 2
+
+        assert client.get("/api/inventory/test-product-1").json()["stock_level"] == 10
+        assert client.get("/api/inventory/test-product-2").json()["stock_level"] == 55
+        stock_ledger.compact()
+        assert get_stock(test_engine, "test-product-1") == 10
+
+    def test_prune_compacted_rows(self, client, test_engine, ledger_mode):
+        """Test that retention only deletes compacted rows"""
+        client.post("/api/inventory/reduce", json=[{"id": "test-product-1", "quantity": 1}])
+        stock_ledger.compact()
+        client.post("/api/inventory/reduce", json=[{"id": "test-product-1", "quantity": 1}])
+        assert stock_ledger.prune(older_than=float("inf")) == 1
+        assert client.get("/api/inventory/test-product-1").json()["stock_level"] == 98
+
+
+class TestReservations:
+    """Test suite for stock reservations"""
+
+    def reserve(self, client, items, ttl_seconds=None):
+        payload = {"items": [{"id": product_id, "quantity": quantity} for product_id, quantity in items]}
+        if ttl_seconds:
+            payload["ttl_seconds"] = ttl_seconds
+        return client.post("/api/inventory/reservations", json=payload)
+
+    def test_reserve_holds_stock(self, client, test_engine):
+        """Test that a hold lowers availability but not the stock level"""
+        response = self.reserve(client, [("test-product-1", 30), ("test-product-2", 5)])
+        assert response.status_code == 200
+        assert response.json()["reservation_id"].startswith("RSV-")
+
+        response = client.get("/api/inventory/available?ids=test-product-1,test-product-2,unknown")
+        assert response.json() == [
+            {"product_id": "test-product-1", "stock_level": 100, "reserved": 30, "available": 70},
+            {"product_id": "test-product-2", "stock_level": 50, "reserved": 5, "available": 45},
+        ]
+        assert get_stock(test_engine, "test-product-1") == 100
+
+    def test_reserve_insufficient_stock(self, client):
+        """Test that a hold is refused (all or nothing) when stock is short"""
+        self.reserve(client, [("test-product-2", 40)])
+        response = self.reserve(client, [("test-product-1", 1), ("test-product-2", 20)])
+        assert response.status_code == 409
+        shortages = response.json()["detail"]["shortages"]
+        assert shortages == [{"product_id": "test-product-2", "requested": 20, "available": 10}]
+
+        # Nothing was held for the first item either
+        available = client.get("/api/inventory/available?ids=test-product-1").json()
+        assert available[0]["reserved"] == 0
+
+    def test_reserve_rejects_non_positive_quantity(self, client):
+        """Test that a zero or negative hold is refused instead of lowering the held sum"""
+        self.reserve(client, [("test-product-2", 50)])
+        for quantity in (0, -5):
+            response = self.reserve(client, [("test-product-2", quantity), ("test-product-2", 5)])
+            assert response.status_code == 422
+        with pytest.raises(ValueError):
+            reservations.reserve([ItemPurchased(id="test-product-2", quantity=-5)])
+        assert self.reserve(client, [("test-product-2", 1)]).status_code == 409
+
+    def test_reserve_unknown_product(self, client):
+        """Test that reserving an unknown product is refused"""
+        response = self.reserve(client, [("unknown", 1)])
+        assert response.status_code == 409
+
+    def test_confirm_turns_hold_into_sale(self, client, test_engine):
+        """Test that confirming reduces stock and drops the hold"""
+        reservation_id = self.reserve(client, [("test-product-1", 10)]).json()["reservation_id"]
+        response = client.post(f"/api/inventory/reservations/{reservation_id}/confirm")
+        assert response.status_code == 200
+        assert response.json()["updated_items"] == [{"product_id": "test-product-1", "new_stock_level": 90}]
+        assert get_stock(test_engine, "test-product-1") == 90
+
+        # Confirming twice (a retry) succeeds without selling twice
+        response = client.post(f"/api/inventory/reservations/{reservation_id}/confirm")
+        assert response.status_code == 200
+        assert response.json()["updated_items"] == []
+        assert get_stock(test_engine, "test-product-1") == 90
+
+    def test_reserve_and_confirm_are_idempotent(self, client, test_engine):
+        """Test that retries with the same key hold and sell the stock once"""
+        payload = {"items": [{"id": "test-product-2", "quantity": 20}]}
+        headers = {"Idempotency-Key": "ORD-1-abc"}
+        first = client.post("/api/inventory/reservations", json=payload, headers=headers).json()
+        retry = client.post("/api/inventory/reservations", json=payload, headers=headers).json()
+        assert first["reservation_id"] == retry["reservation_id"] == "RSV-ORD-1-abc"
+        assert retry["items"] == [{"product_id": "test-product-2", "quantity": 20}]
+        assert client.get("/api/inventory/available?ids=test-product-2").json()[0]["reserved"] == 20
+
+        client.post(f"/api/inventory/reservations/{first['reservation_id']}/confirm")
+        # A late retry of the reserve doesn't hold the sold stock again
+        assert client.post("/api/inventory/reservations", json=payload, headers=headers).json()["items"] == []
+        assert get_stock(test_engine, "test-product-2") == 30
+        assert client.get("/api/inventory/available?ids=test-product-2").json()[0]["reserved"] == 0
+        assert client.post("/api/inventory/reservations/RSV-unknown/confirm").status_code == 404
+
+    def test_release_hold(self, client):
+        """Test that releasing a hold makes the stock available again"""
+        reservation_id = self.reserve(client, [("test-product-2", 50)]).json()["reservation_id"]
+        assert client.delete(f"/api/inventory/reservations/{reservation_id}").status_code == 200
+        assert client.delete(f"/api/inventory/reservations/{reservation_id}").status_code == 404
+        assert client.get("/api/inventory/available?ids=test-product-2").json()[0]["available"] == 50
+
+    def test_expired_holds_are_ignored_and_swept(self, client, test_engine):
+        """Test that expired holds stop counting and are swept in batches"""
+        for _ in range(3):
+            self.reserve(client, [("test-product-1", 10)], ttl_seconds=60)
+        live_id = self.reserve(client, [("test-product-2", 1)], ttl_seconds=3600).json()["reservation_id"]
+
+        later = time.time() + 120
+        with test_engine.connect() as conn:
+            assert reservations.reserved_quantities(conn, ["test-product-1"], now=later) == {}
+
+        assert reservations.sweep_expired(now=later, batch_size=2) == 3
+        with test_engine.connect() as conn:
+            remaining = conn.execute(stock_reservations_table.select()).fetchall()
+        assert [row.reservation_id for row in remaining] == [live_id]
+
+    def test_confirm_in_ledger_mode(self, client, test_engine, ledger_mode):
+        """Test that confirmed holds go through the ledger write path"""
+        reservation_id = self.reserve(client, [("test-product-1", 10)]).json()["reservation_id"]
+        client.post(f"/api/inventory/reservations/{reservation_id}/confirm")
+        assert get_stock(test_engine, "test-product-1") == 100
+        assert client.get("/api/inventory/test-product-1").json()["stock_level"] == 90
+
+
+class TestStockCache:
+    """Test suite for the stock level cache"""
+
+    def test_stock_level_is_cached(self, client, test_engine):
+        """Test that a repeated lookup is served from the cache, not the database"""
+        assert client.get("/api/inventory/test-product-1").json()["stock_level"] == 100
+        with test_engine.begin() as conn:
+            conn.execute(inventory_table.update().where(inventory_table.c.product_id == "test-product-1").values(stock_level=1))
+        assert client.get("/api/inventory/test-product-1").json()["stock_level"] == 100
+        assert stock_levels.stock_cache.stats["local_hits"] == 1
+
+    def test_shared_between_replicas(self, client):
+        """Test that another replica finds the stock level in the shared tier"""
+        client.get("/api/inventory/test-product-2")
+        other_replica = SharedCache("inventory", url="fake://")
+        assert other_replica.get("test-product-2") == 50
+
+    def test_writes_invalidate(self, client):
+        """Test that sales, bulk adjustments and confirmed holds drop the cached level"""
+        client.get("/api/inventory/test-product-1")
+        client.post("/api/inventory/reduce", json=[{"id": "test-product-1", "quantity": 10}])
+        assert client.get("/api/inventory/test-product-1").json()["stock_level"] == 90
+
+        client.post("/api/inventory/bulk-adjust", content="test-product-1,set,75\n")
+        assert client.get("/api/inventory/test-product-1").json()["stock_level"] == 75
+
+        payload = {"items": [{"id": "test-product-1", "quantity": 5}]}
+        reservation_id = client.post("/api/inventory/reservations", json=payload).json()["reservation_id"]
+        client.post(f"/api/inventory/reservations/{reservation_id}/confirm")
+        assert client.get("/api/inventory/test-product-1").json()["stock_level"] == 70
+
+
+    def test_fill_racing_a_write_is_not_cached(self, client):
+        """Test that a level read before a write's invalidation isn't cached after it"""
+        load_levels = stock_levels._load_levels
+
+        def read_then_write(product_ids):
+            levels = load_levels(product_ids)  # the old level
+            stock_levels.invalidate(product_ids)  # a write commits meanwhile
+            return levels
+
+        with patch('stock_levels._load_levels', read_then_write):
+            assert stock_levels.load_level("test-product-1") == 100
+        assert stock_levels.stock_cache.get("test-product-1") is None
+
+        stock_levels.load_level("test-product-1")
+        assert stock_levels.stock_cache.get("test-product-1") == 100
+
+class TestCacheInvalidation:
+    """Test suite for cross-replica cache invalidation (polling fallback on SQLite)"""
+
+    @pytest.fixture
+    def other_replica(self, client):
+        cache = SharedCache("inventory", url="")
+        listener = cache_invalidation.InvalidationListener(
+            stock_levels.STOCK_CHANNEL, on_keys=cache.evict_local, on_resync=cache.clear_local
+        )
+        listener.poll()
+        cache.set("test-product-1", 100, 60)
+        cache.set("test-product-2", 50, 60)
+        return cache, listener
+
+    def test_sale_evicts_on_other_replica(self, client, other_replica):
+        """Test that a sale on one replica evicts the key on another"""
+        cache, listener = other_replica
+        client.post("/api/inventory/reduce", json=[{"id": "test-product-1", "quantity": 1}])
+        assert listener.poll() == 1
+        assert cache.get("test-product-1") is None
+        assert cache.get("test-product-2") == 50
+        assert listener.poll() == 0
+
+    def test_bulk_adjust_publishes_per_chunk(self, client, other_replica):
+        """Test that a bulk adjustment sends one notification per chunk"""
+        cache, listener = other_replica
+        body = "test-product-1,delta,5\ntest-product-2,set,10\nunknown,set,1\n"
+        client.post("/api/inventory/bulk-adjust?chunk_size=2", content=body)
+        assert listener.poll() == 2
+        assert listener.stats["notifications"] == 1
+        assert cache.get("test-product-2") is None
+
+    def test_reconnect_runs_full_resync(self, client, other_replica):
+        """Test that a listener that lost its connection drops everything on reconnect"""
+        cache, listener = other_replica
+        broken_engine = Mock()
+        broken_engine.begin.side_effect = OSError("connection reset")
+        with patch('cache_invalidation.engine', broken_engine):
+            assert listener.poll() == 0
+        assert listener.stats["errors"] == 1
+        assert cache.get("test-product-2") == 50
+
+        listener.poll()
+        assert listener.stats["resyncs"] == 2
+        assert cache.get("test-product-2") is None
+
+    def test_notify_payloads_stay_under_limit(self):
+        """Test that large key sets are split into several NOTIFY payloads"""
+        keys = [f"product-{i:05d}" for i in range(2000)]
+        payloads = cache_invalidation._notify_payloads(keys)
+        assert len(payloads) > 1
+        assert all(len(payload) <= cache_invalidation.MAX_NOTIFY_PAYLOAD_BYTES for payload in payloads)
+        assert [key for payload in payloads for key in json.loads(payload)] == keys
+
+
+class TestStockStream:
+    """Test suite for live stock updates (Server-Sent Events)"""
+
+    def test_stream_rejects_bad_ids(self, client):
+        """Test that a stream needs between 1 and STREAM_MAX_IDS product IDs"""
+        assert client.get("/api/inventory/stream?ids=").status_code == 400
+        too_many = ",".join(f"p{i}" for i in range(stock_stream.STREAM_MAX_IDS + 1))
+        assert client.get(f"/api/inventory/stream?ids={too_many}").status_code == 400
+
+    def test_adjustments_pushed_and_coalesced(self, client):
+        """Test that committed changes reach the stream, rapid ones as a single event"""
+        async def scenario():
+            broadcaster = stock_stream.broadcaster
+            subscriber = broadcaster.subscribe(["test-product-1"], {"test-product-1": 100})
+            stream = stock_stream.events(subscriber, broadcaster, coalesce_seconds=0.01)
+            chunks = [await stream.__anext__(), await stream.__anext__()]
+            # Two chunks, published from the threadpool
+            lines = ["test-product-1,delta,-5", "test-product-1,delta,-5"]
+            await run_in_threadpool(apply_adjustments, lines, 1)
+            chunks.append(await stream.__anext__())
+            await stream.aclose()
+            return chunks, broadcaster.client_count
+
+        chunks, client_count = asyncio.run(scenario())
+        assert chunks[0].startswith("retry:")
+        assert chunks[1] == stock_stream.format_event("test-product-1", 100)
+        assert chunks[2] == stock_stream.format_event("test-product-1", 90)
+        assert client_count == 0
+
+    def test_fan_out_and_dedup(self):
+        """Test that each watcher gets the latest level once and unwatched SKUs are ignored"""
+        async def scenario():
+            broadcaster = stock_stream.StockBroadcaster()
+            first = broadcaster.subscribe(["a", "b"], {"a": 10, "b": 5})
+            second = broadcaster.subscribe(["a"], {"a": 10})
+            first.drain(), second.drain()
+            for levels in ({"a": 9}, {"a": 8, "c": 1}, {"a": 8}):
+                broadcaster.publish(levels)
+            # A change from another replica: reload only what's watched
+            broadcaster.refresh(["b", "c"], lambda product_ids: {product_id: 0 for product_id in product_ids})
+            return first.drain(), second.drain(), broadcaster.stats
+
+        first, second, stats = asyncio.run(scenario())
+        assert first == {"a": 8, "b": 0}
+        assert second == {"a": 8}
+        assert stats["published"] == 3
+
+    def test_new_snapshot_does_not_hide_changes(self):
+        """Test that a newer level read by a new stream still reaches the existing ones"""
+        async def scenario():
+            broadcaster = stock_stream.StockBroadcaster()
+            existing = broadcaster.subscribe(["a"], {"a": 10})
+            existing.drain()
+            # Changed on another replica: the new client reads 7 before the refresh arrives
+            newcomer = broadcaster.subscribe(["a"], {"a": 7})
+            broadcaster.refresh(["a"], lambda product_ids: {"a": 7})
+            return existing.drain(), newcomer.drain()
+
+        existing, newcomer = asyncio.run(scenario())
+        assert existing == {"a": 7}
+        assert newcomer == {"a": 7}
+
+    def test_response_releases_unstarted_stream(self):
+        """Test that a stream whose body never started is unsubscribed"""
+        async def scenario():
+            broadcaster = stock_stream.StockBroadcaster()
+            subscriber = broadcaster.subscribe(["a"], {"a": 1})
+            response = stock_stream.StockStreamResponse(subscriber, broadcaster)
+
+            async def receive():
+                return {"type": "http.disconnect"}
+
+            async def send(message):
+                raise OSError("connection reset")
+
+            with pytest.raises(Exception):
+                await response({"type": "http", "asgi": {"spec_version": "2.4"}}, receive, send)
+            broadcaster.unsubscribe(subscriber)  # and again from the generator: no double count
+            return broadcaster.client_count, broadcaster.subscribers
+
+        assert asyncio.run(scenario()) == (0, {})
+
+
+class TestSingleFlight:
+    """Test suite for cache miss coalescing"""
+
+    def test_concurrent_misses_share_one_query(self, client):
+        """Test that a burst of lookups for one SKU runs a single query"""
+        calls = []
+        load_level = stock_levels.load_level
+
+        def slow_load(product_id):
+            calls.append(product_id)
+            time.sleep(0.05)
+            return load_level(product_id)
+
+        async def burst():
+            return await asyncio.gather(*[main.get_inventory_level("test-product-2") for _ in range(10)])
+
+        lookups = SingleFlight("test-inventory")
+        with patch('stock_levels.load_level', slow_load), patch('main.stock_lookups', lookups):
+            results = asyncio.run(burst())
+        assert calls == ["test-product-2"]
+        assert results == [{"product_id": "test-product-2", "stock_level": 50}] * 10
+        assert lookups.stats["coalesced"] == 9
+
+    def test_metrics_endpoint(self, client):
+        """Test that coalescing counts are exposed for Prometheus"""
+        client.get("/api/inventory/test-product-1")
+        assert 'singleflight_executions_total{group="inventory"}' in client.get("/metrics").text
+
+
+class TestIdFilter:
+    """Test suite for the negative-lookup filter over SKUs"""
+
+    def test_unknown_sku_skips_database(self, client):
+        """Test that a definite miss is a 404 without a query, known SKUs still resolve"""
+        stock_levels.known_products.build()
+        with patch('stock_levels.load_level', Mock(side_effect=AssertionError("database queried"))):
+            assert client.get("/api/inventory/no-such-sku").status_code == 404
+        assert client.get("/api/inventory/test-product-3").json()["stock_level"] == 0
+        assert stock_levels.known_products.stats["definite_misses"] == 1
+
+    def test_resync_rebuilds_filter(self, client, test_engine):
+        """Test that SKUs added while the listener was disconnected are picked up on resync"""
+        stock_levels.known_products.build()
+        with test_engine.begin() as conn:
+            conn.execute(inventory_table.insert().values(product_id="late-sku", stock_level=5))
+        assert stock_levels.known_products.definitely_missing("late-sku")
+        stock_levels._resync()
+        assert client.get("/api/inventory/late-sku").json()["stock_level"] == 5
+
+
+class TestAdmissionControl:
+    """Test suite for admission control route classes"""
+
+    def test_routes_are_classified(self):
+        """Test that the checkout path is prioritized and streams are never queued"""
+        assert main.classify_route("POST", "/api/inventory/reduce") == "checkout"
+        assert main.classify_route("POST", "/api/inventory/reservations/RSV-1/confirm") == "checkout"
+        assert main.classify_route("GET", "/api/inventory/1001") == "read"
+        assert main.classify_route("POST", "/api/inventory/bulk-adjust") == "read"
+        assert main.classify_route("GET", "/api/inventory/stream") is None
+        assert main.classify_route("GET", "/metrics") is None
+
+
+# --- Order/inventory reconciliation ---
+
+# The orders-api tables reconcile.py reads (all services share the database)
+orders_metadata = MetaData()
+orders_view_table = Table("orders", orders_metadata, Column("id", String, primary_key=True), Column("status", String))
+order_items_view_table = Table(
+    "order_items", orders_metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("order_id", String), Column("product_id", String), Column("quantity", Integer),
+)
+order_pipeline_view_table = Table("order_pipeline", orders_metadata, Column("order_id", String, primary_key=True))
+
+
+@pytest.fixture
+def orders_db(test_engine):
+    orders_metadata.create_all(test_engine)
+
+    def add_order(order_id, items, status="received", in_pipeline=False):
+        with test_engine.begin() as conn:
+            conn.execute(orders_view_table.insert().values(id=order_id, status=status))
+            conn.execute(order_items_view_table.insert(), [
+                {"order_id": order_id, "product_id": product_id, "quantity": quantity} for product_id, quantity in items
+            ])
+            if in_pipeline:
+                conn.execute(order_pipeline_view_table.insert().values(order_id=order_id))
+    return add_order
+
+
+class TestReconciliation:
+    """Test suite for the order/inventory reconciliation job"""
+
+    def test_first_run_records_baselines(self, client, orders_db):
+        """Test that the first run only records the current levels"""
+        orders_db("ORD-1", [("test-product-1", 5)])
+        report = reconcile.run(correct=True)
+        assert report["first_run"] is True
+        assert report["skus_checked"] == 3
+        assert report["drifted"] == 0
+        assert client.get("/api/inventory/test-product-1").json()["stock_level"] == 100
+
+    def test_recorded_sales_are_not_drift(self, client, orders_db):
+        """Test that orders whose stock was reduced reconcile cleanly"""
+        reconcile.run()
+        orders_db("ORD-1", [("test-product-1", 5), ("test-product-2", 2)])
+        client.post("/api/inventory/reduce", json=[{"id": "test-product-1", "quantity": 5}, {"id": "test-product-2", "quantity": 2}])
+        report = reconcile.run()
+        assert report["first_run"] is False
+        assert report["drifted"] == 0
+
+    def test_missed_reduce_is_corrected_when_it_persists(self, client, test_engine, orders_db):
+        """Test that a lost inventory call is reported, then corrected by the second run that sees it"""
+        reconcile.run()
+        orders_db("ORD-1", [("test-product-1", 7)])  # Saved, but /reduce never arrived
+
+        report = reconcile.run(correct=True)
+        assert report["drift"] == [{"product_id": "test-product-1", "expected": 93, "actual": 100, "drift": 7}]
+        assert report["corrected"] == 0
+        assert get_stock(test_engine, "test-product-1") == 100
+
+        report = reconcile.run(correct=True)
+        assert report["corrected"] == 1
+        assert get_stock(test_engine, "test-product-1") == 93
+        assert client.get("/api/inventory/test-product-1").json()["stock_level"] == 93
+        assert reconcile.run(correct=True)["drifted"] == 0
+
+    def test_late_reduce_is_not_corrected(self, client, test_engine, orders_db):
+        """Test that a drift that goes away by the next run is only reported"""
+        reconcile.run()
+        orders_db("ORD-1", [("test-product-2", 4)])
+        assert reconcile.run(correct=True)["drifted"] == 1
+        client.post("/api/inventory/reduce", json=[{"id": "test-product-2", "quantity": 4}])
+        report = reconcile.run(correct=True)
+        assert report["drifted"] == 0
+        assert get_stock(test_engine, "test-product-2") == 46
+
+    def test_bulk_adjustments_shift_baselines(self, client, orders_db):
+        """Test that warehouse syncs are not reported as drift"""
+        reconcile.run()
+        client.post("/api/inventory/bulk-adjust", content="test-product-1,set,250\ntest-product-2,delta,-5\n")
+        assert reconcile.run()["drifted"] == 0
+
+    def test_failed_and_in_flight_orders_are_skipped(self, client, orders_db):
+        """Test that failed orders aren't sales and in-flight orders wait for a later run"""
+        reconcile.run()
+        orders_db("ORD-1", [("test-product-1", 3)], status="failed")
+        orders_db("ORD-2", [("test-product-2", 2)], in_pipeline=True)
+        assert reconcile.run()["drifted"] == 0
+
+        client.post("/api/inventory/reduce", json=[{"id": "test-product-2", "quantity": 2}])
+        assert reconcile.run()["drifted"] == 1  # ORD-2 is still in flight: not counted yet
+
+    def test_chunked_run_matches(self, client, orders_db):
+        """Test tiny item and SKU chunks"""
+        reconcile.run()
+        orders_db("ORD-1", [("test-product-1", 1), ("test-product-2", 1)])
+        orders_db("ORD-2", [("test-product-1", 2), ("test-product-3", 1)])
+        with patch('reconcile.RECONCILE_ITEM_CHUNK', 1), patch('reconcile.RECONCILE_SKU_CHUNK', 1):
+            report = reconcile.run()
+        assert report["skus_checked"] == 3
+        assert {entry["product_id"]: entry["drift"] for entry in report["drift"]} == {"test-product-1": 3, "test-product-2": 1}
+
+    def test_interrupted_run_resumes(self, client, test_engine, orders_db):
+        """Test that a run stopped halfway resumes without rechecking or recounting"""
+        reconcile.run()
+        orders_db("ORD-1", [("test-product-1", 1), ("test-product-3", 1)])
+        compare_chunk = reconcile._compare_chunk
+        calls = []
+
+        def crash_after_first(*args):
+            if calls:
+                raise RuntimeError("killed")
+            calls.append(1)
+            return compare_chunk(*args)
+
+        with patch('reconcile.RECONCILE_SKU_CHUNK', 1), patch('reconcile._compare_chunk', crash_after_first):
+            with pytest.raises(RuntimeError):
+                reconcile.run()
+        report = reconcile.run()
+        assert report["skus_checked"] == 2  # test-product-1 was checked before the crash
+        assert report["drift"] == []  # test-product-3 has no stock left to expect
+
+
+class TestBinaryTransport:
+    """Test suite for the compact binary encoding of /api/inventory/reduce"""
+
+    def test_reduce_binary_request_and_response(self, client, test_engine):
+        """Test that a binary body is applied and the levels are sent back encoded on request"""
+        body = item_codec.encode([("test-product-1", 10), ("test-product-2", 5), ("unknown", 1)])
+        headers = {"Content-Type": item_codec.CONTENT_TYPE, "Accept": item_codec.CONTENT_TYPE}
+        response = client.post("/api/inventory/reduce", content=body, headers=headers)
+        assert response.status_code == 200
+        assert response.headers["content-type"] == item_codec.CONTENT_TYPE
+        assert item_codec.decode(response.content) == [("test-product-1", 90), ("test-product-2", 45)]
+        assert get_stock(test_engine, "test-product-1") == 90
+
+    def test_reduce_binary_request_json_response(self, client):
+        """Test that JSON stays the response format unless the caller accepts binary"""
+        body = item_codec.encode([("test-product-1", 1)])
+        response = client.post("/api/inventory/reduce", content=body, headers={"Content-Type": item_codec.CONTENT_TYPE})
+        assert response.json()["updated_items"] == [{"product_id": "test-product-1", "new_stock_level": 99}]
+
+    def test_reduce_malformed_binary(self, client, test_engine):
+        """Test that a truncated body is rejected before touching stock"""
+        body = item_codec.encode([("test-product-1", 1)])[:-2]
+        response = client.post("/api/inventory/reduce", content=body, headers={"Content-Type": item_codec.CONTENT_TYPE})
+        assert response.status_code == 400
+        assert get_stock(test_engine, "test-product-1") == 100
+
+    def test_reduce_json_validation_errors(self, client):
+        """Test that JSON bodies keep FastAPI's 422 error format"""
+        response = client.post("/api/inventory/reduce", json=[{"id": "test-product-1", "quantity": "many"}])
+        assert response.status_code == 422
+        assert response.json()["detail"][0]["loc"] == ["body", 0, "quantity"]
+        assert client.post("/api/inventory/reduce", content=b"not json").status_code == 422
+
+
+class TestPrecompiledStatements:
+    """Test suite for the statements built once and reused on the stock paths"""
+
+    def test_reduce_reuses_compiled_statements(self, client):
+        """Test that once warm, reductions of any cart size compile no SQL"""
+        client.post("/api/inventory/reduce", json=[{"id": "test-product-1", "quantity": 1}])
+        client.get("/api/inventory/test-product-1")
+
+        query_cache.stats.clear()
+        items = [{"id": "test-product-1", "quantity": 1}, {"id": "test-product-2", "quantity": 1}]
+        assert client.post("/api/inventory/reduce", json=items).status_code == 200
+        client.get("/api/inventory/test-product-2")
+        assert query_cache.stats["hit"] > 0
+        assert query_cache.stats["miss"] == 0
+
+
 class TestItemPurchasedModel:
     """Test suite for ItemPurchased Pydantic model"""
     
@@ -0,0 +1,70 @@
+"""
+Performance regression gate (see perf_gate.py), skipped unless asked for:
+
+    PERF_TESTS=1 pytest test_perf.py               # check against perf_baseline.json
+    PERF_UPDATE_BASELINE=1 pytest test_perf.py     # record a new baseline
+"""
+import pytest
+from pathlib import Path
+
+import perf_gate
+import stock_levels
+from database import inventory_table
+from perf_gate import PerfGate
+from shared_cache import connect
+from test_main import client, test_engine  # noqa: F401 (fixtures)
+
+pytestmark = pytest.mark.skipif(not perf_gate.PERF_TESTS, reason="perf gate runs with PERF_TESTS=1")
+
+CART_LINES = 20
+
+
+@pytest.fixture(scope="module")
+def perf():
+    gate = PerfGate(Path(__file__).with_name("perf_baseline.json"))
+    yield gate
+    gate.save()
+
+
+@pytest.fixture
+def stocked(client, test_engine):
+    # Enough stock that every round succeeds
+    with test_engine.begin() as conn:
+        conn.execute(inventory_table.insert(), [
+            {"product_id": f"perf-{i}", "stock_level": 10**9} for i in range(CART_LINES)
+        ])
+    return client
+
+
+def drop_cached_stock():
+    stock_levels.stock_cache.clear_local()
+    connect("fake://").flushall()
+
+
+def cart(lines):
+    return [{"id": f"perf-{i}", "quantity": 1} for i in range(lines)]
+
+
+class TestPerfInventory:
+    """Statement counts and latency of the inventory endpoints against the stored baseline"""
+
+    def test_get_stock_uncached(self, perf, stocked):
+        result = perf.measure("get_stock_uncached", lambda: stocked.get("/api/inventory/perf-0"), setup=drop_cached_stock)
+        perf.check("get_stock_uncached", result)
+
+    def test_reduce_one_line(self, perf, stocked):
+        result = perf.measure("reduce_1_line", lambda: stocked.post("/api/inventory/reduce", json=cart(1)))
+        perf.check("reduce_1_line", result)
+
+    def test_reduce_many_lines(self, perf, stocked):
+        # A statement added per line shows up here CART_LINES times
+        result = perf.measure(f"reduce_{CART_LINES}_lines", lambda: stocked.post("/api/inventory/reduce", json=cart(CART_LINES)))
+        perf.check(f"reduce_{CART_LINES}_lines", result)
+
+    def test_reserve_and_release(self, perf, stocked):
+        def reserve_and_release():
+            reservation = stocked.post("/api/inventory/reservations", json={"items": cart(CART_LINES)}).json()
+            stocked.delete(f"/api/inventory/reservations/{reservation['reservation_id']}")
+
+        result = perf.measure(f"reserve_release_{CART_LINES}_lines", reserve_and_release)
+        perf.check(f"reserve_release_{CART_LINES}_lines", result)
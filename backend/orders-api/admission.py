@@ -0,0 +1,189 @@
+"""
+Admission control and load shedding.
+
+Under a spike, requests used to pile up waiting for a pooled database connection until
+they timed out. Now every request (except health, metrics and long-lived streams) is
+admitted by the AdmissionMiddleware first:
+
+- at most ADMISSION_MAX_CONCURRENCY requests run at once per pod, and each route class
+  ("checkout" or "read") has its own limit below that;
+- requests over the limit wait in a bounded per-class queue, for at most
+  ADMISSION_QUEUE_TIMEOUT_SECONDS;
+- a full queue (or a wait that times out) is answered at once with 503 and Retry-After,
+  so clients back off instead of the pod falling over;
+- freed slots go to queued checkout requests before queued reads, and reads are capped
+  below the pod limit, so browsing can't starve checkout.
+
+Queue depth, in-flight requests and shed requests per class are exported on GET /metrics
+(admission_queue_depth is the gauge to scale on).
+
+This file is identical in every service (each service is its own image).
+"""
+import asyncio
+import json
+import os
+from collections import deque
+from typing import Callable, Deque, Dict, Optional
+
+import metrics
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+# Default pool is 5 connections + 10 overflow per pod
+ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "15"))
+ADMISSION_CHECKOUT_CONCURRENCY = int(os.getenv("ADMISSION_CHECKOUT_CONCURRENCY", "15"))
+ADMISSION_READ_CONCURRENCY = int(os.getenv("ADMISSION_READ_CONCURRENCY", "12"))
+ADMISSION_CHECKOUT_QUEUE = int(os.getenv("ADMISSION_CHECKOUT_QUEUE", "100"))
+ADMISSION_READ_QUEUE = int(os.getenv("ADMISSION_READ_QUEUE", "50"))
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", "2"))
+ADMISSION_RETRY_AFTER_SECONDS = int(os.getenv("ADMISSION_RETRY_AFTER_SECONDS", "1"))
+
+CHECKOUT = "checkout"
+READ = "read"
+
+_controllers = []
+
+
+class RouteClass:
+    def __init__(self, name: str, priority: int, concurrency: int, queue_size: int):
+        self.name = name
+        self.priority = priority  # Lower runs first
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.active = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+        self.stats = {"admitted": 0, "queued": 0, "shed": 0, "timeouts": 0}
+
+
+class AdmissionController:
+    def __init__(self, service: str, max_concurrency: int = ADMISSION_MAX_CONCURRENCY,
+                 queue_timeout: float = ADMISSION_QUEUE_TIMEOUT_SECONDS):
+        self.service = service
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.classes: Dict[str, RouteClass] = {}
+        self.add_class(CHECKOUT, 0, ADMISSION_CHECKOUT_CONCURRENCY, ADMISSION_CHECKOUT_QUEUE)
+        self.add_class(READ, 1, ADMISSION_READ_CONCURRENCY, ADMISSION_READ_QUEUE)
+        _controllers.append(self)
+
+    def add_class(self, name: str, priority: int, concurrency: int, queue_size: int):
+        self.classes[name] = RouteClass(name, priority, concurrency, queue_size)
+
+    def _has_room(self, route_class: RouteClass) -> bool:
+        return self.active < self.max_concurrency and route_class.active < route_class.concurrency
+
+    def _take(self, route_class: RouteClass):
+        self.active += 1
+        route_class.active += 1
+        route_class.stats["admitted"] += 1
+
+    def _queued_ahead(self, route_class: RouteClass) -> bool:
+        # Don't let a newcomer overtake queued requests of its class or above that could run
+        return any(
+            other.waiters and other.active < other.concurrency
+            for other in self.classes.values()
+            if other.priority <= route_class.priority
+        )
+
+    async def acquire(self, name: str) -> bool:
+        """Waits for a slot. Returns False if the request must be shed."""
+        route_class = self.classes[name]
+        if self._has_room(route_class) and not self._queued_ahead(route_class):
+            self._take(route_class)
+            return True
+        if len(route_class.waiters) >= route_class.queue_size:
+            route_class.stats["shed"] += 1
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        route_class.waiters.append(waiter)
+        route_class.stats["queued"] += 1
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+            return True
+        except asyncio.TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                return True  # Granted just as the timeout fired
+            route_class.stats["timeouts"] += 1
+            route_class.stats["shed"] += 1
+            return False
+        except asyncio.CancelledError:
+            # Client went away while queued; give back a slot granted in the meantime
+            if waiter.done() and not waiter.cancelled():
+                self.release(name)
+            raise
+        finally:
+            if waiter in route_class.waiters:
+                route_class.waiters.remove(waiter)
+
+    def release(self, name: str):
+        route_class = self.classes[name]
+        self.active -= 1
+        route_class.active -= 1
+        self._grant()
+
+    def _grant(self):
+        # Hand freed slots to queued requests, checkout first
+        for route_class in sorted(self.classes.values(), key=lambda c: c.priority):
+            while route_class.waiters and self._has_room(route_class):
+                waiter = route_class.waiters.popleft()
+                if waiter.done():
+                    continue  # Timed out or cancelled
+                self._take(route_class)
+                waiter.set_result(True)
+
+
+class AdmissionMiddleware:
+    """
+    Pure ASGI middleware (so streaming responses pass straight through).
+    classify(method, path) returns the route class name, or None to skip admission.
+    """
+
+    def __init__(self, app, controller: AdmissionController, classify: Callable[[str, str], Optional[str]]):
+        self.app = app
+        self.controller = controller
+        self.classify = classify
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not ADMISSION_ENABLED:
+            return await self.app(scope, receive, send)
+        name = self.classify(scope["method"], scope["path"])
+        if name is None:
+            return await self.app(scope, receive, send)
+
+        if not await self.controller.acquire(name):
+            return await self._shed(send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(name)
+
+    async def _shed(self, send):
+        body = json.dumps({"detail": "Service is overloaded, please retry"}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 503,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("ascii")),
+                (b"retry-after", str(ADMISSION_RETRY_AFTER_SECONDS).encode("ascii")),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+@metrics.register
+def _collect():
+    def samples(value):
+        return [
+            ({"service": controller.service, "route_class": route_class.name}, value(route_class))
+            for controller in _controllers
+            for route_class in controller.classes.values()
+        ]
+
+    yield "admission_queue_depth", "gauge", "Requests waiting for admission", samples(lambda c: len(c.waiters))
+    yield "admission_in_flight", "gauge", "Requests admitted and running", samples(lambda c: c.active)
+    yield "admission_concurrency_limit", "gauge", "Concurrent requests allowed", samples(lambda c: c.concurrency)
+    yield "admission_admitted_total", "counter", "Requests admitted", samples(lambda c: c.stats["admitted"])
+    yield "admission_shed_total", "counter", "Requests answered 503 (queue full or wait timed out)", \
+        samples(lambda c: c.stats["shed"])
@@ -0,0 +1,224 @@
+"""
+Cold-storage archival of old orders.
+
+orders and order_items grow forever, which slows every scan, vacuum and backup. The
+archival job moves orders older than ARCHIVE_AFTER_DAYS out of the hot tables into
+gzip-compressed NDJSON files (one order per line, with its items), partitioned by the
+UTC day the order was placed:
+
+    <ARCHIVE_URL>/orders/day=2025-03-10/part-<first order id>.ndjson.gz
+
+Each batch of ARCHIVE_BATCH_ORDERS orders is locked, written to storage, and deleted from
+the hot tables in one transaction, so an order is only deleted once its file is stored.
+If the delete fails after the upload, the next run archives the same orders again into
+a new part; readers take the first copy, which is identical.
+
+ARCHIVE_URL is a directory (file:///var/lib/orders-archive) or an S3-compatible bucket
+(s3://bucket/prefix, with ARCHIVE_S3_ENDPOINT_URL for MinIO and the like; needs boto3).
+GET /api/orders/{id} falls back to lookup() for orders that are no longer in the hot
+tables: the order ID gives the day, so only that day's parts are read. The sales rollups
+keep archived orders; rollups.py --rebuild leaves the archived days alone.
+
+Run it from a cron job:
+
+    ARCHIVE_URL=s3://my-bucket/orders-archive python archive.py --older-than-days 180
+"""
+import argparse
+import gzip
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import delete, select
+
+from database import orders_table, order_items_table, order_pipeline_table
+from rollups import order_day
+from sharding import router
+
+ARCHIVE_URL = os.getenv("ARCHIVE_URL", "")
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "180"))
+ARCHIVE_BATCH_ORDERS = int(os.getenv("ARCHIVE_BATCH_ORDERS", "1000"))
+ARCHIVE_S3_ENDPOINT_URL = os.getenv("ARCHIVE_S3_ENDPOINT_URL") or None
+# Decoded parts kept in memory for read-through lookups
+ARCHIVE_CACHED_PARTS = 8
+
+
+# --- Storage backends ---
+
+class LocalStorage:
+    def __init__(self, root: str):
+        self.root = root
+
+    def put(self, key: str, data: bytes):
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so readers never see a partial part
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as tmp:
+            tmp.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, key: str) -> bytes:
+        with open(os.path.join(self.root, key), "rb") as part:
+            return part.read()
+
+    def list(self, prefix: str) -> List[str]:
+        directory = os.path.join(self.root, prefix)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(f"{prefix}{name}" for name in os.listdir(directory) if not name.endswith(".tmp"))
+
+
+class S3Storage:
+    def __init__(self, bucket: str, prefix: str):
+        import boto3  # Only needed for s3:// archives
+        self.client = boto3.client("s3", endpoint_url=ARCHIVE_S3_ENDPOINT_URL)
+        self.bucket = bucket
+        self.prefix = f"{prefix.strip('/')}/" if prefix.strip("/") else ""
+
+    def put(self, key: str, data: bytes):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data)
+
+    def get(self, key: str) -> bytes:
+        return self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)["Body"].read()
+
+    def list(self, prefix: str) -> List[str]:
+        keys = []
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + prefix):
+            keys.extend(item["Key"][len(self.prefix):] for item in page.get("Contents", []))
+        return sorted(keys)
+
+
+def open_storage(url: str):
+    if url.startswith("s3://"):
+        bucket, _, prefix = url[len("s3://"):].partition("/")
+        return S3Storage(bucket, prefix)
+    return LocalStorage(url[len("file://"):] if url.startswith("file://") else url)
+
+
+def partition(day: str) -> str:
+    return f"orders/day={day}/"
+
+
+_partition_day = re.compile(r"day=(\d{4}-\d{2}-\d{2})")
+
+
+def last_archived_day(storage) -> Optional[str]:
+    """Latest day with an archived part (YYYY-MM-DD), or None if nothing was archived."""
+    days = [match.group(1) for match in map(_partition_day.search, storage.list("orders/")) if match]
+    return max(days, default=None)
+
+
+# --- Archival job ---
+
+def _encode(orders: List[Dict[str, Any]]) -> bytes:
+    lines = "".join(json.dumps(order, separators=(",", ":")) + "\n" for order in orders)
+    return gzip.compress(lines.encode("utf-8"))
+
+
+def archive_batch(engine, storage, cutoff: float, batch_size: int = ARCHIVE_BATCH_ORDERS) -> int:
+    """Moves up to batch_size of one shard's orders placed before `cutoff`. Returns how many."""
+    # IDs are ORD-<epoch>-..., so "placed before cutoff" is a range scan on the primary key
+    boundary = f"ORD-{int(cutoff)}"
+    with engine.begin() as conn:
+        orders = [
+            dict(row._mapping) for row in conn.execute(
+                select(orders_table)
+                .where(orders_table.c.id < boundary)
+                .order_by(orders_table.c.id)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            )
+        ]
+        if not orders:
+            return 0
+        order_ids = [order["id"] for order in orders]
+
+        items: Dict[str, List[Dict[str, Any]]] = {order_id: [] for order_id in order_ids}
+        for row in conn.execute(
+            select(order_items_table).where(order_items_table.c.order_id.in_(order_ids)).order_by(order_items_table.c.id)
+        ):
+            items[row.order_id].append(dict(row._mapping))
+
+        by_day: Dict[str, List[Dict[str, Any]]] = {}
+        for order in orders:
+            by_day.setdefault(order_day(order["id"]), []).append({**order, "items": items[order["id"]]})
+        for day, day_orders in by_day.items():
+            storage.put(f"{partition(day)}part-{day_orders[0]['id']}.ndjson.gz", _encode(day_orders))
+
+        conn.execute(delete(order_items_table).where(order_items_table.c.order_id.in_(order_ids)))
+        # Orders this old that never left the status pipeline are archived as they are
+        conn.execute(delete(order_pipeline_table).where(order_pipeline_table.c.order_id.in_(order_ids)))
+        conn.execute(delete(orders_table).where(orders_table.c.id.in_(order_ids)))
+    return len(orders)
+
+
+def run(storage, older_than_days: float = ARCHIVE_AFTER_DAYS, batch_size: int = ARCHIVE_BATCH_ORDERS) -> int:
+    """Archives every order older than older_than_days, shard by shard, a batch per transaction."""
+    cutoff = time.time() - older_than_days * 86400
+    archived = 0
+    for engine in router.engines:
+        while True:
+            moved = archive_batch(engine, storage, cutoff, batch_size)
+            if not moved:
+                break
+            archived += moved
+            print(f"  Archived {archived} orders...")
+    return archived
+
+
+# --- Read-through ---
+
+class ArchiveReader:
+    """Finds archived orders by ID, keeping the last few decoded parts in memory."""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.parts: "OrderedDict[str, Dict[str, Dict[str, Any]]]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _part(self, key: str) -> Dict[str, Dict[str, Any]]:
+        with self.lock:
+            if key in self.parts:
+                self.parts.move_to_end(key)
+                return self.parts[key]
+        orders = {}
+        for line in gzip.decompress(self.storage.get(key)).decode("utf-8").splitlines():
+            order = json.loads(line)
+            orders.setdefault(order["id"], order)
+        with self.lock:
+            self.parts[key] = orders
+            while len(self.parts) > ARCHIVE_CACHED_PARTS:
+                self.parts.popitem(last=False)
+        return orders
+
+    def lookup(self, order_id: str) -> Optional[Dict[str, Any]]:
+        for key in self.storage.list(partition(order_day(order_id))):
+            # Parts are named after their lowest order ID
+            if key.rsplit("/part-", 1)[-1][:-len(".ndjson.gz")] > order_id:
+                continue
+            order = self._part(key).get(order_id)
+            if order is not None:
+                return order
+        return None
+
+
+archive_reader: Optional[ArchiveReader] = ArchiveReader(open_storage(ARCHIVE_URL)) if ARCHIVE_URL else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--older-than-days", type=float, default=ARCHIVE_AFTER_DAYS)
+    parser.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_ORDERS)
+    parser.add_argument("--url", default=ARCHIVE_URL, help="archive location (default: ARCHIVE_URL)")
+    args = parser.parse_args()
+    if not args.url:
+        parser.error("set ARCHIVE_URL or pass --url")
+    total = run(open_storage(args.url), args.older_than_days, args.batch_size)
+    print(f"Archived {total} orders older than {args.older_than_days} days.")
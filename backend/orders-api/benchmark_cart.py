@@ -0,0 +1,75 @@
+"""
+Micro-benchmark: ingesting one order body, the old model path vs cart.py, per cart size.
+
+Both paths do what POST /api/orders does before the database: parse and validate the
+body, fingerprint it (Idempotency-Key), reprice the cart, build the order_items rows and
+the inventory-api payload. No database or network involved:
+
+    python benchmark_cart.py --lines 10 100 500 1000
+"""
+import argparse
+import contextlib
+import io
+import json
+import time
+
+import cart
+import main
+from benchmark_batch import sample_order
+from cart import CartLine
+from idempotency import fingerprint
+from main import OrderPayload
+from pricing import from_cents, price_cart
+
+
+def model_path(body: bytes, prices):
+    # What the endpoint did before: json module, a model per line, copies per step
+    payload = OrderPayload.model_validate(json.loads(body))
+    fingerprint(payload.model_dump())
+    priced = price_cart(prices, payload.cart)
+    repriced = [item.model_copy(update={"price": from_cents(cents)}) for item, cents in zip(payload.cart, priced["unit_cents"])]
+    payload = payload.model_copy(update={"cart": repriced, "total": from_cents(priced["total_cents"])})
+    items = [
+        {"order_id": "ORD-1", "product_id": item.id, "product_name": item.name, "quantity": item.quantity, "price": item.price}
+        for item in payload.cart
+    ]
+    return items, [{"id": item.id, "quantity": item.quantity} for item in payload.cart]
+
+
+def cart_path(body: bytes, prices):
+    data = cart.validate(cart.order_schema, body)
+    order = cart.to_order(data)
+    fingerprint(data)
+    priced = price_cart(prices, order.cart)
+    order = order._replace(
+        cart=[CartLine(line.id, line.name, from_cents(cents), line.quantity) for line, cents in zip(order.cart, priced["unit_cents"])],
+        total=from_cents(priced["total_cents"]),
+    )
+    _, items = main.build_order_rows("ORD-1", order)
+    return items, [{"id": line.id, "quantity": line.quantity} for line in order.cart]
+
+
+def per_call_ms(path, body: bytes, prices, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        path(body, prices)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, nargs="+", default=[10, 100, 500, 1000], help="cart lines per order")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'lines':>6} {'model ms':>9} {'cart.py ms':>11} {'speedup':>8}")
+    for lines in args.lines:
+        order = sample_order(lines)
+        body = json.dumps(order).encode("utf-8")
+        prices = {item["id"]: 1000 for item in order["cart"]}
+        # Same rows and inventory payload either way
+        assert model_path(body, prices) == cart_path(body, prices)
+        with contextlib.redirect_stdout(io.StringIO()):
+            model_ms = per_call_ms(model_path, body, prices, args.repeat)
+            cart_ms = per_call_ms(cart_path, body, prices, args.repeat)
+        print(f"{lines:>6} {model_ms:>9.3f} {cart_ms:>11.3f} {model_ms / cart_ms:>7.2f}x")
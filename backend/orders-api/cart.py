@@ -0,0 +1,131 @@
+"""
+One-pass ingestion of order payloads.
+
+FastAPI used to parse the body with the json module, build an OrderPayload model with a
+CartItem model per line, and create_order then copied every line again when repricing,
+into order_items rows and into the inventory payload. For 500+ line carts that was most
+of the request. Now:
+
+- The size limits are checked first: Content-Length (or the bytes read so far) against
+  MAX_ORDER_BODY_BYTES / MAX_BATCH_BODY_BYTES (413), before anything is parsed.
+- The raw body is parsed and validated in one pass by pydantic-core against plain
+  TypedDicts, with the cart length and field lengths as part of the schema (422 with the
+  usual FastAPI error format). Unknown fields are ignored, like the models did.
+- Each cart becomes a list of CartLine tuples, which pricing, the order_items rows and
+  the inventory call all read from.
+
+The TypedDicts match main.OrderPayload field for field; benchmark_cart.py compares the
+two paths.
+"""
+import os
+from itertools import repeat
+from operator import itemgetter
+from typing import Any, Dict, List, NamedTuple
+
+from fastapi import HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import Field, StringConstraints, TypeAdapter, ValidationError
+from typing_extensions import Annotated, TypedDict
+
+MAX_ORDER_BODY_BYTES = int(os.getenv("MAX_ORDER_BODY_BYTES", str(1024 * 1024)))
+MAX_BATCH_BODY_BYTES = int(os.getenv("MAX_BATCH_BODY_BYTES", str(32 * 1024 * 1024)))
+MAX_CART_LINES = int(os.getenv("MAX_CART_LINES", "1000"))
+MAX_BATCH_ORDERS = int(os.getenv("MAX_BATCH_ORDERS", "1000"))
+MAX_ID_LENGTH = 64
+MAX_TEXT_LENGTH = 256
+MAX_URL_LENGTH = 2048
+
+ProductId = Annotated[str, StringConstraints(max_length=MAX_ID_LENGTH)]
+Text = Annotated[str, StringConstraints(max_length=MAX_TEXT_LENGTH)]
+
+
+class CartItemData(TypedDict):
+    id: ProductId
+    name: Text
+    price: Annotated[float, Field(ge=0)]
+    # A negative quantity would add stock in inventory-api
+    quantity: Annotated[int, Field(gt=0)]
+    imageUrl: Annotated[str, StringConstraints(max_length=MAX_URL_LENGTH)]
+
+
+class ShippingData(TypedDict):
+    name: Text
+    address: Text
+    city: Text
+    zip: Text
+
+
+class OrderData(TypedDict):
+    cart: Annotated[List[CartItemData], Field(max_length=MAX_CART_LINES)]
+    shippingDetails: ShippingData
+    total: float
+
+
+class BatchData(TypedDict):
+    orders: Annotated[List[OrderData], Field(max_length=MAX_BATCH_ORDERS)]
+
+
+order_schema = TypeAdapter(OrderData)
+batch_schema = TypeAdapter(BatchData)
+
+
+class CartLine(NamedTuple):
+    id: str
+    name: str
+    price: float
+    quantity: int
+
+
+class Order(NamedTuple):
+    cart: List[CartLine]
+    shipping: Dict[str, str]
+    total: float
+
+
+_line_fields = itemgetter(*CartLine._fields)
+
+
+def to_order(data: Dict[str, Any]) -> Order:
+    """Turns a validated OrderData dict into an Order."""
+    # itemgetter + tuple.__new__ stay in C, no Python call per line
+    cart = list(map(tuple.__new__, repeat(CartLine), map(_line_fields, data["cart"])))
+    return Order(cart, data["shippingDetails"], data["total"])
+
+
+async def read_body(request: Request, limit: int) -> bytes:
+    """The request body, or 413 as soon as it is known to be over `limit` bytes."""
+    length = request.headers.get("content-length", "")
+    if length.isdigit() and int(length) > limit:
+        raise HTTPException(status_code=413, detail=f"Request body is limited to {limit} bytes")
+    chunks, size = [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > limit:
+            raise HTTPException(status_code=413, detail=f"Request body is limited to {limit} bytes")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def validate(schema: TypeAdapter, body: bytes) -> Dict[str, Any]:
+    """Parses and validates a JSON body; errors are raised as FastAPI's usual 422."""
+    try:
+        return schema.validate_json(body)
+    except ValidationError as e:
+        raise RequestValidationError([{**error, "loc": ("body", *error["loc"])} for error in e.errors()], body=body)
+
+
+def openapi_body(schema: TypeAdapter) -> Dict[str, Any]:
+    """openapi_extra documenting a raw JSON body, for endpoints that read the Request."""
+    definitions = schema.json_schema()
+    nested = definitions.pop("$defs", {})
+
+    def inline(node):
+        if isinstance(node, dict):
+            if "$ref" in node:
+                return inline(nested[node["$ref"].rsplit("/", 1)[-1]])
+            return {key: inline(value) for key, value in node.items()}
+        if isinstance(node, list):
+            return [inline(value) for value in node]
+        return node
+
+    return {"requestBody": {"required": True, "content": {"application/json": {"schema": inline(definitions)}}}}
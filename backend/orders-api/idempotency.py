@@ -0,0 +1,221 @@
+"""
+Idempotency-Key support for order creation.
+
+A request carrying an Idempotency-Key runs at most once. The first request claims the
+key (INSERT into 'idempotency_keys', the primary key decides races between pods), runs,
+and stores its response. Retries are answered from:
+
+1. an in-memory LRU of completed responses (no DB, no inventory call), then
+2. the shared cache tier (see shared_cache.py), for keys completed on another pod, then
+3. the 'idempotency_keys' row, for keys completed before a restart or a cache outage.
+
+Completed rows are purged once they are older than IDEMPOTENCY_SHARED_TTL_SECONDS (see
+purge_completed), so a key is replayed for as long as the shared tier keeps it.
+
+Concurrent duplicates on the same pod await the first request instead of racing it;
+duplicates on other pods poll the row until it completes.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import bindparam, delete, select, update
+from sqlalchemy.exc import IntegrityError
+from starlette.concurrency import run_in_threadpool
+
+from database import engine, idempotency_keys_table
+from shared_cache import SharedCache
+
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+# How long a duplicate waits for a request still running on another pod
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "10"))
+# A "pending" claim older than this is treated as abandoned (pod died mid-request)
+IDEMPOTENCY_PENDING_TIMEOUT_SECONDS = float(os.getenv("IDEMPOTENCY_PENDING_TIMEOUT_SECONDS", "60"))
+# How long completed responses are replayed (shared cache tier TTL and DB row retention)
+IDEMPOTENCY_SHARED_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_SHARED_TTL_SECONDS", "86400"))
+# How often expired completed rows are purged, and how many rows per DELETE
+IDEMPOTENCY_PURGE_INTERVAL_SECONDS = float(os.getenv("IDEMPOTENCY_PURGE_INTERVAL_SECONDS", "3600"))
+IDEMPOTENCY_PURGE_BATCH = int(os.getenv("IDEMPOTENCY_PURGE_BATCH", "1000"))
+POLL_INTERVAL_SECONDS = 0.05
+MAX_KEY_LENGTH = 255
+
+
+def fingerprint(body) -> str:
+    """Stable hash of a request body, to refuse a key reused for a different request."""
+    canonical = json.dumps(body, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    """Small bounded mapping; the least recently used entry is evicted first."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, Tuple[str, dict]]" = OrderedDict()
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+# Hot-path statements, built once (see query_cache.py)
+_keys = idempotency_keys_table.c
+_insert_claim = idempotency_keys_table.insert()
+_select_claim = select(_keys.status, _keys.fingerprint, _keys.response, _keys.created_at).where(_keys.key == bindparam("claim_key"))
+_complete_claim = (
+    update(idempotency_keys_table)
+    .where(_keys.key == bindparam("claim_key"))
+    .values(status="completed", response=bindparam("stored_response"))
+)
+_release_claim = delete(idempotency_keys_table).where(_keys.key == bindparam("claim_key"), _keys.status == "pending")
+_purge_completed = delete(idempotency_keys_table).where(
+    _keys.key.in_(
+        select(_keys.key)
+        .where(_keys.status == "completed", _keys.created_at < bindparam("cutoff"))
+        .limit(bindparam("batch_size"))
+        .scalar_subquery()
+    )
+)
+
+
+def _claim(key: str, request_fingerprint: str) -> Tuple[str, Optional[str], Optional[dict]]:
+    """
+    Tries to claim the key. Returns (status, fingerprint, response):
+    ("claimed", ...) if this request must run, otherwise the stored row.
+    """
+    keys = idempotency_keys_table.c
+    now = time.time()
+    try:
+        with engine.begin() as conn:
+            conn.execute(_insert_claim, {"key": key, "status": "pending", "fingerprint": request_fingerprint, "created_at": now})
+        return "claimed", request_fingerprint, None
+    except IntegrityError:
+        pass
+
+    with engine.begin() as conn:
+        row = conn.execute(_select_claim, {"claim_key": key}).first()
+        if row is None:
+            # Released between our INSERT and SELECT; let the caller try again
+            return "pending", None, None
+        if row.status == "pending" and row.created_at < now - IDEMPOTENCY_PENDING_TIMEOUT_SECONDS:
+            # Take over an abandoned claim (only one pod wins the conditional UPDATE)
+            taken = conn.execute(
+                update(idempotency_keys_table)
+                .where(keys.key == key, keys.status == "pending", keys.created_at == row.created_at)
+                .values(fingerprint=request_fingerprint, created_at=now)
+            ).rowcount
+            if taken:
+                return "claimed", request_fingerprint, None
+        response = json.loads(row.response) if row.response else None
+        return row.status, row.fingerprint, response
+
+
+def _complete(key: str, response: dict):
+    with engine.begin() as conn:
+        conn.execute(_complete_claim, {"claim_key": key, "stored_response": json.dumps(response)})
+
+
+def _release(key: str):
+    # The request failed: drop the claim so a retry can run it again
+    with engine.begin() as conn:
+        conn.execute(_release_claim, {"claim_key": key})
+
+
+def purge_completed(now: Optional[float] = None, batch_size: int = IDEMPOTENCY_PURGE_BATCH) -> int:
+    """
+    Deletes completed keys older than IDEMPOTENCY_SHARED_TTL_SECONDS, batch_size rows per
+    transaction so the table is never locked for long. Pending claims are left to
+    _claim's takeover. Returns the number of rows deleted.
+    """
+    cutoff = (time.time() if now is None else now) - IDEMPOTENCY_SHARED_TTL_SECONDS
+    deleted = 0
+    while True:
+        with engine.begin() as conn:
+            count = conn.execute(_purge_completed, {"cutoff": cutoff, "batch_size": batch_size}).rowcount
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+
+class IdempotencyStore:
+    def __init__(self, max_entries: int = IDEMPOTENCY_CACHE_SIZE, shared_cache: Optional[SharedCache] = None):
+        self.cache = LRUCache(max_entries)
+        self.shared_cache = shared_cache or SharedCache("orders-idempotency")
+        self.inflight: Dict[str, asyncio.Future] = {}
+
+    async def run(self, key: str, request_fingerprint: str, handler: Callable[[], Awaitable[dict]]) -> dict:
+        """Runs handler() once per key and returns its (possibly replayed) response."""
+        if len(key) > MAX_KEY_LENGTH:
+            raise HTTPException(status_code=400, detail=f"Idempotency-Key must be at most {MAX_KEY_LENGTH} characters")
+
+        # 1. Hot path: completed on this pod
+        cached = self.cache.get(key)
+        if cached is not None:
+            return self._replay(cached, request_fingerprint)
+
+        # 2. Same key already running on this pod: wait for it
+        running = self.inflight.get(key)
+        if running is not None:
+            stored_fingerprint, response = await asyncio.shield(running)
+            return self._replay((stored_fingerprint, response), request_fingerprint)
+
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        try:
+            # 3. Completed on another pod (shared tier), otherwise claim it in the DB
+            shared = await self.shared_cache.aget(key)
+            if shared is not None:
+                result = (shared[0], shared[1])
+            else:
+                result = await self._run_once(key, request_fingerprint, handler)
+                await self.shared_cache.aset(key, list(result), IDEMPOTENCY_SHARED_TTL_SECONDS)
+            future.set_result(result)
+            self.cache.put(key, result)
+            return self._replay(result, request_fingerprint)
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # Mark as retrieved when nobody else was waiting
+            raise
+        finally:
+            del self.inflight[key]
+
+    @staticmethod
+    def _replay(entry: Tuple[str, dict], request_fingerprint: str) -> dict:
+        stored_fingerprint, response = entry
+        if stored_fingerprint != request_fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+        return response
+
+    async def _run_once(self, key: str, request_fingerprint: str, handler) -> Tuple[str, dict]:
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+        while True:
+            status, stored_fingerprint, response = await run_in_threadpool(_claim, key, request_fingerprint)
+            if status == "completed":
+                return stored_fingerprint, response
+            if status == "claimed":
+                break
+            # Running on another pod
+            if time.monotonic() > deadline:
+                raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+            await asyncio.sleep(POLL_INTERVAL_SECONDS)
+
+        try:
+            response = await handler()
+        except BaseException:
+            await run_in_threadpool(_release, key)
+            raise
+        await run_in_threadpool(_complete, key, response)
+        return request_fingerprint, response
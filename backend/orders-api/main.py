@@ -1,14 +1,39 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
-from typing import List, Dict, Any
+from sqlalchemy import bindparam
+from starlette.concurrency import run_in_threadpool
+from typing import List, Dict, Any, Optional
 import time
+import uuid
 import httpx # NEW: Import httpx to make API calls
 
 # NEW: Import database components
-from database import engine, orders_table, order_items_table, create_db_and_tables
+from database import orders_table, order_items_table, create_db_and_tables
+import idempotency
+from idempotency import IdempotencyStore, fingerprint
+import pricing
+import rollups
+import archive
+import sharding
+import group_commit
+from group_commit import GroupCommitter
+import pipeline
+from pipeline import OrderPipeline
+import item_codec
+import cart
+from cart import Order
+from sharding import router
+from pricing import PriceCache, PricingError
+import asyncio
+import metrics
+import profiling
+from admission import AdmissionController, AdmissionMiddleware, CHECKOUT, READ
 
 # --- Pydantic Models (Data Contracts) ---
+# The endpoints validate the raw body against the equivalent TypedDicts in cart.py
+# (one pass, no model per cart line); these models are the same contract for Python callers.
 class CartItem(BaseModel):
     id: str
     name: str
@@ -34,6 +59,24 @@ app = FastAPI()
 import os
 INVENTORY_API_URL = os.getenv("INVENTORY_API_URL", "http://localhost:8002/api/inventory/reduce")
 print(f"--- CONFIG: Inventory Service URL set to: {INVENTORY_API_URL} ---")
+# "binary" sends stock reductions in the compact encoding (see item_codec.py), once
+# every inventory-api replica understands it; "json" (default) works with any version
+INVENTORY_TRANSPORT = os.getenv("INVENTORY_TRANSPORT", "json").lower()
+# Orders written per transaction of a bulk submission (orders per request: cart.MAX_BATCH_ORDERS)
+BATCH_ORDERS_PER_TRANSACTION = int(os.getenv("BATCH_ORDERS_PER_TRANSACTION", "250"))
+# Rows per multi-row INSERT, keeps bound parameters under the driver limits
+ROWS_PER_INSERT = 1000
+# --- Admission Control ---
+# Bounded concurrency and wait queue per route class, 503 + Retry-After when full
+# (see admission.py). Added before CORS so shed responses still carry CORS headers.
+def classify_route(method: str, path: str):
+    if not path.startswith("/api/orders"):
+        return None  # Health checks and /metrics
+    return CHECKOUT if method == "POST" else READ
+
+admission_controller = AdmissionController("orders-api")
+app.add_middleware(AdmissionMiddleware, controller=admission_controller, classify=classify_route)
+
 # --- CORS Configuration ---
 
 app.add_middleware(
@@ -47,11 +90,25 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# --- Profiling ---
+# Guarded /debug/profile endpoints and per-request profiling (see profiling.py)
+profiling.install(app)
+
 # --- Database Connection ---
 @app.on_event("startup")
 def on_startup():
     # This creates the 'orders.db' file and tables
     create_db_and_tables()
+    # Order tables on every shard (see sharding.py)
+    router.create_tables()
+
+    # Keep the local product price cache warm (see pricing.py)
+    app.state.background_tasks = [asyncio.create_task(run_price_cache_refresh())]
+    # Drop completed idempotency keys past their retention (see idempotency.py)
+    app.state.background_tasks.append(asyncio.create_task(run_idempotency_purge()))
+    if pipeline.ORDER_PIPELINE_ENABLED:
+        # Moves orders through reserved/confirmed/fulfilled (see pipeline.py)
+        app.state.background_tasks.append(asyncio.create_task(order_pipeline.run()))
 
 # --- Asynchronous HTTP Client ---
 # We use a single httpx client for the app's lifespan
@@ -59,80 +116,105 @@ client = httpx.AsyncClient()
 
 @app.on_event("shutdown")
 async def on_shutdown():
+    for task in getattr(app.state, "background_tasks", []):
+        task.cancel()
     # Cleanly close the client when the app stops
     await client.aclose()
 
+# Status pipeline workers, started when ORDER_PIPELINE_ENABLED (see pipeline.py)
+order_pipeline = OrderPipeline(client)
+
+# Product prices in cents, loaded in bulk and refreshed in the background,
+# so orders are priced server-side without a products-api call per cart line
+price_cache = PriceCache()
+
+async def run_price_cache_refresh():
+    while True:
+        await price_cache.refresh_if_stale(client, min_age=0)
+        await asyncio.sleep(pricing.PRICE_CACHE_REFRESH_SECONDS)
+
+
+# Replays responses for repeated Idempotency-Key headers (see idempotency.py)
+idempotency_store = IdempotencyStore()
+
+async def run_idempotency_purge():
+    while True:
+        try:
+            await run_in_threadpool(idempotency.purge_completed)
+        except Exception as e:
+            print(f"  WARNING: Idempotency key purge failed: {e}")
+        await asyncio.sleep(idempotency.IDEMPOTENCY_PURGE_INTERVAL_SECONDS)
+
 
 # --- API Endpoints ---
 @app.get("/")
 def read_root():
     return {"status": "Orders API is running and connected to database"}
 
-@app.post("/api/orders")
-async def create_order(payload: OrderPayload):
-    
-    order_id = f"ORD-{int(time.time())}"
-    
-    print("\n--- [Orders Service] ---")
-    print("Received new order:")
-    print(f"  User: {payload.shippingDetails.name}")
-    print(f"  Items: {len(payload.cart)}")
-    print(f"  Total: ${payload.total:.2f}")
+# Prometheus scrape endpoint (see metrics.py)
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return metrics.render()
 
-    # --- 1. Save to Database (NEW) ---
-    with engine.connect() as conn:
-        trans = conn.begin() # Start a transaction
-        try:
-            # Insert into the main 'orders' table
-            order_insert = orders_table.insert().values(
-                id=order_id,
-                status="received",
-                total=payload.total,
-                shipping_name=payload.shippingDetails.name,
-                shipping_address=payload.shippingDetails.address,
-                shipping_city=payload.shippingDetails.city,
-                shipping_zip=payload.shippingDetails.zip
-            )
-            conn.execute(order_insert)
-            
-            # Prepare items for 'order_items' table
-            items_to_insert = []
-            for item in payload.cart:
-                items_to_insert.append({
-                    "order_id": order_id,
-                    "product_id": item.id,
-                    "product_name": item.name,
-                    "quantity": item.quantity,
-                    "price": item.price
-                })
-            
-            # Insert all items into the 'order_items' table
-            if items_to_insert:
-                conn.execute(order_items_table.insert(), items_to_insert)
-            
-            trans.commit() # Commit all changes
-            print(f"  Order {order_id} saved to database.")
+@app.post("/api/orders", openapi_extra=cart.openapi_body(cart.order_schema))
+async def create_order(request: Request, idempotency_key: Optional[str] = Header(None)):
+    # Size limits first, then one validation pass into cart lines (see cart.py)
+    data = cart.validate(cart.order_schema, await cart.read_body(request, cart.MAX_ORDER_BODY_BYTES))
+    order = cart.to_order(data)
+    # Client retries and double-clicks send the same Idempotency-Key:
+    # the order is placed once and the original response is returned again.
+    if idempotency_key:
+        request_fingerprint = fingerprint(data)
+        return await idempotency_store.run(idempotency_key, request_fingerprint, lambda: place_order(order))
+    return await place_order(order)
 
-        except Exception as e:
-            trans.rollback() # Undo changes if anything failed
-            print(f"  ERROR: Database transaction failed, rolling back. {e}")
-            raise HTTPException(status_code=500, detail="Order processing failed (database error)")
-            
-    # --- 2. Call Inventory Service (NEW) ---
-    # (This happens *after* the order is successfully saved)
+def new_order_id() -> str:
+    # The random suffix keeps IDs unique when several orders arrive in the same second
+    return f"ORD-{int(time.time())}-{uuid.uuid4().hex[:8]}"
+
+def build_order_rows(order_id: str, order: Order):
+    """Returns the 'orders' row and the 'order_items' rows for one order."""
+    shipping = order.shipping
+    order_row = {
+        "id": order_id,
+        "status": "received",
+        "total": order.total,
+        "shipping_name": shipping["name"],
+        "shipping_address": shipping["address"],
+        "shipping_city": shipping["city"],
+        "shipping_zip": shipping["zip"],
+    }
+    items_to_insert = [
+        {"order_id": order_id, "product_id": product_id, "product_name": name, "quantity": quantity, "price": price}
+        for product_id, name, price, quantity in order.cart
+    ]
+    return order_row, items_to_insert
+
+async def call_inventory_service(items) -> bool:
+    """
+    Asks inventory-api to reduce stock of the items (anything with .id and .quantity).
+    Returns False (and logs) if the call failed.
+    """
     try:
-        # Prepare the payload for the inventory service (it only needs id and quantity)
-        inventory_payload = [{"id": item.id, "quantity": item.quantity} for item in payload.cart]
-        
         print(f"  Calling Inventory Service at {INVENTORY_API_URL}...")
         
         # Make the async POST request
-        response = await client.post(INVENTORY_API_URL, json=inventory_payload)
+        if INVENTORY_TRANSPORT == "binary":
+            body = item_codec.encode((item.id, item.quantity) for item in items)
+            headers = {"Content-Type": item_codec.CONTENT_TYPE, "Accept": item_codec.CONTENT_TYPE}
+            response = await client.post(INVENTORY_API_URL, content=body, headers=headers)
+        else:
+            inventory_payload = [{"id": item.id, "quantity": item.quantity} for item in items]
+            response = await client.post(INVENTORY_API_URL, json=inventory_payload)
         
         # Check if the inventory service call was successful
         response.raise_for_status() # Raises an exception for 4xx or 5xx status codes
         
-        print(f"  Inventory service responded: {response.json()}")
+        if INVENTORY_TRANSPORT == "binary" and item_codec.is_binary(response.headers.get("content-type")):
+            print(f"  Inventory service updated {len(item_codec.decode(response.content))} items.")
+        else:
+            print(f"  Inventory service responded: {response.json()}")
+        return True
 
     except httpx.RequestError as e:
         # This catches connection errors (e.g., inventory-api is down)
@@ -144,21 +226,228 @@ async def create_order(payload: OrderPayload):
         # This catches 4xx/5xx errors from the inventory service
         print(f"  ERROR: Inventory Service returned an error: {e.response.status_code} - {e.response.text}")
 
+    except ValueError as e:
+        # A cart the binary encoding can't carry, or a malformed binary response
+        print(f"  ERROR: Inventory Service payload could not be encoded or decoded. {e}")
+
+    return False
+
+async def place_order(payload: Order):
+    
+    order_id = new_order_id()
+
+    # --- 0. Price the cart server-side (client prices are not trusted) ---
+    try:
+        payload = await pricing.reprice_order(price_cache, client, payload)
+    except PricingError as e:
+        raise HTTPException(status_code=e.status_code, detail={"message": str(e), "items": e.details})
+    
+    print("\n--- [Orders Service] ---")
+    print("Received new order:")
+    print(f"  User: {payload.shipping['name']}")
+    print(f"  Items: {len(payload.cart)}")
+    print(f"  Total: ${payload.total:.2f}")
+
+    # --- 1. Save to Database (NEW), on the order's shard ---
+    order_entry = build_order_rows(order_id, payload)
+    shard_engine = router.engine_for(order_id)
+    try:
+        if group_commit.ORDER_GROUP_COMMIT:
+            # Committed with the other orders placed in the same window (see group_commit.py)
+            await order_writer.submit(shard_engine, order_entry)
+        else:
+            with shard_engine.begin() as conn:
+                write_orders(conn, [order_entry])
+        print(f"  Order {order_id} saved to database.")
+
+    except Exception as e:
+        print(f"  ERROR: Database transaction failed, rolling back. {e}")
+        raise HTTPException(status_code=500, detail="Order processing failed (database error)")
+            
+    # --- 2. Call Inventory Service (NEW) ---
+    # (This happens *after* the order is successfully saved)
+    if pipeline.ORDER_PIPELINE_ENABLED:
+        # The pipeline workers reserve and confirm the stock
+        order_pipeline.notify()
+    else:
+        # The cart lines carry the id and quantity inventory-api needs
+        await call_inventory_service(payload.cart)
+
     print("--- [End Order] ---")
     
     # Return a success response to the frontend
     return {"orderId": order_id, "status": "received", "total": payload.total}
 
 
+def validate_batch_order(order: Order) -> Optional[str]:
+    """Checks the batch rules the schema can't express. Returns an error or None."""
+    # Quantities and prices are checked by the cart schema (see cart.py)
+    if not order.cart:
+        return "cart is empty"
+    return None
+
+# Hot-path statements, built once (see query_cache.py)
+insert_order = orders_table.insert()
+insert_order_item = order_items_table.insert()
+select_order = orders_table.select().where(orders_table.c.id == bindparam("order_id"))
+select_order_items = (
+    order_items_table.select().where(order_items_table.c.order_id == bindparam("order_id")).order_by(order_items_table.c.id)
+)
+
+def insert_rows(conn, statement, rows: List[Dict[str, Any]]):
+    # executemany of one prebuilt INSERT: the driver sends multi-row INSERT ... VALUES
+    # (...), (...) of ROWS_PER_INSERT rows where it supports it, never one statement per row
+    if rows:
+        conn.execute(statement, rows, execution_options={"insertmanyvalues_page_size": ROWS_PER_INSERT})
+
+def write_orders(conn, built):
+    """Writes (order_row, item_rows) pairs and their sales rollups in the open transaction."""
+    insert_rows(conn, insert_order, [order_row for order_row, _ in built])
+    insert_rows(conn, insert_order_item, [item for _, items_to_insert in built for item in items_to_insert])
+    # Sales rollups move with the orders (see rollups.py)
+    rollups.record_orders(conn, built)
+    if pipeline.ORDER_PIPELINE_ENABLED:
+        pipeline.enqueue(conn, [order_row["id"] for order_row, _ in built])
+
+# Opt-in group commit of concurrent single orders (ORDER_GROUP_COMMIT)
+order_writer = GroupCommitter(write_orders)
+
+@app.post("/api/orders/batch", openapi_extra=cart.openapi_body(cart.batch_schema))
+async def create_orders_batch(request: Request):
+    """
+    Bulk submission for B2B customers: every order is validated on its own, the valid
+    ones are written with multi-row INSERTs (BATCH_ORDERS_PER_TRANSACTION per transaction)
+    and inventory-api gets ONE call with the quantities of the whole batch.
+    """
+    data = cart.validate(cart.batch_schema, await cart.read_body(request, cart.MAX_BATCH_BODY_BYTES))
+    orders = [cart.to_order(order) for order in data["orders"]]
+
+    print("\n--- [Orders Service] ---")
+    print(f"Received batch of {len(orders)} orders.")
+
+    results: List[Dict[str, Any]] = [None] * len(orders)
+    accepted = []
+    for index, order in enumerate(orders):
+        error = validate_batch_order(order)
+        if not error:
+            try:
+                order = await pricing.reprice_order(price_cache, client, order)
+            except PricingError as e:
+                error = str(e)
+        if error:
+            results[index] = {"index": index, "status": "rejected", "error": error}
+        else:
+            accepted.append((index, new_order_id(), order))
+
+    # --- 1. Save to Database, a chunk of orders per transaction ---
+    saved = []
+    for start in range(0, len(accepted), BATCH_ORDERS_PER_TRANSACTION):
+        chunk = accepted[start:start + BATCH_ORDERS_PER_TRANSACTION]
+        # One transaction per shard the chunk's orders hash to
+        for shard_engine, shard_chunk in router.split(chunk, lambda entry: entry[1]):
+            built = [build_order_rows(order_id, order) for _, order_id, order in shard_chunk]
+            try:
+                with shard_engine.begin() as conn:
+                    write_orders(conn, built)
+            except Exception as e:
+                print(f"  ERROR: Database transaction failed for {len(shard_chunk)} orders, rolling back. {e}")
+                for index, _, _ in shard_chunk:
+                    results[index] = {"index": index, "status": "failed", "error": "database error"}
+                continue
+            for index, order_id, order in shard_chunk:
+                results[index] = {"index": index, "status": "received", "orderId": order_id, "total": order.total}
+            saved.extend(shard_chunk)
+    print(f"  {len(saved)} orders saved to database.")
+
+    # --- 2. Call Inventory Service once for the whole batch ---
+    inventory_updated = False
+    if saved and pipeline.ORDER_PIPELINE_ENABLED:
+        order_pipeline.notify()
+    elif saved:
+        quantities: Dict[str, int] = {}
+        for _, _, order in saved:
+            for item in order.cart:
+                quantities[item.id] = quantities.get(item.id, 0) + item.quantity
+        inventory_items = [item_codec.Item(product_id, quantity) for product_id, quantity in quantities.items()]
+        inventory_updated = await call_inventory_service(inventory_items)
+
+    print("--- [End Batch] ---")
+    statuses = [result["status"] for result in results]
+    return {
+        "received": statuses.count("received"),
+        "rejected": statuses.count("rejected"),
+        "failed": statuses.count("failed"),
+        "inventoryUpdated": inventory_updated,
+        "orders": results,
+    }
+
+
+# --- Sales reports (served from the rollup tables, see rollups.py) ---
+@app.get("/api/orders/stats")
+async def get_order_stats(days: int = Query(7, ge=1, le=rollups.ROLLUP_MAX_DAYS)):
+    """Orders and revenue per day for the last `days` days, split by order status."""
+    per_day = rollups.merge_daily_stats(await router.gather(rollups.daily_stats, days))
+    return {
+        "days": days,
+        "orders": sum(day["orders"] for day in per_day),
+        "revenue": round(sum(day["revenue"] for day in per_day), 2),
+        "perDay": per_day,
+    }
+
+@app.get("/api/orders/stats/top-products")
+async def get_top_products(
+    days: int = Query(7, ge=1, le=rollups.ROLLUP_MAX_DAYS),
+    limit: int = Query(10, ge=1, le=100),
+    by: str = Query("units", pattern="^(units|revenue)$"),
+):
+    """Best sellers over the last `days` days, ranked by units sold or revenue."""
+    if len(router.engines) == 1:
+        with router.engines[0].connect() as conn:
+            products = rollups.top_products(conn, days, limit, by)
+    else:
+        # A shard's top N isn't enough to rank globally, merge the full rankings
+        products = rollups.merge_top_products(await router.gather(rollups.top_products, days, None, by), limit, by)
+    return {"days": days, "by": by, "products": products}
+
+
 @app.get("/api/orders")
-async def get_all_orders():
+async def get_all_orders(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    before: Optional[str] = None,
+):
     """
     A simple endpoint to check all orders that have been
-    placed (for debugging).
+    placed (for debugging). Newest first; with ?limit= the page is cut there and
+    X-Next-Cursor holds the ?before= value for the next page.
     """
-    with engine.connect() as conn:
-        # Query the 'orders' table
-        query = orders_table.select().order_by(orders_table.c.id.desc())
-        result = conn.execute(query).fetchall()
-        orders = [dict(row._asdict()) for row in result]
-        return orders
\ No newline at end of file
+    # Every shard returns its own newest-first page, merged by order ID
+    orders = sharding.merge_orders(await router.gather(sharding.list_orders, limit, before), limit)
+    if limit is not None and len(orders) == limit:
+        response.headers["X-Next-Cursor"] = orders[-1]["id"]
+    return orders
+
+def find_order(conn, order_id: str):
+    order = conn.execute(select_order, {"order_id": order_id}).first()
+    if order is None:
+        return None
+    items = conn.execute(select_order_items, {"order_id": order_id})
+    return {**order._asdict(), "items": [item._asdict() for item in items], "archived": False}
+
+@app.get("/api/orders/{order_id}")
+async def get_order(order_id: str):
+    """One order with its items, read through to the cold archive once it has been moved."""
+    with router.engine_for(order_id).connect() as conn:
+        order = find_order(conn, order_id)
+    if order is None and router.may_be_elsewhere(order_id):
+        # Placed before the current shard layout and not moved to its shard yet
+        order = next((found for found in await router.gather(find_order, order_id) if found), None)
+    if order is not None:
+        return order
+
+    # Orders older than ARCHIVE_AFTER_DAYS live in compressed files (see archive.py)
+    if archive.archive_reader is not None:
+        archived = await run_in_threadpool(archive.archive_reader.lookup, order_id)
+        if archived is not None:
+            return {**archived, "archived": True}
+    raise HTTPException(status_code=404, detail=f"Order {order_id} not found")
@@ -0,0 +1,40 @@
+"""
+Prometheus metrics for GET /metrics, in the text exposition format.
+
+Modules register a collector: a function returning (name, type, help, samples) tuples,
+where samples is a list of (labels dict, value). Collectors run on every scrape, so
+they report the live counters the modules already keep (no extra work on requests).
+
+This file is identical in every service (each service is its own image).
+"""
+from typing import Callable, Dict, Iterable, List, Tuple
+
+Sample = Tuple[Dict[str, str], float]
+Metric = Tuple[str, str, str, List[Sample]]
+
+_collectors: List[Callable[[], Iterable[Metric]]] = []
+
+
+def register(collector: Callable[[], Iterable[Metric]]):
+    _collectors.append(collector)
+    return collector
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in sorted(labels.items()):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def render() -> str:
+    lines = []
+    for collector in _collectors:
+        for name, metric_type, help_text, samples in collector():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.extend(f"{name}{_labels(labels)} {value}" for labels, value in samples)
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,293 @@
+"""
+Asynchronous order status pipeline (opt-in, ORDER_PIPELINE_ENABLED=true).
+
+Orders used to stay "received" forever, with the inventory call made inline in
+create_order. With the pipeline, create_order only writes the order (and a row in the
+order_pipeline work queue, in the same transaction) and a pool of ORDER_PIPELINE_WORKERS
+async workers moves it through the stages:
+
+    received --reserve--> reserved --confirm--> confirmed --fulfill--> fulfilled
+    (any stage, on a permanent error or too many retries) --> failed
+
+- reserve: POST <INVENTORY_RESERVATIONS_URL> holds the items; out of stock (409) fails the order.
+  The order ID is sent as the Idempotency-Key, so a retry gets the same hold back.
+- confirm: POST <INVENTORY_RESERVATIONS_URL>/{id}/confirm turns the hold into a sale
+  (a retried confirm of a sold hold succeeds without selling twice).
+- fulfill: hand-off point for fulfillment and notifications (nothing downstream yet).
+
+Workers claim ORDER_PIPELINE_BATCH_SIZE orders at a time. On Postgres the claim is a
+SELECT ... FOR UPDATE SKIP LOCKED, so workers in every pod claim disjoint batches without
+waiting on each other. Every claim is a lease: the rows are stamped with the worker's
+token and hidden for ORDER_PIPELINE_LEASE_SECONDS, so the orders of a worker that dies
+are picked up again. The stamp is a conditional UPDATE, which also makes claims safe on
+SQLite (no SKIP LOCKED there; workers just poll).
+
+Workers sleep ORDER_PIPELINE_POLL_SECONDS when the queue is empty and are woken at once
+by orders placed on their own pod. A failed stage is retried with exponential backoff up
+to ORDER_PIPELINE_MAX_ATTEMPTS times, then the order fails (releasing any stock hold).
+A worker whose lease ran out drops the hold it made if the order has already left the
+pipeline; otherwise the worker that took over uses the same hold.
+
+Per-stage latency (time spent in each stage), transitions and retries are exported
+on GET /metrics.
+"""
+import asyncio
+import os
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+import httpx
+from sqlalchemy import delete, select, update
+from starlette.concurrency import run_in_threadpool
+
+import metrics
+import rollups
+from database import orders_table, order_items_table, order_pipeline_table
+from sharding import router
+
+ORDER_PIPELINE_ENABLED = os.getenv("ORDER_PIPELINE_ENABLED", "false").lower() == "true"
+ORDER_PIPELINE_WORKERS = int(os.getenv("ORDER_PIPELINE_WORKERS", "4"))
+ORDER_PIPELINE_BATCH_SIZE = int(os.getenv("ORDER_PIPELINE_BATCH_SIZE", "20"))
+ORDER_PIPELINE_POLL_SECONDS = float(os.getenv("ORDER_PIPELINE_POLL_SECONDS", "1"))
+ORDER_PIPELINE_LEASE_SECONDS = float(os.getenv("ORDER_PIPELINE_LEASE_SECONDS", "30"))
+ORDER_PIPELINE_MAX_ATTEMPTS = int(os.getenv("ORDER_PIPELINE_MAX_ATTEMPTS", "5"))
+ORDER_PIPELINE_RETRY_SECONDS = float(os.getenv("ORDER_PIPELINE_RETRY_SECONDS", "2"))
+INVENTORY_RESERVATIONS_URL = os.getenv("INVENTORY_RESERVATIONS_URL", "http://localhost:8002/api/inventory/reservations")
+
+RECEIVED, RESERVED, CONFIRMED, FULFILLED, FAILED = "received", "reserved", "confirmed", "fulfilled", "failed"
+NEXT_STAGE = {RECEIVED: RESERVED, RESERVED: CONFIRMED, CONFIRMED: FULFILLED}
+
+_pipelines: List["OrderPipeline"] = []
+
+
+class StageFailed(Exception):
+    """The order can't go on (out of stock, hold expired): fail it without retrying."""
+
+
+def enqueue(conn, order_ids: List[str], now: Optional[float] = None):
+    """Queues new orders; call it in the transaction that inserts them."""
+    now = time.time() if now is None else now
+    if order_ids:
+        conn.execute(order_pipeline_table.insert(), [
+            {"order_id": order_id, "stage": RECEIVED, "attempts": 0, "available_at": now, "entered_at": now}
+            for order_id in order_ids
+        ])
+
+
+def claim(engine, batch_size: int, lease_seconds: float, now: Optional[float] = None) -> List[Dict[str, Any]]:
+    """Leases up to batch_size claimable orders of one shard, with their totals and items."""
+    now = time.time() if now is None else now
+    queue = order_pipeline_table.c
+    token = uuid.uuid4().hex
+    with engine.begin() as conn:
+        candidates = select(queue.order_id).where(queue.available_at <= now).order_by(queue.available_at).limit(batch_size)
+        if conn.dialect.name == "postgresql":
+            candidates = candidates.with_for_update(skip_locked=True)
+        order_ids = list(conn.execute(candidates).scalars())
+        if not order_ids:
+            return []
+        # Only rows still claimable are stamped, so two claimers never share an order
+        conn.execute(
+            update(order_pipeline_table)
+            .where(queue.order_id.in_(order_ids), queue.available_at <= now)
+            .values(available_at=now + lease_seconds, claim_token=token)
+        )
+        jobs = [
+            dict(row._mapping) for row in conn.execute(
+                select(order_pipeline_table, orders_table.c.total)
+                .join(orders_table, orders_table.c.id == queue.order_id)
+                .where(queue.claim_token == token)
+            )
+        ]
+        items: Dict[str, List[Dict[str, Any]]] = {job["order_id"]: [] for job in jobs}
+        for row in conn.execute(select(order_items_table).where(order_items_table.c.order_id.in_(list(items)))):
+            items[row.order_id].append({"id": row.product_id, "quantity": row.quantity})
+    for job in jobs:
+        job["items"] = items[job["order_id"]]
+    return jobs
+
+
+def advance(engine, job: Dict[str, Any], new_stage: str, updates: Dict[str, Any], now: Optional[float] = None) -> bool:
+    """
+    Moves a claimed order to new_stage (orders.status, rollups and the queue row together).
+    Returns False if the lease was lost to another worker in the meantime.
+    """
+    now = time.time() if now is None else now
+    queue = order_pipeline_table.c
+    mine = (queue.order_id == job["order_id"]) & (queue.claim_token == job["claim_token"])
+    with engine.begin() as conn:
+        if new_stage in (FULFILLED, FAILED):
+            statement = delete(order_pipeline_table).where(mine)
+        else:
+            statement = update(order_pipeline_table).where(mine).values(
+                stage=new_stage, attempts=0, available_at=now, claim_token=None, entered_at=now, **updates)
+        if not conn.execute(statement).rowcount:
+            return False
+        conn.execute(update(orders_table).where(orders_table.c.id == job["order_id"]).values(status=new_stage))
+        rollups.record_status_change(conn, job["order_id"], job["total"] or 0, job["stage"], new_stage)
+    return True
+
+
+def in_pipeline(engine, order_id: str) -> bool:
+    """Whether the order is still queued (not fulfilled or failed yet)."""
+    with engine.connect() as conn:
+        return conn.execute(
+            select(order_pipeline_table.c.order_id).where(order_pipeline_table.c.order_id == order_id)
+        ).first() is not None
+
+
+def retry_later(engine, job: Dict[str, Any], retry_seconds: float, now: Optional[float] = None):
+    """Gives the lease back, claimable again after an exponential backoff."""
+    now = time.time() if now is None else now
+    queue = order_pipeline_table.c
+    with engine.begin() as conn:
+        conn.execute(
+            update(order_pipeline_table)
+            .where((queue.order_id == job["order_id"]) & (queue.claim_token == job["claim_token"]))
+            .values(attempts=job["attempts"] + 1, claim_token=None,
+                    available_at=now + retry_seconds * 2 ** job["attempts"])
+        )
+
+
+# --- Stage handlers (return the queue columns to update) ---
+
+async def reserve(client: httpx.AsyncClient, job: Dict[str, Any]) -> Dict[str, Any]:
+    if not job["items"]:
+        return {}
+    response = await client.post(INVENTORY_RESERVATIONS_URL, json={"items": job["items"]},
+                                 headers={"Idempotency-Key": job["order_id"]})
+    if response.status_code == 409:
+        raise StageFailed(f"out of stock: {response.json().get('detail')}")
+    response.raise_for_status()
+    return {"reservation_id": response.json()["reservation_id"]}
+
+
+async def confirm(client: httpx.AsyncClient, job: Dict[str, Any]) -> Dict[str, Any]:
+    if job["reservation_id"] is None:
+        return {}
+    response = await client.post(f"{INVENTORY_RESERVATIONS_URL}/{job['reservation_id']}/confirm")
+    if response.status_code == 404:
+        raise StageFailed("stock reservation expired before it was confirmed")
+    response.raise_for_status()
+    return {}
+
+
+async def fulfill(client: httpx.AsyncClient, job: Dict[str, Any]) -> Dict[str, Any]:
+    # Hand-off point for fulfillment and customer notifications
+    print(f"  [Pipeline] Order {job['order_id']} handed off for fulfillment.")
+    return {}
+
+
+HANDLERS = {RECEIVED: reserve, RESERVED: confirm, CONFIRMED: fulfill}
+
+
+async def release(client: httpx.AsyncClient, job: Dict[str, Any]):
+    """Best effort: an unreleased hold expires on its own."""
+    if job.get("reservation_id"):
+        try:
+            await client.delete(f"{INVENTORY_RESERVATIONS_URL}/{job['reservation_id']}")
+        except httpx.HTTPError as e:
+            print(f"  [Pipeline] Could not release reservation {job['reservation_id']}: {e}")
+
+
+# --- Worker pool ---
+
+class OrderPipeline:
+    def __init__(self, client: httpx.AsyncClient, workers: int = ORDER_PIPELINE_WORKERS,
+                 batch_size: int = ORDER_PIPELINE_BATCH_SIZE, lease_seconds: float = ORDER_PIPELINE_LEASE_SECONDS,
+                 max_attempts: int = ORDER_PIPELINE_MAX_ATTEMPTS, retry_seconds: float = ORDER_PIPELINE_RETRY_SECONDS):
+        self.client = client
+        self.workers = workers
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.wake = asyncio.Event()
+        self.stats = {"claimed": 0, "retries": 0, "lost_leases": 0}
+        self.transitions: Dict[tuple, int] = {}
+        self.stage_seconds: Dict[str, float] = {}
+        _pipelines.append(self)
+
+    def notify(self):
+        """New orders were queued on this pod."""
+        self.wake.set()
+
+    async def process(self, engine, job: Dict[str, Any]):
+        stage = job["stage"]
+        try:
+            updates = await HANDLERS[stage](self.client, job)
+            new_stage = NEXT_STAGE[stage]
+        except StageFailed as e:
+            print(f"  [Pipeline] Order {job['order_id']} failed at {stage}: {e}")
+            updates, new_stage = {}, FAILED
+        except Exception as e:
+            if job["attempts"] + 1 < self.max_attempts:
+                self.stats["retries"] += 1
+                await run_in_threadpool(retry_later, engine, job, self.retry_seconds)
+                return
+            print(f"  [Pipeline] Order {job['order_id']} failed at {stage} after {self.max_attempts} attempts: {e}")
+            updates, new_stage = {}, FAILED
+
+        if new_stage == FAILED:
+            await release(self.client, job)
+        if not await run_in_threadpool(advance, engine, job, new_stage, updates):
+            self.stats["lost_leases"] += 1
+            if new_stage != FAILED and not await run_in_threadpool(in_pipeline, engine, job["order_id"]):
+                # Finished by the worker that took the lease over: a hold made since is left over
+                await release(self.client, {**job, **updates})
+            return
+        self.transitions[(stage, new_stage)] = self.transitions.get((stage, new_stage), 0) + 1
+        self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + time.time() - job["entered_at"]
+
+    async def run_once(self) -> int:
+        """Claims and processes one batch per shard. Returns the number of orders processed."""
+        processed = 0
+        for engine in router.engines:
+            jobs = await run_in_threadpool(claim, engine, self.batch_size, self.lease_seconds)
+            self.stats["claimed"] += len(jobs)
+            for job in jobs:
+                await self.process(engine, job)
+            processed += len(jobs)
+        return processed
+
+    async def _worker(self):
+        while True:
+            try:
+                processed = await self.run_once()
+            except Exception as e:
+                print(f"  [Pipeline] Worker error: {e}")
+                processed = 0
+            if not processed:
+                try:
+                    await asyncio.wait_for(self.wake.wait(), ORDER_PIPELINE_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                self.wake.clear()
+
+    async def run(self):
+        await asyncio.gather(*(self._worker() for _ in range(self.workers)))
+
+
+@metrics.register
+def _collect():
+    transitions: Dict[tuple, int] = {}
+    stage_seconds: Dict[str, float] = {}
+    for pipeline in _pipelines:
+        for key, count in pipeline.transitions.items():
+            transitions[key] = transitions.get(key, 0) + count
+        for stage, seconds in pipeline.stage_seconds.items():
+            stage_seconds[stage] = stage_seconds.get(stage, 0.0) + seconds
+    yield "order_pipeline_transitions_total", "counter", "Orders moved from one stage to the next", [
+        ({"from": stage, "to": new_stage}, count) for (stage, new_stage), count in sorted(transitions.items())
+    ]
+    # Average time in a stage = rate(seconds_total) / rate(transitions out of it)
+    yield "order_pipeline_stage_seconds_total", "counter", "Seconds orders spent in each stage before leaving it", [
+        ({"stage": stage}, round(seconds, 6)) for stage, seconds in sorted(stage_seconds.items())
+    ]
+    for stat, help_text in (
+        ("claimed", "Orders claimed by pipeline workers"),
+        ("retries", "Stage attempts that failed and were scheduled again"),
+        ("lost_leases", "Orders whose lease expired before the worker finished them"),
+    ):
+        yield f"order_pipeline_{stat}_total", "counter", help_text, [({}, sum(p.stats[stat] for p in _pipelines))]
@@ -0,0 +1,165 @@
+"""
+Server-side cart pricing.
+
+Orders used to store whatever price and total the browser sent. Now every order is
+repriced from a local price cache that is loaded in bulk (one request to products-api,
+or one query on the products table) and refreshed periodically, so checkout never
+makes a per-item network call.
+
+All arithmetic is in integer cents. The total mirrors the checkout page:
+subtotal + tax (ORDER_TAX_RATE, rounded half-up) + shipping (ORDER_SHIPPING_FEE_CENTS).
+
+If the cache has never loaded (products-api down since startup), an order tries a load
+itself, at most every MIN_REFRESH_INTERVAL_SECONDS, and is refused with 503 until one
+succeeds. PRICE_UNAVAILABLE_POLICY=client keeps the client prices instead.
+"""
+import os
+import time
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Dict, List, Optional
+
+from sqlalchemy import column, select, table
+
+from cart import CartLine
+from database import engine
+
+PRODUCTS_API_URL = os.getenv("PRODUCTS_API_URL", "http://localhost:8000/api/products")
+# "api" loads prices from products-api, "db" reads the products table directly
+PRICE_SOURCE = os.getenv("PRICE_SOURCE", "api")
+PRICE_CACHE_REFRESH_SECONDS = float(os.getenv("PRICE_CACHE_REFRESH_SECONDS", "60"))
+# "correct" stores the server prices, "reject" refuses orders whose prices don't match
+PRICE_MISMATCH_POLICY = os.getenv("PRICE_MISMATCH_POLICY", "correct")
+# "reject" refuses orders (503) while no prices were ever loaded, "client" (opt-in) stores the client prices
+PRICE_UNAVAILABLE_POLICY = os.getenv("PRICE_UNAVAILABLE_POLICY", "reject")
+ORDER_TAX_RATE = Decimal(os.getenv("ORDER_TAX_RATE", "0.08"))
+ORDER_SHIPPING_FEE_CENTS = int(os.getenv("ORDER_SHIPPING_FEE_CENTS", "999"))
+# The browser computes totals in floating point, allow it to be off by a cent
+TOTAL_TOLERANCE_CENTS = 1
+# Unknown IDs trigger an early refresh, at most this often
+MIN_REFRESH_INTERVAL_SECONDS = 5.0
+
+# Read-only view of the products table (owned by products-api, never created here)
+products_prices = table("products", column("id"), column("price"))
+
+
+def to_cents(amount) -> int:
+    return int((Decimal(str(amount)) * 100).quantize(Decimal("1"), rounding=ROUND_HALF_UP))
+
+
+def from_cents(cents: int) -> float:
+    return cents / 100
+
+
+class PricingError(Exception):
+    """The cart can't be priced (unknown products) or doesn't match the server prices."""
+
+    def __init__(self, message: str, status_code: int, details: Optional[List[dict]] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.details = details or []
+
+
+class PriceCache:
+    def __init__(self):
+        self.prices: Dict[str, int] = {}
+        self.loaded_at: Optional[float] = None
+        self.attempted_at: Optional[float] = None
+
+    @property
+    def is_loaded(self) -> bool:
+        return self.loaded_at is not None
+
+    def load(self, products):
+        """Replaces the cache with (id, price) pairs in one go."""
+        self.prices = {str(product_id): to_cents(price) for product_id, price in products if price is not None}
+        self.loaded_at = time.time()
+
+    async def refresh(self, http_client):
+        if PRICE_SOURCE == "db":
+            with engine.connect() as conn:
+                self.load(conn.execute(select(products_prices.c.id, products_prices.c.price)).fetchall())
+        else:
+            response = await http_client.get(PRODUCTS_API_URL)
+            response.raise_for_status()
+            self.load((product["id"], product["price"]) for product in response.json())
+        print(f"  Price cache refreshed: {len(self.prices)} products.")
+
+    async def refresh_if_stale(self, http_client, min_age: float = MIN_REFRESH_INTERVAL_SECONDS) -> bool:
+        # Failed attempts count too, so an outage doesn't turn every order into a refresh
+        last = max((at for at in (self.loaded_at, self.attempted_at) if at is not None), default=None)
+        now = time.time()
+        if last is not None and now - last < min_age:
+            return False
+        self.attempted_at = now
+        try:
+            await self.refresh(http_client)
+            return True
+        except Exception as e:
+            print(f"  ERROR: Could not refresh price cache. {e}")
+            return False
+
+
+def price_cart(prices: Dict[str, int], cart) -> dict:
+    """
+    Prices cart lines (anything with .id, .price and .quantity) from the cache.
+    Returns unit prices, subtotal, tax, shipping and total in cents, plus mismatches.
+    Raises PricingError for products the cache doesn't know.
+    """
+    unknown = [item.id for item in cart if item.id not in prices]
+    if unknown:
+        raise PricingError("Unknown products in cart", 400, [{"id": product_id} for product_id in unknown])
+
+    unit_cents = [prices[item.id] for item in cart]
+    subtotal = sum(cents * item.quantity for cents, item in zip(unit_cents, cart))
+    tax = int((Decimal(subtotal) * ORDER_TAX_RATE).quantize(Decimal("1"), rounding=ROUND_HALF_UP))
+    shipping = ORDER_SHIPPING_FEE_CENTS if cart else 0
+    mismatches = [
+        {"id": item.id, "price": item.price, "expected": from_cents(cents)}
+        for cents, item in zip(unit_cents, cart)
+        if to_cents(item.price) != cents
+    ]
+    return {
+        "unit_cents": unit_cents,
+        "subtotal_cents": subtotal,
+        "tax_cents": tax,
+        "shipping_cents": shipping,
+        "total_cents": subtotal + tax + shipping,
+        "mismatches": mismatches,
+    }
+
+
+async def reprice_order(cache: PriceCache, http_client, payload):
+    """
+    Returns the order (a cart.Order) with server prices and total.
+    Raises PricingError for unknown products, for mismatches under the "reject" policy,
+    and (503) while no prices could ever be loaded, unless PRICE_UNAVAILABLE_POLICY=client.
+    """
+    if not cache.is_loaded:
+        # Don't wait for the background refresh, products-api may be back
+        await cache.refresh_if_stale(http_client)
+    if not cache.is_loaded:
+        if PRICE_UNAVAILABLE_POLICY == "client":
+            print("  WARNING: Price cache unavailable, keeping client prices.")
+            return payload
+        raise PricingError("Prices are unavailable, try again shortly", 503)
+
+    try:
+        priced = price_cart(cache.prices, payload.cart)
+    except PricingError:
+        # Maybe a product added since the last refresh
+        if not await cache.refresh_if_stale(http_client):
+            raise
+        priced = price_cart(cache.prices, payload.cart)
+
+    total_off = abs(to_cents(payload.total) - priced["total_cents"]) > TOTAL_TOLERANCE_CENTS
+    if (priced["mismatches"] or total_off) and PRICE_MISMATCH_POLICY == "reject":
+        details = priced["mismatches"] + [{"total": payload.total, "expected": from_cents(priced["total_cents"])}]
+        raise PricingError("Cart prices don't match current prices", 409, details)
+    if priced["mismatches"] or total_off:
+        print(f"  Corrected client prices: total {payload.total} -> {from_cents(priced['total_cents'])}")
+
+    cart = [
+        CartLine(item.id, item.name, from_cents(cents), item.quantity)
+        for item, cents in zip(payload.cart, priced["unit_cents"])
+    ]
+    return payload._replace(cart=cart, total=from_cents(priced["total_cents"]))
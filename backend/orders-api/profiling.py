@@ -0,0 +1,379 @@
+"""
+On-demand profiling for production pods.
+
+Disabled unless PROFILING_TOKEN is set; every use must send it as X-Debug-Token.
+
+- GET /debug/profile?seconds=N samples every thread's stack for N seconds and returns
+  the samples as collapsed stacks ("frame;frame;frame count" lines), the input format of
+  flamegraph.pl, speedscope and inferno. ?format=json also returns a per-request
+  breakdown of the requests served during the window.
+- A request sent with "X-Profile: 1" is profiled on its own: its response carries a
+  Server-Timing header (total, db, serialize and http time) and X-Profile-Id, and
+  GET /debug/profile/requests/{id} returns its collapsed stacks. Only the request's own
+  work is sampled: the event loop while it runs the request's coroutine, and threadpool
+  threads while they run a call made from it (run_in_threadpool, sync endpoints). Tasks
+  the request spawns (a streaming body) are not followed.
+
+Breakdowns come from hooks that are only installed while a profile is running (SQLAlchemy
+cursor events for DB time, FastAPI response serialization, httpx sends), so an idle pod
+pays for one header scan per request and nothing else.
+
+This file is identical in every service (each service is its own image).
+"""
+import asyncio
+import hmac
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from contextvars import ContextVar
+from typing import List, Optional
+
+import anyio.to_thread
+import fastapi.routing
+import httpx
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN", "")
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+PROFILE_INTERVAL_SECONDS = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000
+# Profiled requests kept for GET /debug/profile/requests/{id}
+PROFILE_KEEP_REQUESTS = 20
+MAX_CONCURRENT_REQUEST_PROFILES = 4
+
+# Leaf frames of threads that are just waiting (thread pools, the idle event loop)
+IDLE_FRAMES = {("threading.py", "wait"), ("selectors.py", "select"), ("queue.py", "get")}
+
+
+# --- Sampling profiler ---
+
+class Sampler(threading.Thread):
+    """
+    Samples every other thread's Python stack every `interval` seconds, or with a request's
+    Breakdown only the threads working for that request.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL_SECONDS, request: Optional["Breakdown"] = None):
+        super().__init__(name="profiling-sampler", daemon=True)
+        self.interval = interval
+        self.request = request
+        self.counts: Counter = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        me = threading.get_ident()
+        names = {}
+        while not self.stopped.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                    continue
+                request = self.request
+                mine = request is None or thread_id in request.threads
+                stack = []
+                while frame is not None:
+                    # The request's middleware frame is on the event loop's stack only
+                    # while the loop runs that request's coroutine
+                    mine = mine or frame is request.frame
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if not mine:
+                    continue
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.counts[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self) -> str:
+        self.stopped.set()
+        self.join()
+        return self.collapsed()
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.counts.most_common())
+
+
+# --- Per-request breakdown hooks (installed only while profiling) ---
+
+class Breakdown:
+    __slots__ = ("method", "path", "started", "db", "db_queries", "serialize", "http", "http_calls", "total",
+                 "frame", "threads")
+
+    def __init__(self, method: str, path: str):
+        self.method = method
+        self.path = path
+        self.started = time.perf_counter()
+        self.db = self.serialize = self.http = self.total = 0.0
+        self.db_queries = self.http_calls = 0
+        # Where the request runs, for its Sampler: its middleware frame and its threadpool threads
+        self.frame = None
+        self.threads: set = set()
+
+    def server_timing(self) -> str:
+        return ", ".join(
+            f"{name};dur={seconds * 1000:.1f}"
+            for name, seconds in (("total", self.total), ("db", self.db), ("serialize", self.serialize), ("http", self.http))
+        )
+
+    def as_dict(self) -> dict:
+        return {
+            "method": self.method,
+            "path": self.path,
+            "total_ms": round(self.total * 1000, 2),
+            "db_ms": round(self.db * 1000, 2),
+            "db_queries": self.db_queries,
+            "serialize_ms": round(self.serialize * 1000, 2),
+            "http_ms": round(self.http * 1000, 2),
+            "http_calls": self.http_calls,
+        }
+
+
+current_breakdown: ContextVar[Optional[Breakdown]] = ContextVar("current_breakdown", default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("profiling_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get("profiling_started")
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    breakdown = current_breakdown.get()
+    if breakdown is not None:
+        breakdown.db += elapsed
+        breakdown.db_queries += 1
+
+
+class _Hooks:
+    """Reference-counted install of the timing hooks."""
+
+    def __init__(self):
+        self.users = 0
+        self.lock = threading.Lock()
+        self.originals = {}
+
+    def install(self):
+        with self.lock:
+            self.users += 1
+            if self.users > 1:
+                return
+            event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+            self.originals = {
+                "serialize_response": fastapi.routing.serialize_response,
+                "async_send": httpx.AsyncClient.send,
+                "sync_send": httpx.Client.send,
+                "run_sync": anyio.to_thread.run_sync,
+            }
+            fastapi.routing.serialize_response = _timed_async(self.originals["serialize_response"], "serialize")
+            httpx.AsyncClient.send = _timed_async(self.originals["async_send"], "http")
+            httpx.Client.send = _timed_sync(self.originals["sync_send"], "http")
+            # run_in_threadpool (and sync endpoints) go through anyio.to_thread.run_sync
+            anyio.to_thread.run_sync = _tracked_run_sync(self.originals["run_sync"])
+
+    def uninstall(self):
+        with self.lock:
+            self.users -= 1
+            if self.users > 0:
+                return
+            event.remove(Engine, "before_cursor_execute", _before_cursor_execute)
+            event.remove(Engine, "after_cursor_execute", _after_cursor_execute)
+            fastapi.routing.serialize_response = self.originals["serialize_response"]
+            httpx.AsyncClient.send = self.originals["async_send"]
+            httpx.Client.send = self.originals["sync_send"]
+            anyio.to_thread.run_sync = self.originals["run_sync"]
+
+
+def _record(kind: str, elapsed: float):
+    breakdown = current_breakdown.get()
+    if breakdown is None:
+        return
+    if kind == "http":
+        breakdown.http += elapsed
+        breakdown.http_calls += 1
+    else:
+        breakdown.serialize += elapsed
+
+
+def _timed_async(function, kind: str):
+    async def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        finally:
+            _record(kind, time.perf_counter() - started)
+    return timed
+
+
+def _timed_sync(function, kind: str):
+    def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _record(kind, time.perf_counter() - started)
+    return timed
+
+
+def _tracked_run_sync(run_sync):
+    """Marks the worker thread as the calling request's while it runs the call."""
+    async def tracked(func, *args, **kwargs):
+        breakdown = current_breakdown.get()
+        if breakdown is None:
+            return await run_sync(func, *args, **kwargs)
+
+        def run(*call_args):
+            thread_id = threading.get_ident()
+            breakdown.threads.add(thread_id)
+            try:
+                return func(*call_args)
+            finally:
+                breakdown.threads.discard(thread_id)
+        return await run_sync(run, *args, **kwargs)
+    return tracked
+
+
+hooks = _Hooks()
+
+
+# --- Profiling state ---
+
+class _Window:
+    def __init__(self):
+        self.requests: List[dict] = []
+
+
+class Profiler:
+    def __init__(self):
+        self.window: Optional[_Window] = None
+        self.request_profiles: "OrderedDict[str, str]" = OrderedDict()
+        self.active_request_profiles = 0
+
+    async def profile_window(self, seconds: float) -> dict:
+        if self.window is not None:
+            raise HTTPException(status_code=409, detail="A profile is already running")
+        self.window = window = _Window()
+        sampler = Sampler()
+        hooks.install()
+        sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            stacks = sampler.stop()
+            hooks.uninstall()
+            self.window = None
+        return {"seconds": seconds, "samples": sampler.samples, "stacks": stacks, "requests": window.requests}
+
+    def keep_request_profile(self, profile_id: str, stacks: str):
+        self.request_profiles[profile_id] = stacks
+        while len(self.request_profiles) > PROFILE_KEEP_REQUESTS:
+            self.request_profiles.popitem(last=False)
+
+
+profiler = Profiler()
+
+
+def _authorized(token: Optional[str]) -> bool:
+    return bool(PROFILING_TOKEN) and token is not None and hmac.compare_digest(token, PROFILING_TOKEN)
+
+
+class ProfilingMiddleware:
+    """Pure ASGI middleware; does nothing unless a window is open or the request asks."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        window = profiler.window
+        wants_profile = False
+        if PROFILING_TOKEN:
+            headers = dict(scope["headers"])
+            wants_profile = b"x-profile" in headers and _authorized(headers.get(b"x-debug-token", b"").decode("latin-1"))
+        if window is None and not wants_profile:
+            return await self.app(scope, receive, send)
+
+        breakdown = Breakdown(scope["method"], scope["path"])
+        token = current_breakdown.set(breakdown)
+        sampler = None
+        if wants_profile:
+            hooks.install()
+            if profiler.active_request_profiles < MAX_CONCURRENT_REQUEST_PROFILES:
+                profiler.active_request_profiles += 1
+                breakdown.frame = sys._getframe()
+                sampler = Sampler(request=breakdown)
+                sampler.start()
+        profile_id = uuid.uuid4().hex[:12] if sampler is not None else None
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start" and wants_profile:
+                breakdown.total = time.perf_counter() - breakdown.started
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", breakdown.server_timing().encode("latin-1")))
+                if profile_id is not None:
+                    headers.append((b"x-profile-id", profile_id.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            breakdown.total = time.perf_counter() - breakdown.started
+            current_breakdown.reset(token)
+            if window is not None:
+                window.requests.append(breakdown.as_dict())
+            if wants_profile:
+                hooks.uninstall()
+            if sampler is not None:
+                profiler.active_request_profiles -= 1
+                profiler.keep_request_profile(profile_id, sampler.stop())
+
+
+# --- /debug/profile endpoints ---
+
+router = APIRouter()
+
+
+def _check_token(token: Optional[str]):
+    if not PROFILING_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not _authorized(token):
+        raise HTTPException(status_code=403, detail="Invalid debug token")
+
+
+@router.get("/debug/profile")
+async def profile(seconds: float = 10, format: str = "collapsed", x_debug_token: Optional[str] = Header(None)):
+    _check_token(x_debug_token)
+    seconds = max(0.1, min(seconds, PROFILE_MAX_SECONDS))
+    result = await profiler.profile_window(seconds)
+    if format == "json":
+        return JSONResponse(result)
+    return PlainTextResponse(result["stacks"])
+
+
+@router.get("/debug/profile/requests/{profile_id}")
+async def request_profile(profile_id: str, x_debug_token: Optional[str] = Header(None)):
+    _check_token(x_debug_token)
+    stacks = profiler.request_profiles.get(profile_id)
+    if stacks is None:
+        raise HTTPException(status_code=404, detail=f"Profile {profile_id} not found")
+    return PlainTextResponse(stacks)
+
+
+def install(app):
+    """Adds the middleware (outermost, so timings include admission) and the endpoints."""
+    app.add_middleware(ProfilingMiddleware)
+    app.include_router(router)
@@ -0,0 +1,280 @@
+"""
+Incremental sales rollups.
+
+"Best sellers this week" and "revenue per day" used to mean a full scan of order_items
+joined to orders. Now every order adds its counts to two small tables in the same
+transaction that inserts it:
+
+- sales_by_product_day: units, revenue and orders per (day, product)
+- orders_by_status_day: orders and revenue per (day, status)
+
+so GET /api/orders/stats and GET /api/orders/stats/top-products read at most
+ROLLUP_MAX_DAYS days of rollup rows, however long the order history is.
+
+The increments are one INSERT ... ON CONFLICT DO UPDATE per table, with the rows sorted
+by key so concurrent orders for the same products always lock them in the same order.
+The day is the UTC date in the order ID (ORD-<epoch>-...), so a status change lands on
+the day the order was placed.
+
+Existing history (or a drifted rollup) is rebuilt with:
+
+    python rollups.py --rebuild
+
+Archived orders (see archive.py) are no longer in the hot tables, so with ARCHIVE_URL set
+(or --archive-url) the rebuild keeps the rollups of every day up to the last archived one
+and recomputes only the days after it.
+"""
+import argparse
+import os
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from database import orders_table, order_items_table, sales_by_product_day_table, orders_by_status_day_table
+from pricing import from_cents, to_cents
+
+ROLLUP_MAX_DAYS = 366
+REBUILD_FETCH_ROWS = 10000
+
+_dialect_inserts = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+# Upsert statements, built once per (dialect, table, counters) (see query_cache.py)
+_upserts: Dict[Tuple[str, str, Tuple[str, ...]], Any] = {}
+
+
+def order_day(order_id: str, now: Optional[float] = None) -> str:
+    """UTC date (YYYY-MM-DD) the order was placed, read from its ID."""
+    try:
+        placed_at = float(order_id.split("-")[1])
+    except (IndexError, ValueError):
+        placed_at = time.time() if now is None else now
+    return time.strftime("%Y-%m-%d", time.gmtime(placed_at))
+
+
+def first_day(days: int, now: Optional[float] = None) -> str:
+    """First day of a window of `days` days ending today (UTC)."""
+    now = time.time() if now is None else now
+    return time.strftime("%Y-%m-%d", time.gmtime(now - (days - 1) * 86400))
+
+
+def _add(conn, table, key_columns: Tuple[str, ...], rows: Iterable[Dict[str, Any]]):
+    """Adds the rows' counters to the existing rows with the same key (or inserts them)."""
+    rows = sorted(rows, key=lambda row: tuple(row[column] for column in key_columns))
+    if not rows:
+        return
+    counters = [column for column in rows[0] if column not in key_columns and column != "product_name"]
+    dialect_insert = _dialect_inserts.get(conn.dialect.name)
+    if dialect_insert is None:
+        # Other databases: update, then insert the keys that weren't there yet
+        for row in rows:
+            key = [table.c[column] == row[column] for column in key_columns]
+            values = {column: table.c[column] + row[column] for column in counters}
+            if not conn.execute(table.update().where(*key).values(**values)).rowcount:
+                conn.execute(table.insert().values(**row))
+        return
+    upsert_key = (conn.dialect.name, table.name, tuple(counters))
+    upsert = _upserts.get(upsert_key)
+    if upsert is None:
+        statement = dialect_insert(table)
+        upsert = _upserts[upsert_key] = statement.on_conflict_do_update(
+            index_elements=list(key_columns),
+            set_={column: table.c[column] + statement.excluded[column] for column in counters},
+        )
+    # executemany: sent as one multi-row upsert, in key order, where the driver supports it
+    conn.execute(upsert, rows)
+
+
+def record_orders(conn, orders: Iterable[Tuple[Dict[str, Any], List[Dict[str, Any]]]], sign: int = 1):
+    """
+    Adds (order_row, item_rows) pairs, as built by main.build_order_rows, to the rollups.
+    Call it inside the transaction that inserts them (sign=-1 takes them back out, when
+    orders are deleted from a shard).
+    """
+    products: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    statuses: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    for order_row, item_rows in orders:
+        day = order_day(order_row["id"])
+        status = statuses.setdefault((day, order_row["status"]), {
+            "day": day, "status": order_row["status"], "orders": 0, "revenue_cents": 0,
+        })
+        status["orders"] += sign
+        status["revenue_cents"] += sign * to_cents(order_row["total"])
+
+        seen = set()
+        for item in item_rows:
+            product = products.setdefault((day, item["product_id"]), {
+                "day": day, "product_id": item["product_id"], "product_name": item["product_name"],
+                "units": 0, "revenue_cents": 0, "orders": 0,
+            })
+            product["units"] += sign * item["quantity"]
+            product["revenue_cents"] += sign * to_cents(item["price"]) * item["quantity"]
+            if item["product_id"] not in seen:
+                seen.add(item["product_id"])
+                product["orders"] += sign
+
+    _add(conn, sales_by_product_day_table, ("day", "product_id"), products.values())
+    _add(conn, orders_by_status_day_table, ("day", "status"), statuses.values())
+
+
+def record_status_change(conn, order_id: str, total: float, old_status: str, new_status: str):
+    """Moves one order from old_status to new_status on the day it was placed."""
+    day = order_day(order_id)
+    cents = to_cents(total)
+    _add(conn, orders_by_status_day_table, ("day", "status"), [
+        {"day": day, "status": old_status, "orders": -1, "revenue_cents": -cents},
+        {"day": day, "status": new_status, "orders": 1, "revenue_cents": cents},
+    ])
+
+
+# --- Reads ---
+
+def daily_stats(conn, days: int, now: Optional[float] = None) -> List[Dict[str, Any]]:
+    """Orders and revenue per day (newest first), with the split by current status."""
+    start = first_day(days, now)
+    rows = conn.execute(
+        select(orders_by_status_day_table)
+        .where(orders_by_status_day_table.c.day >= start)
+        .order_by(orders_by_status_day_table.c.day.desc(), orders_by_status_day_table.c.status)
+    )
+    by_day: Dict[str, Dict[str, Any]] = {}
+    for row in rows:
+        if row.orders == 0:
+            continue  # Every order of the day has moved on to another status
+        day = by_day.setdefault(row.day, {"day": row.day, "orders": 0, "revenue_cents": 0, "byStatus": {}})
+        day["orders"] += row.orders
+        day["revenue_cents"] += row.revenue_cents
+        day["byStatus"][row.status] = {"orders": row.orders, "revenue": from_cents(row.revenue_cents)}
+    return [
+        {"day": day["day"], "orders": day["orders"], "revenue": from_cents(day["revenue_cents"]), "byStatus": day["byStatus"]}
+        for day in by_day.values()
+    ]
+
+
+def top_products(conn, days: int, limit: Optional[int], by: str = "units",
+                 now: Optional[float] = None) -> List[Dict[str, Any]]:
+    """Best-selling products over the last `days` days, by units or revenue (limit=None: all)."""
+    sales = sales_by_product_day_table.c
+    units = func.sum(sales.units).label("units")
+    revenue = func.sum(sales.revenue_cents).label("revenue_cents")
+    ranking = revenue if by == "revenue" else units
+    rows = conn.execute(
+        select(sales.product_id, func.max(sales.product_name).label("product_name"), units, revenue,
+               func.sum(sales.orders).label("orders"))
+        .where(sales.day >= first_day(days, now))
+        .group_by(sales.product_id)
+        .order_by(ranking.desc(), sales.product_id)
+        .limit(limit)
+    )
+    return [
+        {"productId": row.product_id, "name": row.product_name, "units": row.units,
+         "revenue": from_cents(row.revenue_cents), "orders": row.orders}
+        for row in rows
+    ]
+
+
+# --- Merging the shards' answers (see sharding.py) ---
+
+def merge_daily_stats(per_shard: List[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    days: Dict[str, Dict[str, Any]] = {}
+    for shard_days in per_shard:
+        for shard_day in shard_days:
+            day = days.setdefault(shard_day["day"], {"day": shard_day["day"], "byStatus": {}})
+            for status, counts in shard_day["byStatus"].items():
+                total = day["byStatus"].setdefault(status, {"orders": 0, "revenue_cents": 0})
+                total["orders"] += counts["orders"]
+                total["revenue_cents"] += to_cents(counts["revenue"])
+    merged = []
+    for day in sorted(days.values(), key=lambda day: day["day"], reverse=True):
+        statuses = dict(sorted(day["byStatus"].items()))
+        merged.append({
+            "day": day["day"],
+            "orders": sum(counts["orders"] for counts in statuses.values()),
+            "revenue": from_cents(sum(counts["revenue_cents"] for counts in statuses.values())),
+            "byStatus": {
+                status: {"orders": counts["orders"], "revenue": from_cents(counts["revenue_cents"])}
+                for status, counts in statuses.items()
+            },
+        })
+    return merged
+
+
+def merge_top_products(per_shard: List[List[Dict[str, Any]]], limit: int, by: str = "units") -> List[Dict[str, Any]]:
+    """Merges complete per-shard rankings (top_products with limit=None) into one."""
+    products: Dict[str, Dict[str, Any]] = {}
+    for shard_products in per_shard:
+        for product in shard_products:
+            total = products.setdefault(product["productId"], {
+                "productId": product["productId"], "name": product["name"], "units": 0, "revenue_cents": 0, "orders": 0,
+            })
+            total["units"] += product["units"]
+            total["revenue_cents"] += to_cents(product["revenue"])
+            total["orders"] += product["orders"]
+    ranking = "revenue_cents" if by == "revenue" else "units"
+    ranked = sorted(products.values(), key=lambda product: (-product[ranking], product["productId"]))[:limit]
+    return [
+        {"productId": p["productId"], "name": p["name"], "units": p["units"],
+         "revenue": from_cents(p["revenue_cents"]), "orders": p["orders"]}
+        for p in ranked
+    ]
+
+
+# --- Rebuild from history ---
+
+def rebuild(engine, after_day: Optional[str] = None) -> int:
+    """
+    Recomputes both rollups of one database (or shard) from its orders and order_items in
+    one transaction (a streamed scan, upserted every REBUILD_FETCH_ROWS orders).
+    With after_day, the rows of that day and earlier are kept as they are and only later
+    days are recomputed. Returns the number of orders counted.
+    """
+    with engine.begin() as conn:
+        for table in (sales_by_product_day_table, orders_by_status_day_table):
+            statement = delete(table)
+            if after_day is not None:
+                statement = statement.where(table.c.day > after_day)
+            conn.execute(statement)
+
+        query = (
+            select(orders_table.c.id, orders_table.c.status, orders_table.c.total,
+                   order_items_table.c.product_id, order_items_table.c.product_name,
+                   order_items_table.c.quantity, order_items_table.c.price)
+            .select_from(orders_table.outerjoin(order_items_table, order_items_table.c.order_id == orders_table.c.id))
+            .order_by(orders_table.c.id)
+        )
+        counted = 0
+        pending: List[Tuple[Dict[str, Any], List[Dict[str, Any]]]] = []
+        result = conn.execution_options(yield_per=REBUILD_FETCH_ROWS).execute(query)
+        for row in result:
+            if after_day is not None and order_day(row.id) <= after_day:
+                continue  # Partly archived day, its rollups are kept
+            if not pending or pending[-1][0]["id"] != row.id:
+                if len(pending) >= REBUILD_FETCH_ROWS:
+                    # Rows come ordered by order ID, so every pending order is complete
+                    record_orders(conn, pending)
+                    pending = []
+                pending.append(({"id": row.id, "status": row.status, "total": row.total or 0}, []))
+                counted += 1
+            if row.product_id is not None:
+                pending[-1][1].append({"product_id": row.product_id, "product_name": row.product_name,
+                                       "quantity": row.quantity, "price": row.price})
+        record_orders(conn, pending)
+    return counted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rebuild", action="store_true", help="recompute the rollups from the order history")
+    parser.add_argument("--archive-url", default=os.getenv("ARCHIVE_URL", ""),
+                        help="order archive whose days are kept as they are (default: ARCHIVE_URL)")
+    args = parser.parse_args()
+    if args.rebuild:
+        import archive
+        from sharding import router
+        after_day = archive.last_archived_day(archive.open_storage(args.archive_url)) if args.archive_url else None
+        if after_day is not None:
+            print(f"Keeping the rollups of {after_day} and earlier (archived orders).")
+        for shard, engine in enumerate(router.engines):
+            print(f"Rebuilt sales rollups of shard {shard} from {rebuild(engine, after_day)} orders.")
+    else:
+        parser.print_help()
@@ -0,0 +1,232 @@
+"""
+Hash-sharded order storage.
+
+One Postgres instance was close to its write limit at peak. With ORDER_SHARD_URLS set
+(comma-separated database URLs), every order, its order_items and its share of the
+sales rollups are written to one of N databases, picked by a hash of the order ID.
+Without it there is one shard, the usual DATABASE_URL engine.
+
+- Writes and GET /api/orders/{id} go straight to the order's shard.
+- GET /api/orders, the stats and the archival job scatter to every shard (in parallel)
+  and merge the results; listings are merged by order ID with an ID cursor.
+- Idempotency keys stay in the DATABASE_URL database.
+
+The shard is picked with jump consistent hashing, so appending a shard to the list
+moves only 1/N of the orders (shards can only be added at the end of the list).
+
+Resharding: deploy the new ORDER_SHARD_URLS (new orders follow the new layout, lookups
+of an order not found on its shard check the other shards), then move the existing
+orders whose shard changed, in batches. Set ORDER_SHARDS_SINCE to the time (epoch
+seconds) from which every order was written under the current layout: only orders
+placed before it (by the time in their ID) are looked for on the other shards, so a
+miss on a newer order, e.g. an unknown ID, costs one query instead of one per shard.
+
+    ORDER_SHARD_URLS=postgresql://.../orders0,postgresql://.../orders1 python sharding.py reshard
+
+To backfill from the single database used before sharding, add --from-url with its URL.
+Every order is copied (skipped if already there) before it is deleted from its old
+shard, and the rollups move with it, so the tool can be stopped and rerun at any time.
+Orders still in the status pipeline are skipped; run it again once they are done.
+
+Local setup with three SQLite files:
+
+    ORDER_SHARD_URLS=sqlite:///shard0.db,sqlite:///shard1.db,sqlite:///shard2.db uvicorn main:app --port 8001
+"""
+import argparse
+import asyncio
+import hashlib
+import heapq
+import os
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import create_engine, delete, select
+from starlette.concurrency import run_in_threadpool
+
+import database
+import query_cache
+from database import metadata, orders_table, order_items_table, order_pipeline_table
+import rollups
+
+ORDER_SHARD_URLS = [url.strip() for url in os.getenv("ORDER_SHARD_URLS", "").split(",") if url.strip()]
+RESHARD_BATCH_ORDERS = int(os.getenv("RESHARD_BATCH_ORDERS", "500"))
+# Unset: any order missing from its shard may still be on another one
+ORDER_SHARDS_SINCE = float(os.getenv("ORDER_SHARDS_SINCE")) if os.getenv("ORDER_SHARDS_SINCE") else None
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """Jump consistent hash (Lamping & Veach): a bucket in [0, buckets)."""
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+class ShardRouter:
+    def __init__(self, urls: List[str], since: Optional[float] = ORDER_SHARDS_SINCE):
+        self.urls = urls
+        self.since = since
+        self._engines = [create_engine(url, connect_args=query_cache.connect_args(url)) for url in urls]
+
+    @property
+    def engines(self) -> List[Any]:
+        # Unsharded: the one DATABASE_URL engine (looked up on use, tests patch it)
+        return self._engines or [database.engine]
+
+    def shard_for(self, order_id: str) -> int:
+        if len(self._engines) <= 1:
+            return 0
+        key = int.from_bytes(hashlib.blake2b(order_id.encode("utf-8"), digest_size=8).digest(), "little")
+        return jump_hash(key, len(self._engines))
+
+    def engine_for(self, order_id: str):
+        return self.engines[self.shard_for(order_id)]
+
+    def may_be_elsewhere(self, order_id: str) -> bool:
+        """Whether an order missing from its shard can be on another one (placed before the layout)."""
+        if len(self._engines) <= 1:
+            return False
+        if self.since is None:
+            return True
+        try:
+            placed_at = float(order_id.split("-")[1])
+        except (IndexError, ValueError):
+            return True  # No time in the ID, could be from any layout
+        return placed_at < self.since
+
+    def split(self, entries: Iterable[Any], order_id: Callable[[Any], str]) -> List[Tuple[Any, List[Any]]]:
+        """Groups entries by shard: [(engine, entries)], skipping shards with nothing."""
+        groups: Dict[int, List[Any]] = {}
+        for entry in entries:
+            groups.setdefault(self.shard_for(order_id(entry)), []).append(entry)
+        return [(self.engines[shard], groups[shard]) for shard in sorted(groups)]
+
+    def create_tables(self):
+        for engine in self.engines:
+            metadata.create_all(engine)
+
+    async def gather(self, query: Callable, *args) -> List[Any]:
+        """Runs query(conn, *args) on every shard in parallel, returns the per-shard results."""
+        def run(engine):
+            with engine.connect() as conn:
+                return query(conn, *args)
+        return await asyncio.gather(*(run_in_threadpool(run, engine) for engine in self.engines))
+
+
+router = ShardRouter(ORDER_SHARD_URLS)
+
+
+# --- Scatter-gather reads ---
+
+def list_orders(conn, limit: Optional[int], before: Optional[str]) -> List[Dict[str, Any]]:
+    """One shard's orders, newest ID first."""
+    query = orders_table.select().order_by(orders_table.c.id.desc())
+    if before:
+        query = query.where(orders_table.c.id < before)
+    if limit is not None:
+        query = query.limit(limit)
+    return [dict(row._mapping) for row in conn.execute(query)]
+
+
+def merge_orders(per_shard: List[List[Dict[str, Any]]], limit: Optional[int]) -> List[Dict[str, Any]]:
+    """Merges the shards' newest-first lists. An order seen twice (mid-reshard) is kept once."""
+    merged, seen = [], set()
+    for order in heapq.merge(*per_shard, key=lambda order: order["id"], reverse=True):
+        if order["id"] in seen:
+            continue
+        seen.add(order["id"])
+        merged.append(order)
+        if limit is not None and len(merged) == limit:
+            break
+    return merged
+
+
+# --- Resharding / backfill ---
+
+def _copy_orders(conn, orders: List[Dict[str, Any]], items: Dict[str, List[Dict[str, Any]]]):
+    """Inserts the orders missing from this shard, with their items and rollup counts."""
+    order_ids = [order["id"] for order in orders]
+    present = set(conn.execute(select(orders_table.c.id).where(orders_table.c.id.in_(order_ids))).scalars())
+    missing = [order for order in orders if order["id"] not in present]
+    if not missing:
+        return
+    conn.execute(orders_table.insert(), missing)
+    rows = [{key: value for key, value in item.items() if key != "id"} for order in missing for item in items[order["id"]]]
+    if rows:
+        conn.execute(order_items_table.insert(), rows)
+    rollups.record_orders(conn, [(order, items[order["id"]]) for order in missing])
+
+
+def move_misplaced(source, target_router: ShardRouter, batch_size: int = RESHARD_BATCH_ORDERS,
+                   source_shard: Optional[int] = None) -> int:
+    """
+    Moves the orders in `source` that belong on another shard. source_shard is the
+    source's own index in target_router (None for a database outside the layout, all of
+    whose orders move). Returns the number of orders moved.
+    """
+    moved, after = 0, ""
+    while True:
+        with source.connect() as conn:
+            orders = [
+                dict(row._mapping) for row in conn.execute(
+                    orders_table.select().where(orders_table.c.id > after).order_by(orders_table.c.id).limit(batch_size)
+                )
+            ]
+            if not orders:
+                return moved
+            after = orders[-1]["id"]
+            misplaced = [order for order in orders if target_router.shard_for(order["id"]) != source_shard]
+            if misplaced:
+                # Orders still moving through the status pipeline are left for a later run
+                in_flight = set(conn.execute(
+                    select(order_pipeline_table.c.order_id)
+                    .where(order_pipeline_table.c.order_id.in_([order["id"] for order in misplaced]))
+                ).scalars())
+                misplaced = [order for order in misplaced if order["id"] not in in_flight]
+            if not misplaced:
+                continue
+            order_ids = [order["id"] for order in misplaced]
+            items: Dict[str, List[Dict[str, Any]]] = {order_id: [] for order_id in order_ids}
+            for row in conn.execute(
+                select(order_items_table).where(order_items_table.c.order_id.in_(order_ids)).order_by(order_items_table.c.id)
+            ):
+                items[row.order_id].append(dict(row._mapping))
+
+        # Copy first: if this stops halfway the order exists twice, never zero times
+        for target, shard_orders in target_router.split(misplaced, lambda order: order["id"]):
+            with target.begin() as conn:
+                _copy_orders(conn, shard_orders, items)
+        with source.begin() as conn:
+            conn.execute(delete(order_items_table).where(order_items_table.c.order_id.in_(order_ids)))
+            deleted = [
+                order for order in misplaced
+                if conn.execute(delete(orders_table).where(orders_table.c.id == order["id"])).rowcount
+            ]
+            rollups.record_orders(conn, [(order, items[order["id"]]) for order in deleted], sign=-1)
+        moved += len(misplaced)
+        print(f"  Moved {moved} orders...")
+
+
+def reshard(target_router: ShardRouter, from_urls: Iterable[str] = (), batch_size: int = RESHARD_BATCH_ORDERS) -> int:
+    """Moves every order to its shard under target_router's layout. Returns the number moved."""
+    target_router.create_tables()
+    moved = 0
+    for url in from_urls:
+        moved += move_misplaced(create_engine(url), target_router, batch_size)
+    for shard, engine in enumerate(target_router.engines):
+        moved += move_misplaced(engine, target_router, batch_size, source_shard=shard)
+    return moved
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["reshard"])
+    parser.add_argument("--from-url", action="append", default=[],
+                        help="database outside ORDER_SHARD_URLS to drain (e.g. the pre-sharding DATABASE_URL)")
+    parser.add_argument("--batch-size", type=int, default=RESHARD_BATCH_ORDERS)
+    args = parser.parse_args()
+    if not ORDER_SHARD_URLS:
+        parser.error("set ORDER_SHARD_URLS to the new shard layout")
+    total = reshard(router, args.from_url, args.batch_size)
+    print(f"Resharding done: {total} orders moved across {len(router.engines)} shards.")
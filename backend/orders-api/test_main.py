@@ -1,11 +1,33 @@
 import pytest
 from fastapi.testclient import TestClient
 from unittest.mock import Mock, patch, AsyncMock
+import asyncio
+import time
+import gzip
+import json
 from sqlalchemy import create_engine
 from sqlalchemy.pool import StaticPool
 import httpx
+from fastapi import HTTPException
 from main import app, CartItem, ShippingDetails, OrderPayload
-from database import orders_table, order_items_table, metadata
+from database import orders_table, order_items_table, idempotency_keys_table, order_pipeline_table, metadata
+import idempotency
+from idempotency import IdempotencyStore
+from pricing import PriceCache, price_cart, to_cents
+from shared_cache import SharedCache, connect
+from admission import AdmissionController, AdmissionMiddleware, CHECKOUT, READ
+import main
+import rollups
+import archive
+import sharding
+from sharding import ShardRouter
+from group_commit import GroupCommitter
+import pipeline
+from pipeline import OrderPipeline
+import item_codec
+import cart
+import query_cache
+from idempotency import fingerprint
 
 # Create an in-memory SQLite database for testing
 TEST_DATABASE_URL = "sqlite:///:memory:"
@@ -34,10 +56,12 @@ def mock_httpx_client():
 @pytest.fixture
 def client(test_engine, mock_httpx_client):
     """Create a test client with mocked database and HTTP client"""
-    with patch('main.engine', test_engine):
-        with patch('database.engine', test_engine):
-            with patch('main.client', mock_httpx_client):
-                yield TestClient(app)
+    with patch('database.engine', test_engine):
+        with patch('main.client', mock_httpx_client), patch('idempotency.engine', test_engine), \
+                patch('main.idempotency_store', IdempotencyStore()), patch('main.price_cache', PriceCache()), \
+                patch('pricing.PRICE_UNAVAILABLE_POLICY', 'client'):
+            # Client prices unless a test loads the price cache (see TestServerSidePricing)
+            yield TestClient(app)
 
 @pytest.fixture
 def sample_order_payload():
@@ -188,6 +212,901 @@ class TestOrdersAPI:
         # May or may not be empty depending on test execution order
 
 
+def count_orders(engine):
+    with engine.connect() as conn:
+        return len(conn.execute(orders_table.select()).fetchall())
+
+
+class TestIdempotency:
+    """Test suite for Idempotency-Key handling on order creation"""
+
+    def test_order_ids_are_unique(self, client, sample_order_payload):
+        """Test that orders placed in the same second get different IDs"""
+        first = client.post("/api/orders", json=sample_order_payload).json()["orderId"]
+        second = client.post("/api/orders", json=sample_order_payload).json()["orderId"]
+        assert first != second
+
+    def test_repeat_request_replays_response(self, client, sample_order_payload, mock_httpx_client, test_engine):
+        """Test that a retry returns the original order without placing it again"""
+        headers = {"Idempotency-Key": "checkout-123"}
+        first = client.post("/api/orders", json=sample_order_payload, headers=headers)
+        second = client.post("/api/orders", json=sample_order_payload, headers=headers)
+        assert first.status_code == second.status_code == 200
+        assert first.json() == second.json()
+        assert mock_httpx_client.post.call_count == 1
+        assert count_orders(test_engine) == 1
+
+    def test_replay_from_database_after_restart(self, client, sample_order_payload, test_engine):
+        """Test that a key completed before a restart (empty LRU) is replayed from the table"""
+        headers = {"Idempotency-Key": "checkout-456"}
+        first = client.post("/api/orders", json=sample_order_payload, headers=headers).json()
+        with patch('main.idempotency_store', IdempotencyStore()):
+            second = client.post("/api/orders", json=sample_order_payload, headers=headers).json()
+        assert first == second
+        assert count_orders(test_engine) == 1
+
+    def test_key_reused_for_different_request(self, client, sample_order_payload):
+        """Test that reusing a key with another body is refused"""
+        headers = {"Idempotency-Key": "checkout-789"}
+        client.post("/api/orders", json=sample_order_payload, headers=headers)
+        sample_order_payload["total"] = 1.0
+        response = client.post("/api/orders", json=sample_order_payload, headers=headers)
+        assert response.status_code == 422
+
+    def test_failed_request_releases_key(self, client, sample_order_payload, test_engine):
+        """Test that a failed order can be retried with the same key"""
+        headers = {"Idempotency-Key": "checkout-retry"}
+        with patch('main.place_order', AsyncMock(side_effect=RuntimeError("boom"))):
+            with pytest.raises(RuntimeError):
+                client.post("/api/orders", json=sample_order_payload, headers=headers)
+        response = client.post("/api/orders", json=sample_order_payload, headers=headers)
+        assert response.status_code == 200
+        assert count_orders(test_engine) == 1
+
+    def test_concurrent_duplicates_wait_for_first(self, test_engine):
+        """Test that concurrent requests with one key run the handler once"""
+        store = IdempotencyStore()
+        calls = []
+
+        async def handler():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return {"orderId": "ORD-1"}
+
+        async def run_duplicates():
+            return await asyncio.gather(*[store.run("same-key", "fp", handler) for _ in range(5)])
+
+        with patch('idempotency.engine', test_engine):
+            results = asyncio.run(run_duplicates())
+        assert results == [{"orderId": "ORD-1"}] * 5
+        assert len(calls) == 1
+
+    def test_duplicate_waits_for_other_pod(self, test_engine):
+        """Test that a key claimed on another pod is awaited, then replayed"""
+        with test_engine.begin() as conn:
+            conn.execute(idempotency_keys_table.insert().values(
+                key="other-pod", status="pending", fingerprint="fp", created_at=time.time()
+            ))
+
+        async def finish_on_other_pod():
+            await asyncio.sleep(0.1)
+            with test_engine.begin() as conn:
+                conn.execute(idempotency_keys_table.update().values(status="completed", response='{"orderId": "ORD-2"}'))
+
+        async def scenario():
+            handler = AsyncMock(return_value={"orderId": "never"})
+            results = await asyncio.gather(IdempotencyStore().run("other-pod", "fp", handler), finish_on_other_pod())
+            handler.assert_not_called()
+            return results[0]
+
+        with patch('idempotency.engine', test_engine):
+            assert asyncio.run(scenario()) == {"orderId": "ORD-2"}
+
+    def test_purge_drops_expired_completed_keys(self, test_engine):
+        """Test that completed keys past the retention are deleted in batches, pending ones kept"""
+        now = time.time()
+        expired = now - idempotency.IDEMPOTENCY_SHARED_TTL_SECONDS - 60
+        rows = [{"key": f"old-{i}", "status": "completed", "fingerprint": "fp", "response": "{}", "created_at": expired} for i in range(5)]
+        rows.append({"key": "old-pending", "status": "pending", "fingerprint": "fp", "response": None, "created_at": expired})
+        rows.append({"key": "recent", "status": "completed", "fingerprint": "fp", "response": "{}", "created_at": now})
+        with test_engine.begin() as conn:
+            conn.execute(idempotency_keys_table.insert(), rows)
+
+        with patch('idempotency.engine', test_engine):
+            assert idempotency.purge_completed(now=now, batch_size=2) == 5
+        with test_engine.connect() as conn:
+            remaining = {row.key for row in conn.execute(idempotency_keys_table.select())}
+        assert remaining == {"old-pending", "recent"}
+
+    def test_replay_from_shared_cache_on_other_pod(self, test_engine):
+        """Test that a key completed on one pod is replayed on another without touching the DB"""
+        connect("fake://").flushall()
+        first_pod = IdempotencyStore(shared_cache=SharedCache("orders-idempotency", url="fake://"))
+        other_pod = IdempotencyStore(shared_cache=SharedCache("orders-idempotency", url="fake://"))
+        handler = AsyncMock(return_value={"orderId": "ORD-3"})
+
+        with patch('idempotency.engine', test_engine):
+            assert asyncio.run(first_pod.run("shared-key", "fp", handler)) == {"orderId": "ORD-3"}
+        with patch('idempotency.engine', Mock(side_effect=AssertionError("DB used"))):
+            assert asyncio.run(other_pod.run("shared-key", "fp", handler)) == {"orderId": "ORD-3"}
+            with pytest.raises(HTTPException) as error:
+                asyncio.run(other_pod.run("shared-key", "other-fp", handler))
+        assert error.value.status_code == 422
+        assert handler.call_count == 1
+
+
+class TestBatchOrders:
+    """Test suite for bulk order submission"""
+
+    def test_batch_creates_all_orders(self, client, sample_order_payload, mock_httpx_client, test_engine):
+        """Test that a batch is saved and inventory is called once with summed quantities"""
+        response = client.post("/api/orders/batch", json={"orders": [sample_order_payload] * 3})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["received"] == 3
+        assert data["inventoryUpdated"] is True
+        assert len({result["orderId"] for result in data["orders"]}) == 3
+
+        assert count_orders(test_engine) == 3
+        with test_engine.connect() as conn:
+            assert len(conn.execute(order_items_table.select()).fetchall()) == 6
+
+        mock_httpx_client.post.assert_called_once()
+        inventory_payload = mock_httpx_client.post.call_args.kwargs["json"]
+        assert sorted(inventory_payload, key=lambda item: item["id"]) == [
+            {"id": "product-1", "quantity": 6},
+            {"id": "product-2", "quantity": 3},
+        ]
+
+    def test_batch_reports_per_order(self, client, sample_order_payload, test_engine):
+        """Test that invalid orders are rejected individually"""
+        empty = dict(sample_order_payload, cart=[])
+        response = client.post("/api/orders/batch", json={"orders": [sample_order_payload, empty]})
+        data = response.json()
+        assert [result["status"] for result in data["orders"]] == ["received", "rejected"]
+        assert data["orders"][1]["error"] == "cart is empty"
+        assert data["received"] == 1 and data["rejected"] == 1
+        assert count_orders(test_engine) == 1
+
+        # Quantities and prices are part of the schema: the whole batch is refused
+        zero = dict(sample_order_payload, cart=[dict(sample_order_payload["cart"][0], quantity=0)])
+        response = client.post("/api/orders/batch", json={"orders": [sample_order_payload, zero]})
+        assert response.status_code == 422
+        assert response.json()["detail"][0]["loc"] == ["body", "orders", 1, "cart", 0, "quantity"]
+        assert count_orders(test_engine) == 1
+
+    def test_batch_chunks_transactions(self, client, sample_order_payload, mock_httpx_client, test_engine):
+        """Test that orders are written across several transactions"""
+        with patch('main.BATCH_ORDERS_PER_TRANSACTION', 2), patch('main.ROWS_PER_INSERT', 3):
+            response = client.post("/api/orders/batch", json={"orders": [sample_order_payload] * 5})
+        assert response.json()["received"] == 5
+        assert count_orders(test_engine) == 5
+        mock_httpx_client.post.assert_called_once()
+
+    def test_batch_inventory_down(self, client, sample_order_payload, mock_httpx_client):
+        """Test that orders are still received when inventory-api is down"""
+        mock_httpx_client.post.side_effect = httpx.RequestError("Connection failed")
+        data = client.post("/api/orders/batch", json={"orders": [sample_order_payload]}).json()
+        assert data["received"] == 1
+        assert data["inventoryUpdated"] is False
+
+    def test_batch_too_large(self, client, sample_order_payload, test_engine):
+        """Test the batch size limit (checked by the schema, before anything is written)"""
+        response = client.post("/api/orders/batch", json={"orders": [sample_order_payload] * (cart.MAX_BATCH_ORDERS + 1)})
+        assert response.status_code == 422
+        assert response.json()["detail"][0]["type"] == "too_long"
+        assert count_orders(test_engine) == 0
+
+
+class TestBinaryInventoryTransport:
+    """Test suite for the compact orders -> inventory encoding (INVENTORY_TRANSPORT=binary)"""
+
+    def test_order_sends_binary_items(self, client, sample_order_payload, mock_httpx_client):
+        """Test that the stock reduction is encoded and the binary response accepted"""
+        mock_httpx_client.post.return_value = Mock(
+            status_code=200, headers={"content-type": item_codec.CONTENT_TYPE},
+            content=item_codec.encode([("product-1", 98), ("product-2", 49)]),
+        )
+        with patch('main.INVENTORY_TRANSPORT', "binary"):
+            response = client.post("/api/orders", json=sample_order_payload)
+        assert response.status_code == 200
+
+        kwargs = mock_httpx_client.post.call_args.kwargs
+        assert kwargs["headers"] == {"Content-Type": item_codec.CONTENT_TYPE, "Accept": item_codec.CONTENT_TYPE}
+        assert item_codec.decode(kwargs["content"]) == [("product-1", 2), ("product-2", 1)]
+
+    def test_unencodable_cart_does_not_fail_the_order(self, client, sample_order_payload, mock_httpx_client):
+        """Test that a quantity outside int32 is logged like an unreachable inventory-api"""
+        sample_order_payload["cart"][0]["quantity"] = 2 ** 31
+        with patch('main.INVENTORY_TRANSPORT', "binary"):
+            response = client.post("/api/orders", json=sample_order_payload)
+        assert response.status_code == 200
+        mock_httpx_client.post.assert_not_called()
+
+    def test_codec_round_trip(self):
+        """Test encoding and strict decoding"""
+        body = item_codec.encode([("1001", 3), ("caf\u00e9", -1)])
+        assert item_codec.decode(body) == [("1001", 3), ("caf\u00e9", -1)]
+        assert item_codec.decode(body)[0].quantity == 3
+        for malformed in (b"", b"JSON[]", body[:-1], body + b"x"):
+            with pytest.raises(ValueError):
+                item_codec.decode(malformed)
+
+
+class TestCartIngestion:
+    """Test suite for the one-pass order validation (cart.py)"""
+
+    def test_body_size_limit(self, client, sample_order_payload, test_engine):
+        """Test that an oversized body is refused with 413 before it is parsed"""
+        with patch('cart.MAX_ORDER_BODY_BYTES', 100):
+            response = client.post("/api/orders", json=sample_order_payload)
+        assert response.status_code == 413
+        assert count_orders(test_engine) == 0
+
+    def test_cart_and_field_limits(self, client, sample_order_payload):
+        """Test the cart length and field length limits (FastAPI's 422 format)"""
+        sample_order_payload["cart"][1]["id"] = "x" * (cart.MAX_ID_LENGTH + 1)
+        response = client.post("/api/orders", json=sample_order_payload)
+        assert response.status_code == 422
+        assert response.json()["detail"][0]["loc"] == ["body", "cart", 1, "id"]
+
+        sample_order_payload["cart"] = [sample_order_payload["cart"][0]] * (cart.MAX_CART_LINES + 1)
+        response = client.post("/api/orders", json=sample_order_payload)
+        assert response.status_code == 422
+        assert response.json()["detail"][0]["type"] == "too_long"
+
+    def test_quantity_and_price_limits(self, client, sample_order_payload, mock_httpx_client, loaded_prices, test_engine):
+        """Test that a zero or negative quantity, or a negative price, is refused before pricing and the DB"""
+        for field, value in (("quantity", -5), ("quantity", 0), ("price", -1.0)):
+            payload = json.loads(json.dumps(sample_order_payload))
+            payload["cart"][0][field] = value
+            response = client.post("/api/orders", json=payload)
+            assert response.status_code == 422
+            assert response.json()["detail"][0]["loc"] == ["body", "cart", 0, field]
+        assert count_orders(test_engine) == 0
+        mock_httpx_client.post.assert_not_called()
+
+    def test_unknown_fields_are_ignored(self, client, sample_order_payload, mock_httpx_client, test_engine):
+        """Test that extra cart fields are accepted and the lines reach both the rows and inventory-api"""
+        sample_order_payload["cart"][0]["description"] = "not part of the contract"
+        response = client.post("/api/orders", json=sample_order_payload)
+        assert response.status_code == 200
+        with test_engine.connect() as conn:
+            rows = conn.execute(order_items_table.select().order_by(order_items_table.c.id)).fetchall()
+        assert [(row.product_id, row.product_name, row.quantity) for row in rows] == [
+            ("product-1", "Test Product 1", 2), ("product-2", "Test Product 2", 1),
+        ]
+        assert mock_httpx_client.post.call_args.kwargs["json"] == [
+            {"id": "product-1", "quantity": 2}, {"id": "product-2", "quantity": 1},
+        ]
+
+    def test_fingerprint_matches_the_model(self, sample_order_payload):
+        """Test that idempotency fingerprints are unchanged from the model-based path"""
+        data = cart.order_schema.validate_json(json.dumps(sample_order_payload))
+        assert fingerprint(data) == fingerprint(OrderPayload(**sample_order_payload).model_dump())
+        assert cart.to_order(data).cart[0] == ("product-1", "Test Product 1", 29.99, 2)
+
+    def test_openapi_documents_the_body(self, client):
+        """Test that the raw-body endpoints still publish their request schema"""
+        schema = client.get("/openapi.json").json()["paths"]["/api/orders"]["post"]["requestBody"]
+        cart_schema = schema["content"]["application/json"]["schema"]["properties"]["cart"]
+        assert cart_schema["maxItems"] == cart.MAX_CART_LINES
+        assert "quantity" in cart_schema["items"]["properties"]
+
+
+@pytest.fixture
+def loaded_prices():
+    """Price cache loaded with the sample products"""
+    import main
+    main.price_cache.load([("product-1", 29.99), ("product-2", 19.99)])
+    return main.price_cache
+
+
+class TestServerSidePricing:
+    """Test suite for server-side cart pricing"""
+
+    def test_unloaded_cache_refuses_orders(self, client, sample_order_payload, mock_httpx_client, test_engine):
+        """Test that without prices orders get a 503 (after a load attempt) unless client prices are opted in"""
+        mock_httpx_client.get.side_effect = httpx.RequestError("products-api down")
+        with patch('pricing.PRICE_UNAVAILABLE_POLICY', 'reject'):
+            response = client.post("/api/orders", json=sample_order_payload)
+            assert response.status_code == 503
+            # The failed attempt holds off the next one
+            assert client.post("/api/orders", json=sample_order_payload).status_code == 503
+        assert mock_httpx_client.get.call_count == 1
+        assert count_orders(test_engine) == 0
+
+        response = client.post("/api/orders", json=sample_order_payload)
+        assert response.json()["total"] == 79.97  # PRICE_UNAVAILABLE_POLICY=client
+
+    def test_unloaded_cache_loads_inline(self, client, sample_order_payload, mock_httpx_client):
+        """Test that an order loads the prices itself when the cache never loaded"""
+        products = Mock(status_code=200)
+        products.json.return_value = [{"id": "product-1", "price": 29.99}, {"id": "product-2", "price": 19.99}]
+        mock_httpx_client.get.return_value = products
+        with patch('pricing.PRICE_UNAVAILABLE_POLICY', 'reject'):
+            response = client.post("/api/orders", json=sample_order_payload)
+        assert response.status_code == 200
+        assert response.json()["total"] == 96.36
+
+    def test_total_includes_tax_and_shipping(self, client, sample_order_payload, loaded_prices, test_engine):
+        """Test that the stored total is computed server-side like the checkout page"""
+        sample_order_payload["total"] = 96.3576  # 79.97 * 1.08 + 9.99, as the browser computes it
+        response = client.post("/api/orders", json=sample_order_payload)
+        assert response.status_code == 200
+        assert response.json()["total"] == 96.36
+
+    def test_tampered_prices_are_corrected(self, client, sample_order_payload, loaded_prices, test_engine):
+        """Test that client prices are replaced by server prices"""
+        sample_order_payload["cart"][0]["price"] = 0.01
+        sample_order_payload["total"] = 1.0
+        order_id = client.post("/api/orders", json=sample_order_payload).json()["orderId"]
+
+        with test_engine.connect() as conn:
+            order = conn.execute(orders_table.select().where(orders_table.c.id == order_id)).first()
+            items = conn.execute(order_items_table.select().where(order_items_table.c.order_id == order_id)).fetchall()
+        assert order.total == 96.36
+        assert sorted(item.price for item in items) == [19.99, 29.99]
+
+    def test_reject_policy(self, client, sample_order_payload, loaded_prices):
+        """Test that mismatched prices are refused under the reject policy"""
+        sample_order_payload["cart"][1]["price"] = 9.99
+        with patch('pricing.PRICE_MISMATCH_POLICY', 'reject'):
+            response = client.post("/api/orders", json=sample_order_payload)
+        assert response.status_code == 409
+        assert response.json()["detail"]["items"][0] == {"id": "product-2", "price": 9.99, "expected": 19.99}
+
+    def test_unknown_product_refreshes_then_fails(self, client, sample_order_payload, loaded_prices, mock_httpx_client):
+        """Test that an unknown product triggers one cache refresh before failing"""
+        loaded_prices.load([("product-1", 29.99)])
+        loaded_prices.loaded_at = 0  # stale
+        catalog = Mock()
+        catalog.json.return_value = [{"id": "product-1", "price": 29.99}]
+        mock_httpx_client.get.return_value = catalog
+
+        response = client.post("/api/orders", json=sample_order_payload)
+        assert response.status_code == 400
+        assert response.json()["detail"]["items"] == [{"id": "product-2"}]
+        mock_httpx_client.get.assert_called_once()
+
+    def test_batch_orders_are_repriced(self, client, sample_order_payload, loaded_prices):
+        """Test that bulk submission prices each order and rejects unknown products"""
+        unknown = dict(sample_order_payload, cart=[dict(sample_order_payload["cart"][0], id="nope")])
+        data = client.post("/api/orders/batch", json={"orders": [sample_order_payload, unknown]}).json()
+        assert data["orders"][0]["total"] == 96.36
+        assert data["orders"][1]["status"] == "rejected"
+
+    def test_cents_arithmetic(self):
+        """Test that prices are summed in integer cents"""
+        assert to_cents(0.1) + to_cents(0.2) == to_cents(0.3)
+        assert to_cents(19.995) == 2000
+        cart = [CartItem(id="a", name="A", price=0.1, quantity=3, imageUrl="")]
+        priced = price_cart({"a": 10}, cart)
+        assert priced["subtotal_cents"] == 30
+        assert priced["tax_cents"] == 2
+        assert priced["total_cents"] == 30 + 2 + 999
+
+    def test_refresh_from_products_table(self, test_engine):
+        """Test loading prices straight from the products table"""
+        with test_engine.begin() as conn:
+            conn.exec_driver_sql("CREATE TABLE products (id VARCHAR PRIMARY KEY, price FLOAT)")
+            conn.exec_driver_sql("INSERT INTO products VALUES ('1001', 249.99)")
+        cache = PriceCache()
+        with patch('pricing.engine', test_engine), patch('pricing.PRICE_SOURCE', 'db'):
+            asyncio.run(cache.refresh(None))
+        assert cache.prices == {"1001": 24999}
+
+
+class TestSalesRollups:
+    """Test suite for the incremental sales rollups"""
+
+    def test_orders_update_rollups(self, client, sample_order_payload):
+        """Test that single and batch orders are counted per day, product and status"""
+        client.post("/api/orders", json=sample_order_payload)
+        client.post("/api/orders/batch", json={"orders": [sample_order_payload] * 2})
+
+        stats = client.get("/api/orders/stats").json()
+        assert stats["orders"] == 3
+        assert stats["revenue"] == 239.91
+        assert stats["perDay"][0]["byStatus"] == {"received": {"orders": 3, "revenue": 239.91}}
+
+        top = client.get("/api/orders/stats/top-products").json()["products"]
+        assert [(p["productId"], p["units"], p["orders"]) for p in top] == [("product-1", 6, 3), ("product-2", 3, 3)]
+        assert top[0]["revenue"] == 179.94
+
+    def test_top_products_by_revenue(self, client, sample_order_payload):
+        """Test the revenue ranking and the limit"""
+        cheap_bulk = dict(sample_order_payload, cart=[dict(sample_order_payload["cart"][1], quantity=10)])
+        client.post("/api/orders", json=sample_order_payload)
+        client.post("/api/orders", json=cheap_bulk)
+        by_units = client.get("/api/orders/stats/top-products?limit=1").json()["products"]
+        by_revenue = client.get("/api/orders/stats/top-products?limit=1&by=revenue").json()["products"]
+        assert by_units[0]["productId"] == "product-2"
+        assert by_revenue[0]["productId"] == "product-2" and by_revenue[0]["revenue"] == 219.89
+        assert client.get("/api/orders/stats/top-products?by=price").status_code == 422
+
+    def test_window_excludes_older_days(self, test_engine):
+        """Test that only the requested days are read"""
+        now = time.mktime((2025, 3, 10, 12, 0, 0, 0, 0, 0))
+        orders = [
+            ({"id": f"ORD-{int(now - days_ago * 86400)}-abc", "status": "received", "total": 10.0},
+             [{"product_id": "p", "product_name": "P", "quantity": 1, "price": 10.0}])
+            for days_ago in (0, 1, 8)
+        ]
+        with test_engine.begin() as conn:
+            rollups.record_orders(conn, orders)
+            week = rollups.daily_stats(conn, 7, now=now)
+            top = rollups.top_products(conn, 7, 10, now=now)
+        assert [day["orders"] for day in week] == [1, 1]
+        assert week[0]["day"] > week[1]["day"]
+        assert top[0]["units"] == 2
+
+    def test_status_change_moves_counts(self, client, sample_order_payload, test_engine):
+        """Test that an order changing status moves to the new status on its own day"""
+        order_id = client.post("/api/orders", json=sample_order_payload).json()["orderId"]
+        with test_engine.begin() as conn:
+            rollups.record_status_change(conn, order_id, 79.97, "received", "confirmed")
+        day = client.get("/api/orders/stats").json()["perDay"][0]
+        assert day["orders"] == 1
+        assert day["byStatus"] == {"confirmed": {"orders": 1, "revenue": 79.97}}
+
+    def test_rebuild_matches_incremental(self, client, sample_order_payload, test_engine):
+        """Test that rebuilding from history gives the same rollups"""
+        client.post("/api/orders/batch", json={"orders": [sample_order_payload] * 3})
+        client.post("/api/orders", json=dict(sample_order_payload, cart=[]))
+        before = client.get("/api/orders/stats").json(), client.get("/api/orders/stats/top-products").json()
+        with patch('rollups.REBUILD_FETCH_ROWS', 2):
+            assert rollups.rebuild(test_engine) == 4
+        assert (client.get("/api/orders/stats").json(), client.get("/api/orders/stats/top-products").json()) == before
+
+
+def insert_old_order(engine, days_ago, suffix, quantity=1):
+    """Inserts an order placed `days_ago` days ago, returns its ID"""
+    order_id = f"ORD-{int(time.time() - days_ago * 86400)}-{suffix}"
+    with engine.begin() as conn:
+        conn.execute(orders_table.insert().values(id=order_id, status="received", total=10.0))
+        conn.execute(order_items_table.insert().values(
+            order_id=order_id, product_id="product-1", product_name="Test Product 1", quantity=quantity, price=10.0))
+    return order_id
+
+
+class TestOrderArchive:
+    """Test suite for cold-storage archival and the read-through lookup"""
+
+    def test_get_order_from_hot_tables(self, client, sample_order_payload):
+        """Test that a recent order is served from the database with its items"""
+        order_id = client.post("/api/orders", json=sample_order_payload).json()["orderId"]
+        data = client.get(f"/api/orders/{order_id}").json()
+        assert data["id"] == order_id and data["archived"] is False
+        assert [item["product_id"] for item in data["items"]] == ["product-1", "product-2"]
+        assert client.get("/api/orders/ORD-1-missing").status_code == 404
+
+    def test_old_orders_are_moved_in_batches(self, client, sample_order_payload, test_engine, tmp_path):
+        """Test that only old orders are archived, a batch per transaction, partitioned by day"""
+        old_ids = [insert_old_order(test_engine, 40, suffix) for suffix in ("a", "b", "c")]
+        client.post("/api/orders", json=sample_order_payload)
+        storage = archive.LocalStorage(str(tmp_path))
+
+        with patch('archive.archive_batch', wraps=archive.archive_batch) as batches:
+            assert archive.run(storage, older_than_days=30, batch_size=2) == 3
+        assert batches.call_count == 3  # 2 + 1 + the empty batch that ends the run
+        assert count_orders(test_engine) == 1
+        with test_engine.connect() as conn:
+            assert len(conn.execute(order_items_table.select()).fetchall()) == 2
+
+        parts = storage.list(archive.partition(rollups.order_day(old_ids[0])))
+        assert len(parts) == 2 and all(part.endswith(".ndjson.gz") for part in parts)
+        lines = gzip.decompress(storage.get(parts[0])).decode().splitlines()
+        assert [json.loads(line)["id"] for line in lines] == old_ids[:2]
+
+    def test_archived_order_read_through(self, client, test_engine, tmp_path):
+        """Test that GET /api/orders/{id} still serves an archived order"""
+        order_id = insert_old_order(test_engine, 400, "old", quantity=3)
+        storage = archive.LocalStorage(str(tmp_path))
+        archive.run(storage, older_than_days=30)
+
+        with patch('archive.archive_reader', archive.ArchiveReader(storage)):
+            data = client.get(f"/api/orders/{order_id}").json()
+            assert client.get(f"/api/orders/{order_id[:-3]}new").status_code == 404
+        assert data["archived"] is True and data["status"] == "received"
+        assert data["items"][0]["quantity"] == 3
+        assert client.get(f"/api/orders/{order_id}").status_code == 404  # Archive not configured
+
+
+    def test_rebuild_keeps_archived_days(self, client, sample_order_payload, test_engine, tmp_path):
+        """Test that rebuilding after archival keeps the archived days in the stats"""
+        insert_old_order(test_engine, 40, "old", quantity=2)
+        rollups.rebuild(test_engine)  # Counts the order inserted without the API
+        client.post("/api/orders", json=sample_order_payload)
+        storage = archive.LocalStorage(str(tmp_path))
+        assert archive.last_archived_day(storage) is None
+        archive.run(storage, older_than_days=30)
+        before = client.get("/api/orders/stats?days=60").json()
+
+        after_day = archive.last_archived_day(storage)
+        assert after_day == rollups.first_day(41)
+        assert rollups.rebuild(test_engine, after_day) == 1
+        assert client.get("/api/orders/stats?days=60").json() == before
+        assert [day["orders"] for day in before["perDay"]] == [1, 1]
+
+@pytest.fixture
+def shards(tmp_path):
+    """Three SQLite files as order shards"""
+    router = ShardRouter([f"sqlite:///{tmp_path}/shard{i}.db" for i in range(3)])
+    router.create_tables()
+    with patch('main.router', router), patch('archive.router', router):
+        yield router
+
+
+def shard_order_ids(router):
+    ids = []
+    for engine in router.engines:
+        with engine.connect() as conn:
+            ids.append({row.id for row in conn.execute(orders_table.select())})
+    return ids
+
+
+class TestSharding:
+    """Test suite for hash-sharded order storage"""
+
+    def test_jump_hash_moves_few_keys(self):
+        """Test that keys spread evenly and adding a shard only moves keys to the new one"""
+        three, four = ShardRouter(["sqlite://"] * 3), ShardRouter(["sqlite://"] * 4)
+        ids = [f"ORD-1700000000-{i:08x}" for i in range(3000)]
+        counts = [0, 0, 0]
+        moved = 0
+        for order_id in ids:
+            before, after = three.shard_for(order_id), four.shard_for(order_id)
+            counts[before] += 1
+            if before != after:
+                assert after == 3
+                moved += 1
+        assert all(800 < count < 1200 for count in counts)
+        assert 550 < moved < 950
+
+    def test_orders_are_stored_on_their_shard(self, client, sample_order_payload, shards):
+        """Test that single and batch orders land on exactly one shard, the hashed one"""
+        for _ in range(6):
+            client.post("/api/orders", json=sample_order_payload)
+        client.post("/api/orders/batch", json={"orders": [sample_order_payload] * 6})
+        per_shard = shard_order_ids(shards)
+        assert sum(len(ids) for ids in per_shard) == 12
+        assert sum(1 for ids in per_shard if ids) > 1
+        for shard, ids in enumerate(per_shard):
+            assert all(shards.shard_for(order_id) == shard for order_id in ids)
+
+        order_id = next(iter(per_shard[0] or per_shard[1]))
+        assert len(client.get(f"/api/orders/{order_id}").json()["items"]) == 2
+        assert client.get("/api/orders/stats").json()["orders"] == 12
+        top = client.get("/api/orders/stats/top-products?limit=1").json()["products"]
+        assert top == [{"productId": "product-1", "name": "Test Product 1", "units": 24, "revenue": 719.76, "orders": 12}]
+
+    def test_listing_merges_shards_with_cursor(self, client, sample_order_payload, shards):
+        """Test that pages merged from every shard are newest first and cover every order once"""
+        client.post("/api/orders/batch", json={"orders": [sample_order_payload] * 10})
+        everything = [order["id"] for order in client.get("/api/orders").json()]
+        assert everything == sorted(everything, reverse=True) and len(everything) == 10
+
+        paged, cursor = [], None
+        while True:
+            response = client.get("/api/orders", params={"limit": 3, **({"before": cursor} if cursor else {})})
+            paged.extend(order["id"] for order in response.json())
+            cursor = response.headers.get("X-Next-Cursor")
+            if not cursor:
+                break
+        assert paged == everything
+
+    def test_reshard_and_backfill(self, client, sample_order_payload, test_engine, shards, tmp_path):
+        """Test that the tool drains the old database and moves orders whose shard changed"""
+        # Orders placed before sharding, in the single database
+        with patch('main.router', ShardRouter([])):
+            client.post("/api/orders/batch", json={"orders": [sample_order_payload] * 8})
+        # ...and on a two-shard layout
+        two = ShardRouter([f"sqlite:///{tmp_path}/shard{i}.db" for i in range(2)])
+        with patch('main.router', two):
+            client.post("/api/orders/batch", json={"orders": [sample_order_payload] * 8})
+        # Jump hashing moves about a third of them to the new shard
+        two_shard_ids = set().union(*shard_order_ids(two))
+        changed_shard = sum(1 for order_id in two_shard_ids if shards.shard_for(order_id) == 2)
+
+        with patch('sharding.create_engine', lambda url: test_engine):
+            assert sharding.reshard(shards, from_urls=["legacy"], batch_size=3) == 8 + changed_shard
+        assert count_orders(test_engine) == 0
+        per_shard = shard_order_ids(shards)
+        assert sum(len(ids) for ids in per_shard) == 16
+        for shard, ids in enumerate(per_shard):
+            assert all(shards.shard_for(order_id) == shard for order_id in ids)
+        assert client.get("/api/orders/stats").json()["orders"] == 16
+        with shards.engines[0].connect() as conn:
+            assert len(conn.execute(order_items_table.select()).fetchall()) == 2 * len(per_shard[0])
+        assert sharding.reshard(shards) == 0
+
+    def test_lookup_falls_back_to_other_shards(self, client, sample_order_payload, shards):
+        """Test that an order not yet moved to its shard is still found"""
+        with patch('main.router', ShardRouter([])):
+            order_id = client.post("/api/orders", json=sample_order_payload).json()["orderId"]
+        stray = shards.engines[(shards.shard_for(order_id) + 1) % 3]
+        with stray.begin() as conn:
+            conn.execute(orders_table.insert().values(id=order_id, status="received", total=1.0))
+        assert client.get(f"/api/orders/{order_id}").json()["id"] == order_id
+
+    def test_lookup_scans_other_shards_only_for_older_orders(self, client, sample_order_payload, shards):
+        """Test that with ORDER_SHARDS_SINCE a miss on a newer order costs one query"""
+        order_id = client.post("/api/orders", json=sample_order_payload).json()["orderId"]
+        placed_at = int(order_id.split("-")[1])
+        with patch.object(shards, 'gather', wraps=shards.gather) as gather:
+            shards.since = placed_at
+            assert client.get(f"/api/orders/ORD-{placed_at}-missing").status_code == 404
+            assert client.get(f"/api/orders/{order_id}").json()["id"] == order_id
+            gather.assert_not_called()
+            assert client.get(f"/api/orders/ORD-{placed_at - 1}-missing").status_code == 404
+            assert client.get("/api/orders/legacy-1").status_code == 404
+            assert gather.call_count == 2
+
+
+class TestGroupCommit:
+    """Test suite for group commit of concurrent order inserts"""
+
+    def test_concurrent_orders_share_one_transaction(self, test_engine):
+        """Test that orders submitted within the window are written together"""
+        write = Mock()
+
+        async def scenario():
+            committer = GroupCommitter(write, window=0.01, max_batch=100)
+            await asyncio.gather(*(committer.submit(test_engine, f"order-{i}") for i in range(5)))
+            return committer.stats
+
+        stats = asyncio.run(scenario())
+        write.assert_called_once()
+        assert write.call_args.args[1] == [f"order-{i}" for i in range(5)]
+        assert stats["groups"] == 1 and stats["entries"] == 5
+
+    def test_full_group_is_written_without_waiting(self, test_engine):
+        """Test that max_batch flushes a group before the window ends"""
+        write = Mock()
+
+        async def scenario():
+            committer = GroupCommitter(write, window=10, max_batch=2)
+            started = time.perf_counter()
+            await asyncio.gather(*(committer.submit(test_engine, i) for i in range(4)))
+            return time.perf_counter() - started
+
+        assert asyncio.run(scenario()) < 1
+        assert [call.args[1] for call in write.call_args_list] == [[0, 1], [2, 3]]
+
+    def test_failing_order_fails_alone(self, test_engine):
+        """Test that each caller gets its own result when the group transaction fails"""
+        def write(conn, entries):
+            if "bad" in entries:
+                raise ValueError("bad order")
+
+        async def scenario():
+            committer = GroupCommitter(write, window=0.01)
+            results = await asyncio.gather(
+                *(committer.submit(test_engine, entry) for entry in ("a", "bad", "c")), return_exceptions=True)
+            return results, committer.stats
+
+        results, stats = asyncio.run(scenario())
+        assert results[0] is None and results[2] is None
+        assert isinstance(results[1], ValueError)
+        assert stats["isolated_retries"] == 3
+
+    def test_create_order_through_group_commit(self, client, sample_order_payload, test_engine):
+        """Test the opt-in write path end to end"""
+        with patch('group_commit.ORDER_GROUP_COMMIT', True), \
+                patch('main.order_writer', GroupCommitter(main.write_orders, window=0.001)) as writer:
+            response = client.post("/api/orders", json=sample_order_payload)
+        assert response.status_code == 200
+        assert writer.stats["entries"] == 1
+        assert count_orders(test_engine) == 1
+        assert client.get("/api/orders/stats").json()["orders"] == 1
+
+
+def inventory_response(status_code, body=None):
+    response = Mock()
+    response.status_code = status_code
+    response.json.return_value = body or {}
+    if status_code >= 400:
+        response.raise_for_status.side_effect = httpx.HTTPStatusError("error", request=Mock(), response=response)
+    return response
+
+
+@pytest.fixture
+def pipeline_client(client):
+    """Test client with the status pipeline on, and a pipeline whose inventory calls are mocked"""
+    inventory = AsyncMock()
+    inventory.post.side_effect = lambda url, **kwargs: inventory_response(
+        200, {"reservation_id": "res-1"} if url.endswith("/reservations") else {"status": "confirmed"})
+    with patch('pipeline.ORDER_PIPELINE_ENABLED', True):
+        yield client, OrderPipeline(inventory, retry_seconds=0)
+
+
+def order_status(engine, order_id):
+    with engine.connect() as conn:
+        return conn.execute(orders_table.select().where(orders_table.c.id == order_id)).first().status
+
+
+class TestOrderPipeline:
+    """Test suite for the asynchronous order status pipeline"""
+
+    def test_order_moves_through_every_stage(self, pipeline_client, sample_order_payload, mock_httpx_client, test_engine):
+        """Test received -> reserved -> confirmed -> fulfilled, with no inline inventory call"""
+        client, order_pipeline = pipeline_client
+        order_id = client.post("/api/orders", json=sample_order_payload).json()["orderId"]
+        mock_httpx_client.post.assert_not_called()
+
+        for expected in ("reserved", "confirmed", "fulfilled"):
+            assert asyncio.run(order_pipeline.run_once()) == 1
+            assert order_status(test_engine, order_id) == expected
+        assert asyncio.run(order_pipeline.run_once()) == 0
+
+        reserve, confirm = order_pipeline.client.post.call_args_list
+        assert reserve.kwargs["json"] == {"items": [{"id": "product-1", "quantity": 2}, {"id": "product-2", "quantity": 1}]}
+        assert reserve.kwargs["headers"] == {"Idempotency-Key": order_id}
+        assert confirm.args[0].endswith("/reservations/res-1/confirm")
+        with test_engine.connect() as conn:
+            assert conn.execute(order_pipeline_table.select()).fetchall() == []
+        assert client.get("/api/orders/stats").json()["perDay"][0]["byStatus"] == {"fulfilled": {"orders": 1, "revenue": 79.97}}
+        metrics_body = client.get("/metrics").text
+        assert 'order_pipeline_transitions_total{from="received",to="reserved"}' in metrics_body
+        assert 'order_pipeline_stage_seconds_total{stage="confirmed"}' in metrics_body
+
+    def test_out_of_stock_fails_without_retry(self, pipeline_client, sample_order_payload, test_engine):
+        """Test that a 409 from inventory-api fails the order at once"""
+        client, order_pipeline = pipeline_client
+        order_pipeline.client.post.side_effect = None
+        order_pipeline.client.post.return_value = inventory_response(409, {"detail": {"shortages": []}})
+        order_id = client.post("/api/orders", json=sample_order_payload).json()["orderId"]
+        asyncio.run(order_pipeline.run_once())
+        assert order_status(test_engine, order_id) == "failed"
+        assert order_pipeline.stats["retries"] == 0
+
+    def test_errors_are_retried_then_fail_and_release(self, pipeline_client, sample_order_payload, test_engine):
+        """Test the retry budget, and that a held reservation is released on failure"""
+        client, order_pipeline = pipeline_client
+        order_pipeline.max_attempts = 3
+        order_id = client.post("/api/orders", json=sample_order_payload).json()["orderId"]
+        asyncio.run(order_pipeline.run_once())  # Reserved
+        order_pipeline.client.post.side_effect = None
+        order_pipeline.client.post.return_value = inventory_response(503)
+
+        for _ in range(2):
+            asyncio.run(order_pipeline.run_once())
+            assert order_status(test_engine, order_id) == "reserved"
+        with test_engine.connect() as conn:
+            assert conn.execute(order_pipeline_table.select()).first().attempts == 2
+        asyncio.run(order_pipeline.run_once())
+        assert order_status(test_engine, order_id) == "failed"
+        assert order_pipeline.stats["retries"] == 2
+        order_pipeline.client.delete.assert_called_once()
+        assert order_pipeline.client.delete.call_args.args[0].endswith("/reservations/res-1")
+
+    def test_claims_are_exclusive_leases(self, pipeline_client, sample_order_payload, test_engine):
+        """Test that a claimed order is hidden from other workers until its lease expires"""
+        client, _ = pipeline_client
+        client.post("/api/orders/batch", json={"orders": [sample_order_payload] * 3})
+        now = time.time()
+        first = pipeline.claim(test_engine, 2, lease_seconds=30, now=now)
+        second = pipeline.claim(test_engine, 2, lease_seconds=30, now=now)
+        assert len(first) == 2 and len(second) == 1
+        assert pipeline.claim(test_engine, 10, lease_seconds=30, now=now) == []
+
+        # The first worker died: its orders come back after the lease, its late update is refused
+        retaken = pipeline.claim(test_engine, 10, lease_seconds=30, now=now + 31)
+        assert {job["order_id"] for job in retaken} == {job["order_id"] for job in first + second}
+        assert pipeline.advance(test_engine, first[0], "reserved", {}) is False
+
+
+    def test_lost_lease_releases_hold_only_once_order_is_done(self, pipeline_client, sample_order_payload, test_engine):
+        """Test that a late worker drops its hold when the order has left the pipeline, and only then"""
+        client, order_pipeline = pipeline_client
+        client.post("/api/orders", json=sample_order_payload)
+        now = time.time()
+        late = pipeline.claim(test_engine, 1, lease_seconds=30, now=now)[0]
+
+        # Taken over: the new owner reuses the same (idempotent) hold, nothing to release
+        pipeline.claim(test_engine, 1, lease_seconds=30, now=now + 31)
+        asyncio.run(order_pipeline.process(test_engine, late))
+        order_pipeline.client.delete.assert_not_called()
+
+        # Failed meanwhile: the hold made by the late reserve would only expire
+        with test_engine.begin() as conn:
+            conn.execute(order_pipeline_table.delete())
+        asyncio.run(order_pipeline.process(test_engine, late))
+        assert order_pipeline.stats["lost_leases"] == 2
+        order_pipeline.client.delete.assert_called_once()
+        assert order_pipeline.client.delete.call_args.args[0].endswith("/reservations/res-1")
+
+class TestPrecompiledStatements:
+    """Test suite for the statements built once and reused on the order path"""
+
+    def test_order_path_reuses_compiled_statements(self, client, sample_order_payload):
+        """Test that once warm, placing and reading an order compiles no SQL"""
+        first = client.post("/api/orders", json=sample_order_payload, headers={"Idempotency-Key": "warm-up"}).json()
+        client.get(f"/api/orders/{first['orderId']}")
+
+        query_cache.stats.clear()
+        second = client.post("/api/orders", json=sample_order_payload, headers={"Idempotency-Key": "second"}).json()
+        assert client.get(f"/api/orders/{second['orderId']}").status_code == 200
+        assert query_cache.stats["hit"] > 0
+        assert query_cache.stats["miss"] == 0
+
+
+class TestAdmissionControl:
+    """Test suite for admission control and load shedding"""
+
+    def test_checkout_is_admitted_before_reads(self):
+        """Test that a freed slot goes to a queued checkout before an earlier queued read"""
+        async def scenario():
+            controller = AdmissionController("test", max_concurrency=1)
+            assert await controller.acquire(READ)
+            order = []
+
+            async def request(name):
+                assert await controller.acquire(name)
+                order.append(name)
+                controller.release(name)
+
+            read = asyncio.ensure_future(request(READ))
+            await asyncio.sleep(0)
+            checkout = asyncio.ensure_future(request(CHECKOUT))
+            await asyncio.sleep(0)
+            assert [len(c.waiters) for c in controller.classes.values()] == [1, 1]
+            controller.release(READ)
+            await asyncio.gather(read, checkout)
+            return order, controller.active
+
+        assert asyncio.run(scenario()) == ([CHECKOUT, READ], 0)
+
+    def test_full_queue_and_timeout_are_shed(self):
+        """Test that requests beyond the queue, or waiting too long, are refused"""
+        async def scenario():
+            controller = AdmissionController("test", max_concurrency=1, queue_timeout=0.05)
+            controller.classes[READ].queue_size = 1
+            assert await controller.acquire(READ)
+            queued = asyncio.ensure_future(controller.acquire(READ))
+            await asyncio.sleep(0)
+            over_queue = await controller.acquire(READ)
+            return over_queue, await queued, controller.classes[READ].stats
+
+        over_queue, queued, stats = asyncio.run(scenario())
+        assert over_queue is False and queued is False
+        assert stats["shed"] == 2 and stats["timeouts"] == 1
+
+    def test_shed_request_gets_503_with_retry_after(self):
+        """Test the middleware's fast 503 response"""
+        async def scenario():
+            controller = AdmissionController("test", max_concurrency=0)
+            controller.classes[CHECKOUT].queue_size = 0
+            middleware = AdmissionMiddleware(AsyncMock(), controller, classify=lambda method, path: CHECKOUT)
+            sent = []
+
+            async def send(message):
+                sent.append(message)
+
+            await middleware({"type": "http", "method": "POST", "path": "/api/orders"}, AsyncMock(), send)
+            return sent
+
+        start, body = asyncio.run(scenario())
+        assert start["status"] == 503
+        assert (b"retry-after", b"1") in start["headers"]
+        assert b"overloaded" in body["body"]
+
+    def test_routes_are_classified(self):
+        """Test that order creation is checkout and listing is a read"""
+        assert main.classify_route("POST", "/api/orders") == CHECKOUT
+        assert main.classify_route("POST", "/api/orders/batch") == CHECKOUT
+        assert main.classify_route("GET", "/api/orders") == READ
+        assert main.classify_route("GET", "/metrics") is None
+
+    def test_queue_depth_exported(self, client, sample_order_payload):
+        """Test the gauges the HPA scales on"""
+        client.post("/api/orders", json=sample_order_payload)
+        body = client.get("/metrics").text
+        assert 'admission_queue_depth{route_class="checkout",service="orders-api"} 0' in body
+        assert 'admission_admitted_total{route_class="checkout",service="orders-api"}' in body
+
+
 class TestPydanticModels:
     """Test suite for Pydantic models"""
     
@@ -0,0 +1,59 @@
+"""
+Performance regression gate (see perf_gate.py), skipped unless asked for:
+
+    PERF_TESTS=1 pytest test_perf.py               # check against perf_baseline.json
+    PERF_UPDATE_BASELINE=1 pytest test_perf.py     # record a new baseline
+"""
+import pytest
+from pathlib import Path
+
+import perf_gate
+from benchmark_batch import sample_order
+from perf_gate import PerfGate
+from test_main import client, mock_httpx_client, test_engine  # noqa: F401 (fixtures)
+
+pytestmark = pytest.mark.skipif(not perf_gate.PERF_TESTS, reason="perf gate runs with PERF_TESTS=1")
+
+CART_LINES = 20
+BATCH_ORDERS = 10
+
+
+@pytest.fixture(scope="module")
+def perf():
+    gate = PerfGate(Path(__file__).with_name("perf_baseline.json"))
+    yield gate
+    gate.save()
+
+
+class TestPerfOrders:
+    """Statement counts and latency of the order endpoints against the stored baseline"""
+
+    def test_create_order_one_line(self, perf, client):
+        order = sample_order(1)
+        result = perf.measure("create_order_1_line", lambda: client.post("/api/orders", json=order))
+        perf.check("create_order_1_line", result)
+
+    def test_create_order_many_lines(self, perf, client):
+        # A statement added per cart line shows up here CART_LINES times
+        order = sample_order(CART_LINES)
+        result = perf.measure(f"create_order_{CART_LINES}_lines", lambda: client.post("/api/orders", json=order))
+        perf.check(f"create_order_{CART_LINES}_lines", result)
+
+    def test_create_order_idempotent(self, perf, client):
+        order = sample_order(CART_LINES)
+        keys = iter(range(10**6))
+        result = perf.measure(
+            "create_order_idempotency_key",
+            lambda: client.post("/api/orders", json=order, headers={"Idempotency-Key": f"perf-{next(keys)}"}),
+        )
+        perf.check("create_order_idempotency_key", result)
+
+    def test_create_orders_batch(self, perf, client):
+        batch = {"orders": [sample_order(CART_LINES) for _ in range(BATCH_ORDERS)]}
+        result = perf.measure(f"create_batch_{BATCH_ORDERS}x{CART_LINES}", lambda: client.post("/api/orders/batch", json=batch))
+        perf.check(f"create_batch_{BATCH_ORDERS}x{CART_LINES}", result)
+
+    def test_get_order(self, perf, client):
+        order_id = client.post("/api/orders", json=sample_order(CART_LINES)).json()["orderId"]
+        result = perf.measure("get_order", lambda: client.get(f"/api/orders/{order_id}"))
+        perf.check("get_order", result)
@@ -0,0 +1,294 @@
+"""
+Category, attribute and price-range browsing.
+
+Products have a category (indexed, and together with price for range queries) and free-form
+string attributes ({"brand": "Sony", ...}), which are also kept one row per attribute in
+product_attributes so a filter on them is an index lookup.
+
+GET /api/products?category=&min_price=&max_price=&attr=name:value returns the matching
+products with facet counts. The counts are never computed with a GROUP BY per request:
+product_facets holds the number of products per facet value, per category scope, and every
+product write moves its own counts in the same transaction (one upsert, keys sorted so
+concurrent writes lock them in the same order):
+
+- ("", "category", <category>): products per category, over the whole catalog
+- (<scope>, "price", <bucket>): products per price range, PRICE_FACET_BOUNDARIES
+- (<scope>, "attr:<name>", <value>): products per attribute value
+
+where <scope> is "" (whole catalog) and the product's category. Facet counts are for the
+requested category and don't narrow with the price and attribute filters.
+
+Existing products (or counts after changing PRICE_FACET_BOUNDARIES) are rebuilt with:
+
+    python catalog.py --rebuild
+"""
+import argparse
+import os
+from bisect import bisect_right
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import bindparam, delete, func, inspect, select, text
+from sqlalchemy.dialects import postgresql, sqlite
+
+from database import products_table, product_attributes_table, product_facets_table
+
+ALL = ""  # Scope of the whole catalog
+PRICE_FACET_BOUNDARIES = [float(bound) for bound in os.getenv("PRICE_FACET_BOUNDARIES", "50,100,250,500,1000").split(",")]
+BROWSE_DEFAULT_LIMIT = 50
+BROWSE_MAX_LIMIT = 200
+
+_dialect_inserts = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+# Hot-path statements, built once (see query_cache.py)
+select_facets = select(product_facets_table).where(
+    product_facets_table.c.scope.in_(bindparam("scopes", expanding=True)), product_facets_table.c.products > 0
+)
+delete_attributes = delete(product_attributes_table).where(
+    product_attributes_table.c.product_id.in_(bindparam("product_ids", expanding=True))
+)
+insert_attributes = product_attributes_table.insert()
+_upserts: Dict[str, Any] = {}
+
+Key = Tuple[str, str, str]
+
+
+def price_bucket(price: float) -> str:
+    """The PRICE_FACET_BOUNDARIES range a price falls in, by index ("0" is below the first bound)."""
+    return str(bisect_right(PRICE_FACET_BOUNDARIES, price))
+
+
+def price_range(bucket: str) -> Dict[str, Optional[float]]:
+    index = int(bucket)
+    return {
+        "min": PRICE_FACET_BOUNDARIES[index - 1] if index else 0.0,
+        "max": PRICE_FACET_BOUNDARIES[index] if index < len(PRICE_FACET_BOUNDARIES) else None,
+    }
+
+
+def facet_keys(product) -> List[Key]:
+    """(scope, facet, value) counts a product (a dict or row with the products columns) is in."""
+    category = product["category"]
+    scopes = [ALL, category] if category else [ALL]
+    keys = [(ALL, "category", category)] if category else []
+    for scope in scopes:
+        if product["price"] is not None:
+            keys.append((scope, "price", price_bucket(product["price"])))
+        keys.extend((scope, f"attr:{name}", str(value)) for name, value in (product["attributes"] or {}).items())
+    return keys
+
+
+def _add(conn, deltas: Counter):
+    """Adds the deltas to the product_facets rows with the same key (or inserts them)."""
+    rows = [
+        {"scope": scope, "facet": facet, "value": value, "products": delta}
+        for (scope, facet, value), delta in sorted(deltas.items())
+        if delta
+    ]
+    if not rows:
+        return
+    facets = product_facets_table
+    dialect_insert = _dialect_inserts.get(conn.dialect.name)
+    if dialect_insert is None:
+        # Other databases: update, then insert the keys that weren't there yet
+        for row in rows:
+            key = [facets.c.scope == row["scope"], facets.c.facet == row["facet"], facets.c.value == row["value"]]
+            if not conn.execute(facets.update().where(*key).values(products=facets.c.products + row["products"])).rowcount:
+                conn.execute(facets.insert().values(**row))
+        return
+    upsert = _upserts.get(conn.dialect.name)
+    if upsert is None:
+        statement = dialect_insert(facets)
+        upsert = _upserts[conn.dialect.name] = statement.on_conflict_do_update(
+            index_elements=["scope", "facet", "value"],
+            set_={"products": facets.c.products + statement.excluded.products},
+        )
+    conn.execute(upsert, rows)
+
+
+def record_changes(conn, changes: Iterable[Tuple[Optional[Any], Dict[str, Any]]]):
+    """
+    Moves the facet counts and attribute rows of (old, new) product pairs, old being None
+    for a new product. Call it inside the transaction that writes the products.
+    """
+    deltas: Counter = Counter()
+    attributes = []
+    product_ids = []
+    for old, new in changes:
+        if old is not None:
+            deltas.subtract(facet_keys(old))
+        deltas.update(facet_keys(new))
+        product_ids.append(new["id"])
+        attributes.extend(
+            {"product_id": new["id"], "name": name, "value": str(value)}
+            for name, value in (new["attributes"] or {}).items()
+        )
+    if not product_ids:
+        return
+    _add(conn, deltas)
+    conn.execute(delete_attributes, {"product_ids": product_ids})
+    if attributes:
+        conn.execute(insert_attributes, attributes)
+
+
+# --- Reads ---
+
+def parse_attribute_filters(filters: List[str]) -> List[Tuple[str, str]]:
+    """["brand:Sony", ...] -> [("brand", "Sony"), ...]; raises ValueError without a ':'."""
+    pairs = []
+    for attribute in filters:
+        name, separator, value = attribute.partition(":")
+        if not separator or not name:
+            raise ValueError(f"Attribute filter {attribute!r} is not name:value")
+        pairs.append((name, value))
+    return pairs
+
+
+def browse(conn, category: Optional[str] = None, min_price: Optional[float] = None,
+           max_price: Optional[float] = None, attributes: Iterable[Tuple[str, str]] = (),
+           limit: int = BROWSE_DEFAULT_LIMIT, offset: int = 0) -> Dict[str, Any]:
+    """One page of matching products (by name), how many match, and the facet counts."""
+    products = products_table.c
+    conditions = []
+    if category is not None:
+        conditions.append(products.category == category)
+    if min_price is not None:
+        conditions.append(products.price >= min_price)
+    if max_price is not None:
+        conditions.append(products.price <= max_price)
+    for name, value in attributes:
+        attribute = product_attributes_table.c
+        conditions.append(
+            select(attribute.product_id)
+            .where(attribute.product_id == products.id, attribute.name == name, attribute.value == value)
+            .exists()
+        )
+
+    page = conn.execute(
+        select(products_table).where(*conditions).order_by(products.name, products.id).limit(limit).offset(offset)
+    ).fetchall()
+    total = conn.execute(select(func.count()).select_from(products_table).where(*conditions)).scalar()
+    return {
+        "products": [dict(row._asdict()) for row in page],
+        "total": total,
+        "limit": limit,
+        "offset": offset,
+        "facets": facet_counts(conn, category),
+    }
+
+
+def facet_counts(conn, category: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Categories over the whole catalog, price ranges and attribute values within `category`
+    (or the whole catalog), from product_facets.
+    """
+    scope = category or ALL
+    categories: Dict[str, int] = {}
+    prices: Dict[str, int] = {}
+    attributes: Dict[str, Dict[str, int]] = {}
+    for row in conn.execute(select_facets, {"scopes": sorted({ALL, scope})}):
+        if row.facet == "category":
+            categories[row.value] = row.products
+        elif row.scope != scope:
+            continue
+        elif row.facet == "price":
+            prices[row.value] = row.products
+        else:
+            attributes.setdefault(row.facet[len("attr:"):], {})[row.value] = row.products
+    return {
+        "category": dict(sorted(categories.items())),
+        "price": [{**price_range(bucket), "products": prices[bucket]} for bucket in sorted(prices, key=int)],
+        "attributes": {name: dict(sorted(values.items())) for name, values in sorted(attributes.items())},
+    }
+
+
+# --- Schema and rebuild ---
+
+# pg_advisory_xact_lock key serializing ensure_schema() across replicas starting together
+SCHEMA_LOCK_KEY = 0x70726F64
+REBUILD_FETCH_ROWS = 1000
+
+
+def ensure_schema(engine):
+    """
+    Adds the category and attributes columns and their indexes to a products table created
+    before they existed, and counts its products if product_facets is still empty.
+    Replicas run it at startup: on Postgres one at a time (advisory lock), so the others
+    wait and then find the columns and counts in place.
+    """
+    with engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+        existing = {column["name"] for column in inspect(conn).get_columns("products")}
+        for column in (products_table.c.category, products_table.c.attributes):
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=conn.dialect)
+                conn.execute(text(f'ALTER TABLE products ADD COLUMN "{column.name}" {column_type}'))
+        for index in products_table.indexes:
+            index.create(conn, checkfirst=True)
+        if not conn.execute(select(func.count()).select_from(product_facets_table)).scalar():
+            _rebuild(conn)
+
+
+def rebuild(engine) -> int:
+    """
+    Recomputes product_facets and product_attributes from the products table in one
+    transaction. Returns the number of products counted.
+    """
+    with engine.begin() as conn:
+        return _rebuild(conn)
+
+
+def _rebuild(conn) -> int:
+    facets = product_facets_table
+    if conn.dialect.name == "postgresql":
+        # Waits for product writes in flight and holds new ones until the recount commits,
+        # after which their deltas apply on top of it. Two rebuilds run one after the other.
+        conn.execute(text("LOCK TABLE product_facets IN EXCLUSIVE MODE"))
+    conn.execute(delete(facets))
+    conn.execute(delete(product_attributes_table))
+
+    counts: Counter = Counter()
+    counted = 0
+    attributes: List[Dict[str, str]] = []
+    query = select(products_table.c.id, products_table.c.category, products_table.c.price, products_table.c.attributes)
+    for row in conn.execution_options(yield_per=REBUILD_FETCH_ROWS).execute(query):
+        product = row._asdict()
+        counts.update(facet_keys(product))
+        counted += 1
+        attributes.extend(
+            {"product_id": product["id"], "name": name, "value": str(value)}
+            for name, value in (product["attributes"] or {}).items()
+        )
+        if len(attributes) >= REBUILD_FETCH_ROWS:
+            conn.execute(insert_attributes, attributes)
+            attributes = []
+    if attributes:
+        conn.execute(insert_attributes, attributes)
+
+    # Absolute counts: whatever is in the table, a rebuild sets it, never adds to it
+    rows = [
+        {"scope": scope, "facet": facet, "value": value, "products": products}
+        for (scope, facet, value), products in sorted(counts.items())
+    ]
+    if rows:
+        dialect_insert = _dialect_inserts.get(conn.dialect.name)
+        if dialect_insert is None:
+            conn.execute(facets.insert(), rows)
+        else:
+            statement = dialect_insert(facets)
+            conn.execute(statement.on_conflict_do_update(
+                index_elements=["scope", "facet", "value"], set_={"products": statement.excluded.products},
+            ), rows)
+    return counted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rebuild", action="store_true", help="recompute the facet counts from the products table")
+    args = parser.parse_args()
+    if args.rebuild:
+        from database import engine
+        print(f"Rebuilt facet counts from {rebuild(engine)} products.")
+    else:
+        parser.print_help()
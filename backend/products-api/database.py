@@ -1,5 +1,7 @@
 import os
-from sqlalchemy import create_engine, Column, Integer, String, Float, MetaData, Table
+from sqlalchemy import create_engine, Column, Index, Integer, JSON, String, Float, MetaData, Table, Text
+
+import query_cache
 
 # 1. Get DB credentials from Environment Variables (injected by K8s)
 DB_USER = os.getenv("DB_USER", "postgres")
@@ -14,7 +16,8 @@ DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NA
 
 # 3. Create the Engine
 # Note: check_same_thread is REMOVED (it is only for SQLite)
-engine = create_engine(DATABASE_URL)
+# Server-side prepared statements where the driver supports them (see query_cache.py)
+engine = create_engine(DATABASE_URL, connect_args=query_cache.connect_args(DATABASE_URL))
 
 metadata = MetaData()
 
@@ -27,6 +30,48 @@ products_table = Table(
     Column("price", Float),
     Column("description", String),
     Column("imageUrl", String),
+    # Browsing by category and attributes (see catalog.py)
+    Column("category", String, index=True),
+    Column("attributes", JSON), # {"brand": "Sony", "color": "black", ...}
+    Index("ix_products_category_price", "category", "price"),
+    Index("ix_products_price", "price"),
+)
+
+# Define the 'product_attributes' table
+# One row per product attribute, so attribute filters are index lookups
+# (products.attributes stays the copy that is returned to clients)
+product_attributes_table = Table(
+    "product_attributes",
+    metadata,
+    Column("product_id", String, primary_key=True),
+    Column("name", String, primary_key=True),
+    Column("value", String, nullable=False),
+    Index("ix_product_attributes_name_value", "name", "value", "product_id"),
+)
+
+# Define the 'product_facets' table
+# Products per facet value, kept up to date by every product write (see catalog.py).
+# scope is a category, or "" for the whole catalog.
+product_facets_table = Table(
+    "product_facets",
+    metadata,
+    Column("scope", String, primary_key=True),
+    Column("facet", String, primary_key=True), # "category", "price" or "attr:<name>"
+    Column("value", String, primary_key=True),
+    Column("products", Integer, nullable=False, default=0),
+)
+
+# Define the 'cache_invalidations' table
+# Change feed for cache invalidation when the database has no LISTEN/NOTIFY (SQLite):
+# writers append the changed keys, every replica polls for rows newer than it has seen.
+# Shared with inventory-api (same database, same definition).
+cache_invalidations_table = Table(
+    "cache_invalidations",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("channel", String, nullable=False),
+    Column("changed_keys", Text, nullable=False),
+    Column("created_at", Float, nullable=False, index=True),
 )
 
 def create_db_and_tables():
@@ -0,0 +1,128 @@
+"""
+Negative-lookup filter for product IDs.
+
+Bots and broken links request IDs that don't exist; each used to cost a database round
+trip before the 404. KnownIdFilter keeps a Bloom filter over the known IDs: "not in the
+filter" means the ID definitely doesn't exist and is answered without the database.
+"Maybe in the filter" falls through to the normal lookup (false positives cost what
+every lookup cost before, never a wrong answer).
+
+The filter is built at startup from the table, updated on insert, and rebuilt at twice
+the size once it holds more IDs than it was sized for (its false-positive rate would
+otherwise climb). Until it is built every ID passes.
+
+Items, memory, the expected false-positive rate, definite misses and the false positives
+actually seen are exposed on GET /metrics.
+
+This file is identical in products-api and inventory-api (each service is its own image).
+"""
+import hashlib
+import math
+import os
+import threading
+from typing import Callable, Iterable, List, Optional
+
+import metrics
+
+ID_FILTER_FP_RATE = float(os.getenv("ID_FILTER_FP_RATE", "0.01"))
+ID_FILTER_MIN_CAPACITY = int(os.getenv("ID_FILTER_MIN_CAPACITY", "10000"))
+
+_filters: List["KnownIdFilter"] = []
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter, sized for `capacity` items at false-positive rate `fp_rate`."""
+
+    def __init__(self, capacity: int, fp_rate: float = ID_FILTER_FP_RATE):
+        self.capacity = capacity
+        self.size_bits = max(64, int(math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.size_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str):
+        # Double hashing: k positions from one 128-bit digest
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size_bits for i in range(self.hash_count)]
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    @property
+    def memory_bytes(self) -> int:
+        return len(self.bits)
+
+    @property
+    def expected_fp_rate(self) -> float:
+        """(1 - e^(-kn/m))^k for the items added so far."""
+        return (1 - math.exp(-self.hash_count * self.count / self.size_bits)) ** self.hash_count
+
+
+class KnownIdFilter:
+    def __init__(self, name: str, load_ids: Callable[[], Iterable[str]]):
+        self.name = name
+        self.load_ids = load_ids
+        self.bloom: Optional[BloomFilter] = None
+        self.lock = threading.Lock()
+        self.stats = {"definite_misses": 0, "false_positives": 0}
+        _filters.append(self)
+
+    @property
+    def ready(self) -> bool:
+        return self.bloom is not None
+
+    def build(self):
+        """(Re)builds from load_ids(), sized for twice the current number of IDs."""
+        ids = list(self.load_ids())
+        bloom = BloomFilter(max(ID_FILTER_MIN_CAPACITY, 2 * len(ids)))
+        for product_id in ids:
+            bloom.add(product_id)
+        with self.lock:
+            self.bloom = bloom
+        print(f"[{self.name}] ID filter built: {len(ids)} IDs, {bloom.memory_bytes} bytes.")
+
+    def add(self, product_ids: Iterable[str]):
+        """Records inserted IDs (after commit). Rebuilds larger once over capacity."""
+        bloom = self.bloom
+        if bloom is None:
+            return
+        with self.lock:
+            for product_id in product_ids:
+                if product_id not in bloom:
+                    bloom.add(product_id)
+            full = bloom.count > bloom.capacity
+        if full:
+            self.build()
+
+    def definitely_missing(self, product_id: str) -> bool:
+        bloom = self.bloom
+        if bloom is None or product_id in bloom:
+            return False
+        self.stats["definite_misses"] += 1
+        return True
+
+    def record_false_positive(self):
+        # The filter said "maybe" but the database had nothing
+        self.stats["false_positives"] += 1
+
+
+@metrics.register
+def _collect():
+    built = [id_filter for id_filter in _filters if id_filter.bloom is not None]
+    for name, metric_type, help_text, value in (
+        ("id_filter_items", "gauge", "IDs in the negative-lookup filter", lambda f: f.bloom.count),
+        ("id_filter_memory_bytes", "gauge", "Size of the filter's bit array", lambda f: f.bloom.memory_bytes),
+        ("id_filter_expected_false_positive_rate", "gauge", "Expected false-positive rate at the current fill",
+         lambda f: round(f.bloom.expected_fp_rate, 6)),
+        ("id_filter_definite_misses_total", "counter", "Lookups answered as missing without the database",
+         lambda f: f.stats["definite_misses"]),
+        ("id_filter_false_positives_total", "counter", "Lookups the filter passed that the database didn't find",
+         lambda f: f.stats["false_positives"]),
+    ):
+        yield name, metric_type, help_text, [({"filter": id_filter.name}, value(id_filter)) for id_filter in built]
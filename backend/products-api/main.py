@@ -1,11 +1,46 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel
+from typing import Dict, List, Optional
+from sqlalchemy import bindparam, select, update
 from database import engine, products_table, create_db_and_tables # Import from our new file
 from seed_db import seed_database
+import catalog
+from shared_cache import SharedCache
+import cache_invalidation
+import metrics
+import profiling
+from single_flight import SingleFlight
+from starlette.concurrency import run_in_threadpool
+from id_filter import KnownIdFilter
+from admission import AdmissionController, AdmissionMiddleware, READ
+import asyncio
+import os
+
+# --- Pydantic Models (Data Contracts) ---
+# What the catalog admin sends to create or replace a product
+class ProductPayload(BaseModel):
+    name: str
+    price: float
+    description: str = ""
+    imageUrl: str = ""
+    category: Optional[str] = None
+    attributes: Dict[str, str] = {}
+
 # --- FastAPI App ---
 app = FastAPI()
 
+# --- Admission Control ---
+# Bounded concurrency and wait queue per route class, 503 + Retry-After when full
+# (see admission.py). Added before CORS so shed responses still carry CORS headers.
+def classify_route(method: str, path: str):
+    # Health checks and /metrics are never queued
+    return READ if path.startswith("/api/products") else None
+
+admission_controller = AdmissionController("products-api")
+app.add_middleware(AdmissionMiddleware, controller=admission_controller, classify=classify_route)
+
 # --- CORS Configuration ---
 
 app.add_middleware(
@@ -19,50 +54,172 @@ app.add_middleware(
     allow_headers=["*"], # Allow all headers
 )
 
+# --- Profiling ---
+# Guarded /debug/profile endpoints and per-request profiling (see profiling.py)
+profiling.install(app)
+
+# --- Cache ---
+# Products change rarely: cache them in-process and, with CACHE_URL set,
+# in the cache tier shared by all replicas (see shared_cache.py).
+# Writes notify every replica, which evicts its in-process copies (see cache_invalidation.py).
+PRODUCT_CACHE_TTL_SECONDS = float(os.getenv("PRODUCT_CACHE_TTL_SECONDS", "300"))
+PRODUCTS_CHANNEL = "products_changed"
+product_cache = SharedCache("products")
+product_lookups = SingleFlight("products")
+
+# Unknown IDs are answered with a 404 without touching the database (see id_filter.py)
+def load_product_ids():
+    with engine.connect() as conn:
+        return [row[0] for row in conn.execute(select(products_table.c.id))]
+
+product_filter = KnownIdFilter("products", load_product_ids)
+
+def products_changed(keys: List[str]):
+    product_cache.evict_local(keys)
+    # New products created on another replica
+    product_filter.add(key for key in keys if key != "all")
+
+def products_resync():
+    product_cache.clear_local()
+    if product_filter.ready:
+        product_filter.build()
+
+product_listener = cache_invalidation.InvalidationListener(
+    PRODUCTS_CHANNEL, on_keys=products_changed, on_resync=products_resync
+)
+
 # --- Database Connection ---
 # This event runs when the FastAPI app starts up
 @app.on_event("startup")
 def on_startup():
     # 1. Create Tables (if they don't exist)
     create_db_and_tables()
+    # Category/attribute columns on an older products table, and the facet counts (see catalog.py)
+    catalog.ensure_schema(engine)
     
     # 2. Seed Data (if table is empty)
     # This will uses the SAME engine, so it connects to RDS
     seed_database()
 
+    # 3. Load the known product IDs into the negative-lookup filter
+    product_filter.build()
+
+    # 4. Evict cached products when another replica changes them
+    app.state.background_tasks = [asyncio.create_task(product_listener.run())]
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    for task in getattr(app.state, "background_tasks", []):
+        task.cancel()
+
 # --- API Endpoints (Now using the database) ---
 
 @app.get("/")
 def read_root():
     return {"status": "Products API is running and connected to database"}
 
-# Endpoint to get all products
+# Prometheus scrape endpoint (see metrics.py)
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return metrics.render()
+
+# Hot-path statements, built once (see query_cache.py)
+select_all_products = products_table.select()
+select_product = products_table.select().where(products_table.c.id == bindparam("product_id"))
+lock_product = select_product.with_for_update()
+# The SET clause comes from the parameter names (every ProductPayload field)
+update_product = update(products_table).where(products_table.c.id == bindparam("product_id"))
+insert_product = products_table.insert()
+
+# Endpoint to get all products, or to browse them with facet counts (see catalog.py)
 @app.get("/api/products")
-async def get_all_products():
+async def get_all_products(
+    category: Optional[str] = None,
+    min_price: Optional[float] = Query(None, ge=0),
+    max_price: Optional[float] = Query(None, ge=0),
+    attr: List[str] = Query([], description="Attribute filters, name:value"),
+    facets: bool = Query(False, description="Browse the whole catalog with facet counts"),
+    limit: int = Query(catalog.BROWSE_DEFAULT_LIMIT, ge=1, le=catalog.BROWSE_MAX_LIMIT),
+    offset: int = Query(0, ge=0),
+):
+    if category is not None or min_price is not None or max_price is not None or attr or facets:
+        try:
+            attributes = catalog.parse_attribute_filters(attr)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        key = ("browse", category, min_price, max_price, tuple(attributes), limit, offset)
+        return await product_lookups.run(key, browse_products, category, min_price, max_price, attributes, limit, offset)
+
+    # Without filters: the whole catalog as a plain list, as before
+    cached = await product_cache.aget("all")
+    if cached is not None:
+        return cached
+    # Concurrent misses share one query (see single_flight.py)
+    return await product_lookups.run("all", load_all_products)
+
+def load_all_products():
     # Connect to the database
     with engine.connect() as conn:
-        # Build a query to select all rows from the products table
-        query = products_table.select()
-        # Execute the query and fetch all results
-        result = conn.execute(query).fetchall()
+        # Select all rows from the products table and fetch all results
+        result = conn.execute(select_all_products).fetchall()
         
         # Convert the list of (row) objects to a list of (dict) objects
         # The frontend (Next.js) expects a JSON array of objects
         products = [dict(row._asdict()) for row in result]
+        product_cache.set("all", products, PRODUCT_CACHE_TTL_SECONDS)
         return products
 
+def browse_products(category, min_price, max_price, attributes, limit, offset):
+    with engine.connect() as conn:
+        return catalog.browse(conn, category, min_price, max_price, attributes, limit, offset)
+
 # Endpoint to get a single product by its ID
 @app.get("/api/products/{product_id}")
 async def get_product(product_id: str):
+    if product_filter.definitely_missing(product_id):
+        raise HTTPException(status_code=404, detail=f"Product with ID {product_id} not found")
+
+    cached = await product_cache.aget(product_id)
+    if cached is not None:
+        return cached
+
+    product = await product_lookups.run(product_id, load_product, product_id)
+    if product is None:
+        product_filter.record_false_positive()
+        # If no product is found, raise a 404 error
+        raise HTTPException(status_code=404, detail=f"Product with ID {product_id} not found")
+    return product
+
+def load_product(product_id: str):
     with engine.connect() as conn:
-        # Build a query to select the product where id matches product_id
-        query = products_table.select().where(products_table.c.id == product_id)
-        # Execute the query and fetch the first (and only) result
-        result = conn.execute(query).first()
+        # Select the product where id matches product_id, fetch the first (and only) result
+        result = conn.execute(select_product, {"product_id": product_id}).first()
         
-        if result:
-            # Convert the single row to a dictionary
-            return dict(result._asdict())
+        if result is None:
+            return None
+        # Convert the single row to a dictionary
+        product = dict(result._asdict())
+        product_cache.set(product_id, product, PRODUCT_CACHE_TTL_SECONDS)
+        return product
+
+# Endpoint for the catalog admin to create or replace a product
+@app.put("/api/products/{product_id}")
+async def put_product(product_id: str, payload: ProductPayload):
+    product = await run_in_threadpool(write_product, product_id, payload)
+    await product_cache.adelete_many([product_id, "all"])
+    product_filter.add([product_id])
+    return product
+
+def write_product(product_id: str, payload: ProductPayload):
+    product = {"id": product_id, **payload.model_dump()}
+    with engine.begin() as conn:
+        old = conn.execute(lock_product, {"product_id": product_id}).first()
+        if old is not None:
+            conn.execute(update_product, {"product_id": product_id, **payload.model_dump()})
         else:
-            # If no product is found, raise a 404 error
-            raise HTTPException(status_code=404, detail=f"Product with ID {product_id} not found")
\ No newline at end of file
+            conn.execute(insert_product, product)
+        # Facet counts and attribute rows move with the product (see catalog.py)
+        catalog.record_changes(conn, [(old._asdict() if old is not None else None, product)])
+        # Delivered to every replica when this transaction commits
+        cache_invalidation.publish(conn, PRODUCTS_CHANNEL, [product_id, "all"])
+    return product
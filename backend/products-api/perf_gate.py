@@ -0,0 +1,143 @@
+"""
+Performance regression gate for the test_perf.py suites.
+
+The test_main.py suites only check behaviour, so an extra query per cart line or a slower
+serializer ships unnoticed. test_perf.py runs key endpoints in-process (TestClient against
+in-memory SQLite) and measures, per scenario:
+
+- statements: SQL statements sent to the database per request, counted with a SQLAlchemy
+  after_cursor_execute listener (an executemany is one statement). Deterministic, so the
+  default margin is 0: one statement more than the baseline fails.
+- median_ms: median wall time of PERF_ROUNDS requests, after PERF_WARMUP untimed ones
+  (compiled statement caches warm), with min/max reported alongside.
+
+Both are compared against perf_baseline.json, next to the suite. Latency is normalized by a
+fixed pure-Python calibration workload timed on the same machine, stored with the baseline,
+so a baseline recorded on a laptop still means something on a CI runner. A scenario fails
+when
+
+    statements > baseline statements + PERF_STATEMENT_MARGIN          (default 0)
+    median_ms  > baseline median_ms * speed ratio * (1 + PERF_LATENCY_MARGIN)   (default 0.5)
+
+The suites are skipped unless PERF_TESTS=1 (run-all-tests.sh --perf). Record or refresh
+the baseline after an intended change with PERF_UPDATE_BASELINE=1 (run-all-tests.sh
+--perf-update) and commit the file.
+
+This file is identical in every service (each service is its own image).
+"""
+import json
+import os
+import statistics
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PERF_ROUNDS = int(os.getenv("PERF_ROUNDS", "50"))
+PERF_WARMUP = int(os.getenv("PERF_WARMUP", "5"))
+PERF_LATENCY_MARGIN = float(os.getenv("PERF_LATENCY_MARGIN", "0.5"))
+PERF_STATEMENT_MARGIN = int(os.getenv("PERF_STATEMENT_MARGIN", "0"))
+PERF_UPDATE_BASELINE = os.getenv("PERF_UPDATE_BASELINE", "").lower() in ("1", "true", "yes")
+# Timing is noisy on a shared machine, so the gate only runs when asked for
+PERF_TESTS = PERF_UPDATE_BASELINE or os.getenv("PERF_TESTS", "").lower() in ("1", "true", "yes")
+
+
+@contextmanager
+def count_statements():
+    """Counts the SQL statements every engine sends while the block runs (yields a list of one int)."""
+    counted = [0]
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        counted[0] += 1
+
+    event.listen(Engine, "after_cursor_execute", count)
+    try:
+        yield counted
+    finally:
+        event.remove(Engine, "after_cursor_execute", count)
+
+
+def calibrate(repeat: int = 5) -> float:
+    """Median ms of a fixed CPU-bound workload: how fast this machine runs Python."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        sorted(str(i * 7919 % 100003) for i in range(100000))
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+class PerfGate:
+    def __init__(self, baseline_path):
+        self.path = Path(baseline_path)
+        self.baseline: Dict[str, Any] = json.loads(self.path.read_text()) if self.path.exists() else {}
+        self.calibration_ms = calibrate()
+        self.results: Dict[str, Dict[str, float]] = {}
+
+    def measure(self, name: str, call: Callable[[], Any], setup: Optional[Callable[[], Any]] = None,
+                rounds: int = PERF_ROUNDS, warmup: int = PERF_WARMUP) -> Dict[str, float]:
+        """
+        Runs call() warmup + rounds times (setup() before each, untimed) and returns the
+        statements per request (the most seen in a round) and min/median/max ms.
+        """
+        timings: List[float] = []
+        statements = 0
+        for round_number in range(warmup + rounds):
+            if setup is not None:
+                setup()
+            with count_statements() as counted:
+                start = time.perf_counter()
+                call()
+                elapsed = (time.perf_counter() - start) * 1000
+            if round_number >= warmup:
+                timings.append(elapsed)
+                statements = max(statements, counted[0])
+        result = {
+            "statements": statements,
+            "min_ms": round(min(timings), 3),
+            "median_ms": round(statistics.median(timings), 3),
+            "max_ms": round(max(timings), 3),
+        }
+        self.results[name] = result
+        print(f"  {name}: {statements} statements, median {result['median_ms']} ms "
+              f"(min {result['min_ms']}, max {result['max_ms']})")
+        return result
+
+    def check(self, name: str, result: Dict[str, float]):
+        """Asserts the result is within the margins of the scenario's baseline."""
+        if PERF_UPDATE_BASELINE:
+            return
+        expected = self.baseline.get("scenarios", {}).get(name)
+        assert expected is not None, f"No baseline for {name}, record one with PERF_UPDATE_BASELINE=1"
+
+        allowed_statements = expected["statements"] + PERF_STATEMENT_MARGIN
+        assert result["statements"] <= allowed_statements, (
+            f"{name}: {result['statements']} SQL statements per request, baseline {expected['statements']}"
+        )
+        speed = self.calibration_ms / self.baseline["calibration_ms"]
+        allowed_ms = expected["median_ms"] * speed * (1 + PERF_LATENCY_MARGIN)
+        assert result["median_ms"] <= allowed_ms, (
+            f"{name}: median {result['median_ms']} ms, allowed {allowed_ms:.3f} ms "
+            f"(baseline {expected['median_ms']} ms x machine speed {speed:.2f} + {PERF_LATENCY_MARGIN:.0%})"
+        )
+
+    def save(self):
+        """Writes the measured scenarios as the new baseline (PERF_UPDATE_BASELINE only)."""
+        if not PERF_UPDATE_BASELINE or not self.results:
+            return
+        # Scenarios that didn't run (pytest -k) are kept, rescaled to this machine's speed
+        speed = self.calibration_ms / self.baseline["calibration_ms"] if self.baseline else 1.0
+        scenarios = {
+            name: {"statements": expected["statements"], "median_ms": round(expected["median_ms"] * speed, 3)}
+            for name, expected in self.baseline.get("scenarios", {}).items()
+        }
+        scenarios.update(
+            (name, {"statements": result["statements"], "median_ms": result["median_ms"]})
+            for name, result in self.results.items()
+        )
+        scenarios = dict(sorted(scenarios.items()))
+        self.path.write_text(json.dumps({"calibration_ms": round(self.calibration_ms, 3), "scenarios": scenarios}, indent=2) + "\n")
+        print(f"  Perf baseline written to {self.path}")
@@ -0,0 +1,60 @@
+"""
+Precompiled hot-path statements.
+
+Building a Core statement (products_table.select().where(...)) and generating its cache
+key costs more CPU than running a primary key lookup on a warm database. The hot
+statements are therefore built once, at import, with bindparam() placeholders and
+executed with a parameters dict:
+
+    select_product = products_table.select().where(products_table.c.id == bindparam("product_id"))
+    conn.execute(select_product, {"product_id": product_id})
+
+SQLAlchemy memoizes the cache key on the statement object and keeps the compiled SQL in
+the engine's compiled cache, so after the first call an execution goes straight to the
+driver. Lists use expanding bindparams (one statement for every list length), and bulk
+INSERTs run as executemany, batched into multi-row VALUES by the driver.
+
+Server-side prepared statements: with the psycopg (3) driver (postgresql+psycopg://
+URLs) connect_args() makes a connection prepare a statement once it has run it
+DB_PREPARE_THRESHOLD times. psycopg2, the default driver in these images, has no
+support for them; there the saving is the client-side build and compile.
+
+Compiled cache lookups are counted for every engine and exported on GET /metrics as
+sql_compile_cache_total{result="hit|miss|..."}.
+
+This file is identical in every service (each service is its own image).
+"""
+import os
+from collections import Counter
+from typing import Any, Dict
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+
+import metrics
+
+DB_PREPARE_THRESHOLD = int(os.getenv("DB_PREPARE_THRESHOLD", "5"))
+# Drivers that prepare statements server-side when given prepare_threshold
+_PREPARING_DRIVERS = ("psycopg", "psycopg_async")
+
+stats: Counter = Counter()
+
+
+def connect_args(url) -> Dict[str, Any]:
+    """create_engine() connect_args enabling server-side prepared statements where supported."""
+    if make_url(url).get_driver_name() in _PREPARING_DRIVERS:
+        return {"prepare_threshold": DB_PREPARE_THRESHOLD}
+    return {}
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _count_cache_lookup(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        # CacheStats.CACHE_HIT -> "hit", NO_CACHE_KEY -> "no_cache_key", ...
+        stats[context.cache_hit.name.lower().replace("cache_", "")] += 1
+
+
+@metrics.register
+def _collect():
+    yield ("sql_compile_cache_total", "counter", "SQL executions by compiled cache lookup result",
+           [({"result": result}, count) for result, count in sorted(stats.items())])
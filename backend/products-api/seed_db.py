@@ -1,4 +1,5 @@
 from database import engine, products_table, create_db_and_tables
+import catalog
 from sqlalchemy import select, func
 
 # The product data that was previously in main.py
@@ -8,91 +9,117 @@ mockProducts = [
     "name": "Apple Airpods Pro",
     "price": 249.99,
     "description": "Earbuds with active noise cancellation",
-    "imageUrl": "https://lh3.googleusercontent.com/d/19YZR4K0ZPvVW4-xoz5HUjre-BChgCmv8"
+    "imageUrl": "https://lh3.googleusercontent.com/d/19YZR4K0ZPvVW4-xoz5HUjre-BChgCmv8",
+    "category": "audio",
+    "attributes": {"brand": "Apple"}
   },
   {
     "id": "1002",
     "name": "Asus ROG Laptop ",
     "price": 1299.00,
     "description": "Unlock a next-level gaming experience with the ROG Strix G16.",
-    "imageUrl": "https://lh3.googleusercontent.com/d/1mKSz1BKglbEx2rPwwpmfxVLlcLmdwGO_"
+    "imageUrl": "https://lh3.googleusercontent.com/d/1mKSz1BKglbEx2rPwwpmfxVLlcLmdwGO_",
+    "category": "laptops",
+    "attributes": {"brand": "Asus"}
   },
   {
     "id": "1003",
     "name": "Bose QuietComfort Headphones",
     "price": 199.99,
     "description": "Take charge of your music and stride along to the beat. ",
-    "imageUrl": "https://lh3.googleusercontent.com/d/1QJt8qblhGPk_PAm084TwC_kWrFcZq6Vo" 
+    "imageUrl": "https://lh3.googleusercontent.com/d/1QJt8qblhGPk_PAm084TwC_kWrFcZq6Vo",
+    "category": "audio",
+    "attributes": {"brand": "Bose"}
   },
   {
     "id": "1004",
     "name": "Canon EOS camera",
     "price": 579.99,
     "description": "Up your photography game with the EOS Rebel T7.",
-    "imageUrl": "https://lh3.googleusercontent.com/d/1Vzo335bkCLsfpib-qhgRpbTZqi5N7dl_"
+    "imageUrl": "https://lh3.googleusercontent.com/d/1Vzo335bkCLsfpib-qhgRpbTZqi5N7dl_",
+    "category": "cameras",
+    "attributes": {"brand": "Canon"}
   },
   {
     "id": "1005",
     "name": "ATH-350TV Headphones Wired",
     "price": 30.63,
     "description": "Audio-Technica ATH-350TV Headphones Wired for TV with Volume Controller Black",
-    "imageUrl": "https://lh3.googleusercontent.com/d/1Rt4z7-JV63AS7y82u12ID_GN5dPUeYvE"
+    "imageUrl": "https://lh3.googleusercontent.com/d/1Rt4z7-JV63AS7y82u12ID_GN5dPUeYvE",
+    "category": "audio",
+    "attributes": {"brand": "Audio-Technica"}
   },
   {
     "id": "1006",
     "name": "JBL Soundbox",
     "price": 165.95,
     "description": "Keep the mood alive for 24 hours on a single charge",
-    "imageUrl": "https://lh3.googleusercontent.com/d/1L4LL8Hlqg7tZETIvcJl8_J493w4MpsFf"
+    "imageUrl": "https://lh3.googleusercontent.com/d/1L4LL8Hlqg7tZETIvcJl8_J493w4MpsFf",
+    "category": "audio",
+    "attributes": {"brand": "JBL"}
   },
   {
     "id": "1007",
     "name": "MACbook Air",
     "price": 999.00,
     "description": "MacBook Air is the world's most popular laptop for a reason.",
-    "imageUrl": "https://lh3.googleusercontent.com/d/1dqWebaJQbnQ0XHRHbXYNunVhWFbMIYQ6"
+    "imageUrl": "https://lh3.googleusercontent.com/d/1dqWebaJQbnQ0XHRHbXYNunVhWFbMIYQ6",
+    "category": "laptops",
+    "attributes": {"brand": "Apple"}
   },
   {
     "id": "1008",
     "name": "SONY Playstation 5 Pro",
     "price": 749.00,
     "description": "PS5® Pro is an all-digital console with no disc drive. ",
-    "imageUrl": "https://lh3.googleusercontent.com/d/1r7a9hp_pPOL-SpvSXDPFQ1M50nCGdYho"
+    "imageUrl": "https://lh3.googleusercontent.com/d/1r7a9hp_pPOL-SpvSXDPFQ1M50nCGdYho",
+    "category": "gaming",
+    "attributes": {"brand": "Sony"}
   },
     {
     "id": "1009",
     "name": "ELEPHAS Mini Projector",
     "price": 66.49,
     "description": "Supports 1080P/4K resolution to provide clear visual effects.",
-    "imageUrl": "https://lh3.googleusercontent.com/d/1s02udwOq22sxrN5D0_LNvIZa1VXWrlv7"
+    "imageUrl": "https://lh3.googleusercontent.com/d/1s02udwOq22sxrN5D0_LNvIZa1VXWrlv7",
+    "category": "tv-video",
+    "attributes": {"brand": "ELEPHAS"}
   },
     {
     "id": "1010",
     "name": "Samsung S23",
     "price": 499.99,
     "description": "Meet Galaxy S23, the phone takes you out of the everyday and into the epic.",
-    "imageUrl": "https://lh3.googleusercontent.com/d/1nXCkZm-70QqAm1Z2Q-mJ01lpV5xW2dXv"
+    "imageUrl": "https://lh3.googleusercontent.com/d/1nXCkZm-70QqAm1Z2Q-mJ01lpV5xW2dXv",
+    "category": "phones",
+    "attributes": {"brand": "Samsung"}
   },
   {
     "id": "1011",
     "name": "SM Controller",
     "price": 59.99,
     "description": "Gaming Controller with TMR sticks, Trigger Lock and Charging Dock",
-    "imageUrl": "https://lh3.googleusercontent.com/d/1oaW2q89znZIylLDcFuwkMzzSEh7WgMpv"
+    "imageUrl": "https://lh3.googleusercontent.com/d/1oaW2q89znZIylLDcFuwkMzzSEh7WgMpv",
+    "category": "gaming",
+    "attributes": {"brand": "SM"}
   },
   {
     "id": "1012",
     "name": "Sony Earbuds",
     "price": 79.99,
     "description": "WF-C710N Truly Wireless Noise-Canceling Earbuds",
-    "imageUrl": "https://lh3.googleusercontent.com/d/1IrdEnW4GKDE6X2YzFw3KDg27ONgMcXun"
+    "imageUrl": "https://lh3.googleusercontent.com/d/1IrdEnW4GKDE6X2YzFw3KDg27ONgMcXun",
+    "category": "audio",
+    "attributes": {"brand": "Sony"}
   },
   {
     "id": "1013",
     "name": "Venu Smartwatch",
     "price": 349.99,
     "description": "Get in tune with your mind and body with Garmin Venu 3S smartwatch.",
-    "imageUrl": "https://lh3.googleusercontent.com/d/18Cm4JBhITC86JLuDaWgbWth75L8l6nWN"
+    "imageUrl": "https://lh3.googleusercontent.com/d/18Cm4JBhITC86JLuDaWgbWth75L8l6nWN",
+    "category": "wearables",
+    "attributes": {"brand": "Venu"}
   },
 ]
 
@@ -111,6 +138,7 @@ def seed_database():
         if count == 0:
             # If the table is empty, insert the mock products
             conn.execute(products_table.insert(), mockProducts)
+            catalog.record_changes(conn, [(None, product) for product in mockProducts])
             conn.commit() # Commit the transaction
             print("Database seeding complete.")
         else:
@@ -0,0 +1,247 @@
+"""
+Two-tier cache shared by the replicas of a service.
+
+- Local tier: in-process TTL + LRU dict. Always on, short TTL (CACHE_LOCAL_TTL_SECONDS).
+- Shared tier: a Redis server at CACHE_URL (redis://[:password@]host:port/db), through
+  redis-py. Multi-gets and multi-sets are one round trip for many keys (MGET, pipeline).
+  If the server is unreachable, the shared tier is skipped for CACHE_RETRY_SECONDS and
+  the local tier serves alone, so a cache outage never fails a request.
+
+The shared tier is blocking socket I/O: sync callers run in the threadpool already, and
+async endpoints use the a*() methods, which check the local tier on the event loop and
+run only the shared-tier round trip with run_in_threadpool.
+
+CACHE_URL=fake:// runs the shared tier against an in-process fakeredis server (shared by
+every SharedCache in the process, no network), for tests and local development. An
+empty CACHE_URL disables the shared tier.
+
+This file is identical in every service (each service is its own image).
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+
+import redis
+from starlette.concurrency import run_in_threadpool
+
+CACHE_URL = os.getenv("CACHE_URL", "")
+CACHE_LOCAL_TTL_SECONDS = float(os.getenv("CACHE_LOCAL_TTL_SECONDS", "5"))
+CACHE_LOCAL_MAX_ENTRIES = int(os.getenv("CACHE_LOCAL_MAX_ENTRIES", "10000"))
+CACHE_RETRY_SECONDS = float(os.getenv("CACHE_RETRY_SECONDS", "10"))
+CACHE_TIMEOUT_SECONDS = float(os.getenv("CACHE_TIMEOUT_SECONDS", "0.2"))
+
+
+# --- Local tier ---
+
+class LocalCache:
+    def __init__(self, max_entries: int = CACHE_LOCAL_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+        # Endpoints read the cache from the threadpool as well as the event loop
+        self.lock = threading.Lock()
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, object]:
+        now = time.monotonic()
+        found = {}
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is None:
+                    continue
+                expires_at, value = entry
+                if expires_at <= now:
+                    del self.entries[key]
+                    continue
+                self.entries.move_to_end(key)
+                found[key] = value
+        return found
+
+    def set_many(self, mapping: Dict[str, object], ttl: float):
+        expires_at = time.monotonic() + ttl
+        with self.lock:
+            for key, value in mapping.items():
+                self.entries[key] = (expires_at, value)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete_many(self, keys: Iterable[str]):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# --- Shared tier client ---
+
+_fake_server = None
+_fake_server_lock = threading.Lock()
+
+
+def fake_server():
+    """The in-process fakeredis server behind CACHE_URL=fake:// (flushall() it between tests)."""
+    global _fake_server
+    with _fake_server_lock:
+        if _fake_server is None:
+            import fakeredis  # test dependency, only needed for fake://
+            _fake_server = fakeredis.FakeServer()
+        return _fake_server
+
+
+def connect(url: str) -> redis.Redis:
+    """A client with its own connection pool; nothing is sent until the first command."""
+    if url.startswith("fake://"):
+        import fakeredis
+        return fakeredis.FakeRedis(server=fake_server())
+    return redis.Redis.from_url(url, socket_timeout=CACHE_TIMEOUT_SECONDS, socket_connect_timeout=CACHE_TIMEOUT_SECONDS)
+
+
+# --- Two-tier cache ---
+
+class SharedCache:
+    def __init__(self, namespace: str, url: str = CACHE_URL, local_ttl: float = CACHE_LOCAL_TTL_SECONDS):
+        self.namespace = namespace
+        self.url = url
+        self.local_ttl = local_ttl
+        self.local = LocalCache()
+        self.client: Optional[redis.Redis] = None
+        self.client_lock = threading.Lock()
+        self.retry_at = 0.0
+        self.stats = {"local_hits": 0, "shared_hits": 0, "misses": 0, "shared_errors": 0}
+
+    @property
+    def shared_enabled(self) -> bool:
+        return bool(self.url)
+
+    def _key(self, key: str) -> str:
+        return f"{self.namespace}:{key}"
+
+    def _shared_available(self) -> bool:
+        return bool(self.url) and time.monotonic() >= self.retry_at
+
+    def _shared(self, run):
+        """Calls run(client) on the shared tier, or returns None if it's unavailable."""
+        if not self._shared_available():
+            return None
+        try:
+            with self.client_lock:
+                if self.client is None:
+                    self.client = connect(self.url)
+                client = self.client
+            return run(client)
+        except (redis.RedisError, ValueError) as e:
+            # Fall back to the local tier and retry the server later (ValueError: bad CACHE_URL)
+            self.stats["shared_errors"] += 1
+            self.retry_at = time.monotonic() + CACHE_RETRY_SECONDS
+            with self.client_lock:
+                if self.client is not None:
+                    self.client.close()
+                    self.client = None
+            print(f"  WARNING: Shared cache unavailable, using in-process cache only. {e}")
+            return None
+
+    def _get_local(self, keys: List[str]) -> Dict[str, object]:
+        found = self.local.get_many(keys)
+        self.stats["local_hits"] += len(found)
+        return found
+
+    def _get_shared(self, keys: List[str]) -> Dict[str, object]:
+        replies = self._shared(lambda client: client.mget([self._key(key) for key in keys]))
+        if replies is None:
+            return {}
+        found = {key: json.loads(raw) for key, raw in zip(keys, replies) if raw is not None}
+        self.stats["shared_hits"] += len(found)
+        self.local.set_many(found, self.local_ttl)
+        return found
+
+    def _set_shared(self, mapping: Dict[str, object], ttl: float):
+        milliseconds = max(1, int(ttl * 1000))
+
+        def run(client):
+            pipeline = client.pipeline(transaction=False)
+            for key, value in mapping.items():
+                pipeline.set(self._key(key), json.dumps(value), px=milliseconds)
+            return pipeline.execute()
+        self._shared(run)
+
+    def _delete_shared(self, keys: List[str]):
+        self._shared(lambda client: client.delete(*[self._key(key) for key in keys]))
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, object]:
+        keys = list(keys)
+        found = self._get_local(keys)
+        missing = [key for key in keys if key not in found]
+        if missing:
+            found.update(self._get_shared(missing))
+        self.stats["misses"] += len(keys) - len(found)
+        return found
+
+    def set_many(self, mapping: Dict[str, object], ttl: float):
+        if not mapping:
+            return
+        self.local.set_many(mapping, min(ttl, self.local_ttl))
+        self._set_shared(mapping, ttl)
+
+    def delete_many(self, keys: Iterable[str]):
+        keys = list(keys)
+        if not keys:
+            return
+        self.local.delete_many(keys)
+        self._delete_shared(keys)
+
+    def get(self, key: str):
+        return self.get_many([key]).get(key)
+
+    def set(self, key: str, value, ttl: float):
+        self.set_many({key: value}, ttl)
+
+    def delete(self, key: str):
+        self.delete_many([key])
+
+    # Async variants for endpoints: a local hit never leaves the event loop
+
+    async def aget_many(self, keys: Iterable[str]) -> Dict[str, object]:
+        keys = list(keys)
+        found = self._get_local(keys)
+        missing = [key for key in keys if key not in found]
+        if missing and self._shared_available():
+            found.update(await run_in_threadpool(self._get_shared, missing))
+        self.stats["misses"] += len(keys) - len(found)
+        return found
+
+    async def aset_many(self, mapping: Dict[str, object], ttl: float):
+        if not mapping:
+            return
+        self.local.set_many(mapping, min(ttl, self.local_ttl))
+        if self._shared_available():
+            await run_in_threadpool(self._set_shared, mapping, ttl)
+
+    async def adelete_many(self, keys: Iterable[str]):
+        keys = list(keys)
+        if not keys:
+            return
+        self.local.delete_many(keys)
+        if self._shared_available():
+            await run_in_threadpool(self._delete_shared, keys)
+
+    async def aget(self, key: str):
+        return (await self.aget_many([key])).get(key)
+
+    async def aset(self, key: str, value, ttl: float):
+        await self.aset_many({key: value}, ttl)
+
+    async def adelete(self, key: str):
+        await self.adelete_many([key])
+
+    def evict_local(self, keys: Iterable[str]):
+        """Drops keys from this replica only (the shared tier was already updated by the writer)."""
+        self.local.delete_many(keys)
+
+    def clear_local(self):
+        self.local.clear()
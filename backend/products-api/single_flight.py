@@ -0,0 +1,60 @@
+"""
+Single-flight request coalescing for cache misses.
+
+When many requests miss the cache for the same key at once (cold cache after a deploy,
+a hot product just evicted), only the first one runs the database query; the others
+await its result instead of each taking a pooled connection for the same query.
+
+The query runs in the threadpool as its own task, so a caller that disconnects doesn't
+cancel it for the callers still waiting. Errors are shared the same way as results.
+
+Every SingleFlight reports its executions and coalesced callers on GET /metrics.
+
+This file is identical in products-api and inventory-api (each service is its own image).
+"""
+import asyncio
+from typing import Callable, Dict, Hashable, List
+
+from starlette.concurrency import run_in_threadpool
+
+import metrics
+
+_groups: List["SingleFlight"] = []
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self.inflight: Dict[Hashable, asyncio.Future] = {}
+        self.stats = {"executions": 0, "coalesced": 0, "errors": 0}
+        _groups.append(self)
+
+    async def run(self, key: Hashable, load: Callable, *args):
+        """Returns load(*args), sharing one call among concurrent callers with the same key."""
+        task = self.inflight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["executions"] += 1
+            task = asyncio.ensure_future(run_in_threadpool(load, *args))
+            self.inflight[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+        return await asyncio.shield(task)
+
+    def _finished(self, key: Hashable, task: asyncio.Future):
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+        if not task.cancelled() and task.exception() is not None:
+            # Retrieving it here also keeps asyncio quiet when every caller went away
+            self.stats["errors"] += 1
+
+
+@metrics.register
+def _collect():
+    for stat, help_text in (
+        ("executions", "Loads actually run by a single-flight group"),
+        ("coalesced", "Callers that awaited a load already in flight instead of running it"),
+        ("errors", "Single-flight loads that raised"),
+    ):
+        samples = [({"group": group.name}, group.stats[stat]) for group in _groups]
+        yield f"singleflight_{stat}_total", "counter", help_text, samples
@@ -1,10 +1,25 @@
+import asyncio
+import json
 import pytest
+import time
 from fastapi.testclient import TestClient
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 from sqlalchemy import create_engine
 from sqlalchemy.pool import StaticPool
+import main
 from main import app
-from database import products_table, metadata
+from database import products_table, product_facets_table, metadata
+from shared_cache import SharedCache, connect
+import cache_invalidation
+from single_flight import SingleFlight
+from id_filter import BloomFilter, KnownIdFilter
+import profiling
+import query_cache
+import catalog
+import perf_gate
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import threading
 
 # Create an in-memory SQLite database for testing
 TEST_DATABASE_URL = "sqlite:///:memory:"
@@ -23,7 +38,7 @@ def test_engine():
 @pytest.fixture
 def client(test_engine):
     """Create a test client with mocked database"""
-    with patch('main.engine', test_engine):
+    with patch('main.engine', test_engine), patch('cache_invalidation.engine', test_engine):
         with patch('database.engine', test_engine):
             # Seed some test data
             with test_engine.connect() as conn:
@@ -54,7 +69,10 @@ def client(test_engine):
                 trans.commit()
             
             # Mock the seed_database function to prevent it from running
-            with patch('main.seed_database'):
+            # and run the cache against the in-process fakeredis server
+            connect("fake://").flushall()
+            with patch('main.seed_database'), patch('main.product_cache', SharedCache("products", url="fake://")), \
+                    patch('main.product_filter', KnownIdFilter("products", main.load_product_ids)):
                 yield TestClient(app)
 
 
@@ -200,7 +218,7 @@ class TestProductsDatabase:
         """Test API behavior with an empty database"""
         with patch('main.engine', test_engine):
             with patch('database.engine', test_engine):
-                with patch('main.seed_database'):
+                with patch('main.seed_database'), patch('main.product_cache', SharedCache("products", url="")):
                     client = TestClient(app)
                     response = client.get("/api/products")
                     assert response.status_code == 200
@@ -213,6 +231,438 @@ class TestProductsDatabase:
             assert isinstance(result, list)
 
 
+class TestSharedCache:
+    """Test suite for the two-tier (in-process + shared) cache"""
+
+    @pytest.fixture(autouse=True)
+    def flush_fake_server(self):
+        connect("fake://").flushall()
+
+    def test_product_served_from_cache(self, client, test_engine):
+        """Test that a cached product is served without the database"""
+        assert client.get("/api/products/product-1").status_code == 200
+        with test_engine.begin() as conn:
+            conn.execute(products_table.delete())
+        response = client.get("/api/products/product-1")
+        assert response.status_code == 200
+        assert response.json()["name"] == "Test Product 1"
+
+    def test_replicas_share_entries(self):
+        """Test that a value set by one replica is found by another through the shared tier"""
+        replica_a = SharedCache("products", url="fake://")
+        replica_b = SharedCache("products", url="fake://")
+        replica_a.set_many({"p1": {"id": "p1"}, "p2": {"id": "p2"}}, ttl=60)
+
+        assert replica_b.get_many(["p1", "p2", "p3"]) == {"p1": {"id": "p1"}, "p2": {"id": "p2"}}
+        assert replica_b.stats["shared_hits"] == 2
+        # Now in replica B's local tier
+        assert replica_b.get("p1") == {"id": "p1"}
+        assert replica_b.stats["local_hits"] == 1
+
+        replica_a.delete("p1")
+        replica_b.evict_local(["p1"])
+        assert replica_b.get("p1") is None
+
+    def test_async_variants_share_entries(self):
+        """Test that the a*() methods used by endpoints read and write the same tiers"""
+        replica_a = SharedCache("products", url="fake://")
+        replica_b = SharedCache("products", url="fake://")
+
+        async def scenario():
+            await replica_a.aset("p1", {"id": "p1"}, ttl=60)
+            from_shared = await replica_b.aget_many(["p1", "p2"])
+            await replica_a.adelete("p1")
+            return from_shared
+
+        assert asyncio.run(scenario()) == {"p1": {"id": "p1"}}
+        assert replica_b.stats == {"local_hits": 0, "shared_hits": 1, "misses": 1, "shared_errors": 0}
+        assert replica_a.get("p1") is None
+
+    def test_multi_get_and_set_are_pipelined(self):
+        """Test that many keys cost one round trip"""
+        cache = SharedCache("products", url="fake://", local_ttl=0)
+        cache.get("warmup")  # creates the client
+        connection_class = cache.client.connection_pool.connection_class
+        with patch.object(connection_class, "send_packed_command", autospec=True,
+                          side_effect=connection_class.send_packed_command) as sent:
+            cache.set_many({f"k{i}": i for i in range(50)}, ttl=60)
+            assert cache.get_many([f"k{i}" for i in range(50)]) == {f"k{i}": i for i in range(50)}
+        # 50 SETs sent in one pipeline, then a single MGET
+        assert sent.call_count == 2
+
+    def test_falls_back_when_shared_tier_is_down(self):
+        """Test that an unreachable cache server degrades to the in-process tier"""
+        cache = SharedCache("products", url="redis://127.0.0.1:1/0")
+        cache.set("p1", {"id": "p1"}, ttl=60)
+        assert cache.get("p1") == {"id": "p1"}
+        assert cache.stats["shared_errors"] == 1
+
+    def test_local_entries_expire(self):
+        """Test the in-process TTL"""
+        cache = SharedCache("products", url="", local_ttl=0.01)
+        cache.set("p1", {"id": "p1"}, ttl=60)
+        assert cache.get("p1") == {"id": "p1"}
+        time.sleep(0.02)
+        assert cache.get("p1") is None
+
+
+class TestProductWrites:
+    """Test suite for product writes and cross-replica invalidation"""
+
+    @pytest.fixture
+    def other_replica(self, client):
+        cache = SharedCache("products", url="")
+        listener = cache_invalidation.InvalidationListener(
+            "products_changed", on_keys=cache.evict_local, on_resync=cache.clear_local
+        )
+        listener.poll()
+        return cache, listener
+
+    def test_put_creates_and_updates(self, client):
+        """Test creating a product, then replacing it"""
+        payload = {"name": "New Product", "price": 9.99}
+        response = client.put("/api/products/product-9", json=payload)
+        assert response.status_code == 200
+        assert client.get("/api/products/product-9").json()["price"] == 9.99
+
+        client.put("/api/products/product-9", json={**payload, "price": 12.5})
+        assert client.get("/api/products/product-9").json()["price"] == 12.5
+        assert len(client.get("/api/products").json()) == 4
+
+    def test_put_evicts_on_other_replica(self, client, other_replica):
+        """Test that an update on one replica evicts the product and the list on another"""
+        cache, listener = other_replica
+        cache.set_many({"product-1": {"price": 29.99}, "product-2": {"price": 49.99}, "all": []}, ttl=60)
+        client.put("/api/products/product-1", json={"name": "Test Product 1", "price": 24.99})
+
+        assert listener.poll() == 2
+        assert cache.get_many(["product-1", "product-2", "all"]) == {"product-2": {"price": 49.99}}
+
+    def test_put_invalid_payload(self, client):
+        """Test that a product without a price is refused"""
+        response = client.put("/api/products/product-1", json={"name": "No price"})
+        assert response.status_code == 422
+
+
+class TestSingleFlight:
+    """Test suite for cache miss coalescing"""
+
+    def test_concurrent_misses_share_one_query(self, client):
+        """Test that a burst of misses for one product runs a single query"""
+        calls = []
+        load_product = main.load_product
+
+        def slow_load(product_id):
+            calls.append(product_id)
+            time.sleep(0.05)
+            return load_product(product_id)
+
+        async def burst():
+            return await asyncio.gather(*[main.get_product("product-1") for _ in range(20)])
+
+        lookups = SingleFlight("test-products")
+        with patch('main.load_product', slow_load), patch('main.product_lookups', lookups):
+            results = asyncio.run(burst())
+        assert calls == ["product-1"]
+        assert all(result["name"] == "Test Product 1" for result in results)
+        assert lookups.stats == {"executions": 1, "coalesced": 19, "errors": 0}
+
+    def test_errors_are_shared_then_retried(self):
+        """Test that waiting callers get the error, and the next call runs again"""
+        lookups = SingleFlight("test-errors")
+
+        def failing_load():
+            time.sleep(0.02)
+            raise RuntimeError("database down")
+
+        async def burst():
+            return await asyncio.gather(*[lookups.run("key", failing_load) for _ in range(3)], return_exceptions=True)
+
+        assert all(isinstance(result, RuntimeError) for result in asyncio.run(burst()))
+        assert asyncio.run(lookups.run("key", lambda: "ok")) == "ok"
+        assert lookups.stats == {"executions": 2, "coalesced": 2, "errors": 1}
+
+    def test_metrics_endpoint(self, client):
+        """Test that coalescing counts are exposed for Prometheus"""
+        client.get("/api/products/product-1")
+        body = client.get("/metrics").text
+        assert "# TYPE singleflight_coalesced_total counter" in body
+        assert 'singleflight_executions_total{group="products"}' in body
+
+
+class TestIdFilter:
+    """Test suite for the negative-lookup filter over product IDs"""
+
+    def test_bloom_filter_has_no_false_negatives(self):
+        """Test that every added ID is found and the false-positive rate is near the target"""
+        bloom = BloomFilter(capacity=5000, fp_rate=0.01)
+        for i in range(5000):
+            bloom.add(f"product-{i}")
+        assert all(f"product-{i}" in bloom for i in range(5000))
+
+        false_positives = sum(f"unknown-{i}" in bloom for i in range(20000))
+        assert false_positives / 20000 < 0.02
+        assert 0.005 < bloom.expected_fp_rate < 0.02
+        assert bloom.memory_bytes < 7000  # ~9.6 bits per ID
+
+    def test_unknown_id_skips_database(self, client):
+        """Test that a definite miss is a 404 without a query"""
+        main.product_filter.build()
+        with patch('main.load_product', Mock(side_effect=AssertionError("database queried"))):
+            response = client.get("/api/products/no-such-product")
+        assert response.status_code == 404
+        assert main.product_filter.stats["definite_misses"] == 1
+
+    def test_inserted_product_passes_filter(self, client):
+        """Test that products created after startup, here or on another replica, are found"""
+        main.product_filter.build()
+        client.put("/api/products/product-9", json={"name": "New Product", "price": 9.99})
+        assert client.get("/api/products/product-9").status_code == 200
+
+        main.products_changed(["product-10", "all"])
+        assert not main.product_filter.definitely_missing("product-10")
+
+    def test_rebuilds_when_over_capacity(self):
+        """Test that the filter is rebuilt larger once it holds more IDs than it was sized for"""
+        ids = ["a", "b"]
+        known = KnownIdFilter("test", lambda: list(ids))
+        with patch('id_filter.ID_FILTER_MIN_CAPACITY', 4):
+            known.build()
+            assert known.bloom.capacity == 4
+            ids.extend(["c", "d", "e"])
+            known.add(["c", "d", "e"])
+        assert known.bloom.capacity == 10
+        assert not any(known.definitely_missing(product_id) for product_id in ids)
+
+    def test_filter_metrics(self, client):
+        """Test that size and false-positive rate are exposed"""
+        main.product_filter.build()
+        body = client.get("/metrics").text
+        assert 'id_filter_items{filter="products"} 3' in body
+        assert 'id_filter_memory_bytes{filter="products"}' in body
+        assert 'id_filter_expected_false_positive_rate{filter="products"}' in body
+
+
+class TestPrecompiledStatements:
+    """Test suite for the statements built once and reused on the product paths"""
+
+    def test_lookups_reuse_compiled_statements(self, client):
+        """Test that once warm, product reads and writes compile no SQL"""
+        main.load_product("product-1")
+        client.put("/api/products/product-1", json={"name": "Renamed", "price": 1.0})
+
+        query_cache.stats.clear()
+        assert main.load_product("product-2")["name"] == "Test Product 2"
+        client.put("/api/products/product-2", json={"name": "Renamed", "price": 2.0})
+        assert query_cache.stats["hit"] > 0
+        assert query_cache.stats["miss"] == 0
+        assert 'sql_compile_cache_total{result="hit"}' in client.get("/metrics").text
+
+    def test_prepared_statements_only_for_psycopg3(self):
+        """Test that the prepare threshold is only passed to drivers that understand it"""
+        assert query_cache.connect_args("postgresql+psycopg://u:p@db/products") == {
+            "prepare_threshold": query_cache.DB_PREPARE_THRESHOLD
+        }
+        assert query_cache.connect_args("postgresql://u:p@db/products") == {}
+        assert query_cache.connect_args("sqlite:///:memory:") == {}
+
+
+class TestCatalogBrowsing:
+    """Test suite for category, price-range and attribute browsing with facet counts"""
+
+    @pytest.fixture
+    def catalog_client(self, client, test_engine):
+        # The seeded products (no category) are counted, then categorised ones added
+        catalog.rebuild(test_engine)
+        for product_id, name, price, category, brand in [
+            ("a-1", "Earbuds", 79.0, "audio", "Sony"),
+            ("a-2", "Headphones", 199.0, "audio", "Bose"),
+            ("a-3", "Speaker", 120.0, "audio", "Sony"),
+            ("c-1", "Camera", 579.0, "cameras", "Canon"),
+        ]:
+            payload = {"name": name, "price": price, "category": category, "attributes": {"brand": brand}}
+            assert client.put(f"/api/products/{product_id}", json=payload).status_code == 200
+        return client
+
+    def test_plain_list_unchanged(self, catalog_client):
+        """Test that GET /api/products without filters is still the whole catalog as a list"""
+        response = catalog_client.get("/api/products")
+        assert isinstance(response.json(), list)
+        assert len(response.json()) == 7
+
+    def test_browse_category_and_price_range(self, catalog_client):
+        """Test that filters select the products and facets are counted for the category"""
+        data = catalog_client.get("/api/products", params={"category": "audio", "min_price": 100}).json()
+        assert [product["id"] for product in data["products"]] == ["a-2", "a-3"]
+        assert data["total"] == 2
+        assert data["facets"]["category"] == {"audio": 3, "cameras": 1}
+        assert data["facets"]["price"] == [
+            {"min": 50.0, "max": 100.0, "products": 1},
+            {"min": 100.0, "max": 250.0, "products": 2},
+        ]
+        assert data["facets"]["attributes"] == {"brand": {"Bose": 1, "Sony": 2}}
+
+    def test_browse_attribute_filter_and_paging(self, catalog_client):
+        """Test attribute filters, paging and malformed filters"""
+        data = catalog_client.get("/api/products", params={"attr": "brand:Sony", "limit": 1}).json()
+        assert [product["id"] for product in data["products"]] == ["a-1"]
+        assert data["total"] == 2
+        whole = catalog_client.get("/api/products", params={"facets": True}).json()["facets"]
+        assert sum(bucket["products"] for bucket in whole["price"]) == 7
+        assert catalog_client.get("/api/products", params={"attr": "brand"}).status_code == 400
+
+    def test_facets_follow_writes(self, catalog_client, test_engine):
+        """Test that a product moved to another category moves its counts, matching a rebuild"""
+        payload = {"name": "Speaker", "price": 30.0, "category": "cameras", "attributes": {"brand": "JBL"}}
+        catalog_client.put("/api/products/a-3", json=payload)
+        facets = catalog_client.get("/api/products", params={"category": "audio"}).json()["facets"]
+        assert facets["category"] == {"audio": 2, "cameras": 2}
+        assert facets["attributes"] == {"brand": {"Bose": 1, "Sony": 1}}
+
+        def counts():
+            with test_engine.connect() as conn:
+                rows = conn.execute(product_facets_table.select().where(product_facets_table.c.products != 0))
+                return sorted(tuple(row) for row in rows)
+
+        incremental = counts()
+        catalog.rebuild(test_engine)
+        assert counts() == incremental
+
+    def test_ensure_schema_upgrades_old_table(self):
+        """Test that a products table from before categories gets the columns and its counts"""
+        engine = create_engine(TEST_DATABASE_URL, connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        with engine.begin() as conn:
+            conn.exec_driver_sql('CREATE TABLE products (id VARCHAR PRIMARY KEY, name VARCHAR, price FLOAT, '
+                                 'description VARCHAR, "imageUrl" VARCHAR)')
+            conn.exec_driver_sql("INSERT INTO products (id, name, price) VALUES ('p-1', 'Old', 10.0)")
+        metadata.create_all(engine)
+        catalog.ensure_schema(engine)
+        with engine.connect() as conn:
+            assert catalog.facet_counts(conn)["price"] == [{"min": 0.0, "max": 50.0, "products": 1}]
+            assert conn.execute(products_table.select()).first().category is None
+
+        # Another replica starting, and repeated rebuilds, never add to the counts
+        catalog.ensure_schema(engine)
+        catalog.rebuild(engine)
+        catalog.rebuild(engine)
+        with engine.connect() as conn:
+            assert catalog.facet_counts(conn)["price"] == [{"min": 0.0, "max": 50.0, "products": 1}]
+
+
+class TestPerfGate:
+    """Test suite for the statement counting and baseline checks of the perf gate"""
+
+    def test_counts_statements_and_fails_beyond_baseline(self, client, tmp_path):
+        """Test that statements are counted per call and one over the baseline fails"""
+        baseline = tmp_path / "perf_baseline.json"
+        baseline.write_text(json.dumps({
+            "calibration_ms": 1.0,
+            "scenarios": {"get_product": {"statements": 0, "median_ms": 1e9}},
+        }))
+        gate = perf_gate.PerfGate(baseline)
+        main.product_cache.clear_local()
+        with perf_gate.count_statements() as counted:
+            main.load_product("product-1")
+        assert counted[0] == 1
+
+        result = gate.measure("get_product", lambda: main.load_product("product-1"), rounds=3, warmup=1)
+        assert result["statements"] == 1
+        with pytest.raises(AssertionError, match="1 SQL statements per request, baseline 0"):
+            gate.check("get_product", result)
+        with patch('perf_gate.PERF_STATEMENT_MARGIN', 1):
+            gate.check("get_product", result)
+        with pytest.raises(AssertionError, match="No baseline"):
+            gate.check("other", result)
+
+
+class TestProfiling:
+    """Test suite for the guarded /debug/profile surface"""
+
+    @pytest.fixture
+    def token(self):
+        with patch('profiling.PROFILING_TOKEN', "secret"):
+            yield {"X-Debug-Token": "secret"}
+
+    def hooks_installed(self):
+        return event.contains(Engine, "before_cursor_execute", profiling._before_cursor_execute)
+
+    def test_disabled_without_token(self, client):
+        """Test that profiling doesn't exist unless PROFILING_TOKEN is configured"""
+        assert client.get("/debug/profile?seconds=0.1").status_code == 404
+        response = client.get("/api/products/product-1", headers={"X-Profile": "1"})
+        assert "server-timing" not in response.headers
+
+    def test_wrong_token_refused(self, client, token):
+        """Test that the debug token is required"""
+        response = client.get("/debug/profile?seconds=0.1", headers={"X-Debug-Token": "wrong"})
+        assert response.status_code == 403
+
+    def test_profile_single_request(self, client, token):
+        """Test Server-Timing breakdown and the stored stacks of a flagged request"""
+        response = client.get("/api/products/product-1", headers={"X-Profile": "1", **token})
+        assert response.status_code == 200
+        timing = response.headers["server-timing"]
+        assert all(f"{name};dur=" in timing for name in ("total", "db", "serialize", "http"))
+        profile_id = response.headers["x-profile-id"]
+        assert client.get(f"/debug/profile/requests/{profile_id}", headers=token).status_code == 200
+        # No hooks left behind once the request is done
+        assert not self.hooks_installed()
+
+    def test_request_profile_samples_only_its_own_work(self, client, token):
+        """Test that a flagged request's stacks leave out other threads' work"""
+        stop = threading.Event()
+
+        def busy_loop():
+            while not stop.is_set():
+                sum(range(1000))
+
+        def slow_load(product_id):
+            deadline = time.perf_counter() + 0.1
+            while time.perf_counter() < deadline:
+                sum(range(1000))
+            return {"id": product_id}
+
+        worker = threading.Thread(target=busy_loop, name="worker")
+        worker.start()
+        try:
+            with patch('main.load_product', slow_load):
+                response = client.get("/api/products/product-1", headers={"X-Profile": "1", **token})
+        finally:
+            stop.set()
+            worker.join()
+        stacks = client.get(f"/debug/profile/requests/{response.headers['x-profile-id']}", headers=token).text
+        assert "slow_load (test_main.py:" in stacks
+        assert "busy_loop" not in stacks
+
+    def test_profile_window(self, client, token):
+        """Test a time-boxed profile, as JSON with per-request breakdowns"""
+        response = client.get("/debug/profile?seconds=0.1&format=json", headers=token)
+        assert response.status_code == 200
+        assert response.json()["samples"] > 0
+        assert not self.hooks_installed()
+
+    def test_sampler_output_is_collapsed_stacks(self):
+        """Test that samples come out as 'frame;frame count' lines"""
+        stop = threading.Event()
+
+        def busy_loop():
+            while not stop.is_set():
+                sum(range(1000))
+
+        worker = threading.Thread(target=busy_loop, name="worker")
+        worker.start()
+        sampler = profiling.Sampler(interval=0.001)
+        sampler.start()
+        time.sleep(0.1)
+        stacks = sampler.stop()
+        stop.set()
+        worker.join()
+
+        worker_lines = [line for line in stacks.splitlines() if line.startswith("worker;")]
+        assert worker_lines and all("busy_loop (test_main.py:" in line for line in worker_lines)
+        assert all(line.rsplit(" ", 1)[1].isdigit() for line in worker_lines)
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
 
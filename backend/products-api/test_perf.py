@@ -0,0 +1,52 @@
+"""
+Performance regression gate (see perf_gate.py), skipped unless asked for:
+
+    PERF_TESTS=1 pytest test_perf.py               # check against perf_baseline.json
+    PERF_UPDATE_BASELINE=1 pytest test_perf.py     # record a new baseline
+"""
+import pytest
+from pathlib import Path
+
+import catalog
+import main
+import perf_gate
+from perf_gate import PerfGate
+from shared_cache import connect
+from test_main import client, test_engine  # noqa: F401 (fixtures)
+
+pytestmark = pytest.mark.skipif(not perf_gate.PERF_TESTS, reason="perf gate runs with PERF_TESTS=1")
+
+
+@pytest.fixture(scope="module")
+def perf():
+    gate = PerfGate(Path(__file__).with_name("perf_baseline.json"))
+    yield gate
+    gate.save()
+
+
+def drop_cached_products():
+    main.product_cache.clear_local()
+    connect("fake://").flushall()
+
+
+class TestPerfProducts:
+    """Statement counts and latency of the product endpoints against the stored baseline"""
+
+    def test_get_product_uncached(self, perf, client):
+        result = perf.measure("get_product_uncached", lambda: client.get("/api/products/product-1"), setup=drop_cached_products)
+        perf.check("get_product_uncached", result)
+
+    def test_get_all_products_uncached(self, perf, client):
+        result = perf.measure("get_all_products_uncached", lambda: client.get("/api/products"), setup=drop_cached_products)
+        perf.check("get_all_products_uncached", result)
+
+    def test_browse_with_facets(self, perf, client, test_engine):
+        catalog.rebuild(test_engine)
+        params = {"category": "audio", "min_price": 10, "attr": "brand:Sony"}
+        result = perf.measure("browse_with_facets", lambda: client.get("/api/products", params=params))
+        perf.check("browse_with_facets", result)
+
+    def test_put_product(self, perf, client):
+        payload = {"name": "Speaker", "price": 120.0, "category": "audio", "attributes": {"brand": "Sony"}}
+        result = perf.measure("put_product", lambda: client.put("/api/products/product-1", json=payload))
+        perf.check("put_product", result)
@@ -50,6 +50,8 @@ export default function CheckoutPage() {
     const [isSubmitting, setIsSubmitting] = useState(false);
     const [orderId, setOrderId] = useState<string | null>(null);
     const [errorMessage, setErrorMessage] = useState<string | null>(null);
+    // One key per checkout: retries and double-clicks reuse it, so the Orders API places the order only once
+    const [idempotencyKey] = useState(() => crypto.randomUUID());
 
     // FIX: Initialize with empty strings so placeholders show up
     const [shippingDetails, setShippingDetails] = useState({
@@ -88,6 +90,7 @@ export default function CheckoutPage() {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
+                    'Idempotency-Key': idempotencyKey,
                 },
                 body: JSON.stringify(orderPayload),
             });
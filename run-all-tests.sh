@@ -11,6 +11,20 @@ NC='\033[0m' # No Color
 OVERALL_STATUS=0
 BACKEND_STATUS=0
 FRONTEND_STATUS=0
+PERF_STATUS=0
+
+# Performance regression gate (backend/*/test_perf.py, see perf_gate.py):
+#   --perf          also check SQL statements and latency per request against perf_baseline.json
+#   --perf-update   record new baselines instead (commit the perf_baseline.json files)
+# Margins: PERF_STATEMENT_MARGIN (default 0), PERF_LATENCY_MARGIN (default 0.5)
+PERF_MODE=""
+for ARG in "$@"; do
+    case "$ARG" in
+        --perf) PERF_MODE="check" ;;
+        --perf-update) PERF_MODE="update" ;;
+        *) echo "Usage: $0 [--perf | --perf-update]"; exit 2 ;;
+    esac
+done
 
 echo -e "${BLUE}================================================${NC}"
 echo -e "${BLUE}        Running All Tests for EKS Microservices${NC}"
@@ -84,7 +98,7 @@ for SERVICE in "${BACKEND_SERVICES[@]}"; do
     # Install dependencies
     pip install -q --upgrade pip
     pip install -q -r requirements.txt
-    pip install -q pytest pytest-asyncio pytest-cov httpx
+    pip install -q pytest pytest-asyncio pytest-cov httpx fakeredis
     
     # Run tests
     echo "Running tests for ${SERVICE}..."
@@ -95,6 +109,31 @@ for SERVICE in "${BACKEND_SERVICES[@]}"; do
         BACKEND_STATUS=1
         OVERALL_STATUS=1
     fi
+
+    # Performance gate
+    if [ -n "$PERF_MODE" ]; then
+        if [ ! -f "test_perf.py" ]; then
+            print_warning "test_perf.py not found for ${SERVICE}"
+        elif [ "$PERF_MODE" = "update" ]; then
+            echo "Recording performance baseline for ${SERVICE}..."
+            if PERF_UPDATE_BASELINE=1 pytest test_perf.py -s --tb=short; then
+                print_success "${SERVICE} perf baseline written to ${SERVICE_DIR}/perf_baseline.json"
+            else
+                print_error "${SERVICE} perf baseline could not be recorded"
+                PERF_STATUS=1
+                OVERALL_STATUS=1
+            fi
+        else
+            echo "Running performance gate for ${SERVICE}..."
+            if PERF_TESTS=1 pytest test_perf.py -s --tb=short; then
+                print_success "${SERVICE} within its performance baseline"
+            else
+                print_error "${SERVICE} performance regressed beyond its baseline"
+                PERF_STATUS=1
+                OVERALL_STATUS=1
+            fi
+        fi
+    fi
     
     # Deactivate virtual environment
     deactivate
@@ -159,6 +198,14 @@ else
     print_error "Some frontend tests failed"
 fi
 
+if [ -n "$PERF_MODE" ]; then
+    if [ $PERF_STATUS -eq 0 ]; then
+        print_success "Performance gate passed"
+    else
+        print_error "Performance gate failed"
+    fi
+fi
+
 echo ""
 echo -e "${BLUE}================================================${NC}"
 